@@ -8,8 +8,10 @@ Date:
 
 from src.error import InputError, AccessError
 from src.config import url
+from src import config, data_store, index
+import collections
 import re
-import json
+import threading
 import jwt
 import hashlib
 import random
@@ -19,22 +21,13 @@ import datetime
 
 SECRET = 'atotallysecuresecret'
 
-#simplify reading data
+#simplify reading data, returns the resident copy of data.json
 def get_data():
-    data = {}
-    while True:
-        with open('data.json', 'r') as datafile:
-            try:
-                data = json.load(datafile)
-                break
-            except:
-                pass
-    return data
+    return data_store.get_store()
 
-# overwrite data.json with the given data
+# hand the given data back to the store, it is written to data.json on the next flush
 def write_data(data):
-    with open('data.json', 'w') as datafile:
-        json.dump(data, datafile, indent="")
+    data_store.set_store(data)
     return {}
 
 #return a hash string, used for passwords
@@ -61,15 +54,15 @@ def check_u_id(u_id, ignore_removed=False):
         Returns the index of the user in data['users']
     '''
 
-    data = get_data()
-    for i, user in enumerate(data['users']):
-        if user['u_id'] == u_id:
-            return i
-    raise InputError(description=f'u_id: {u_id} does not exist')
+    user_index = index.find_user('u_id', u_id)
+    if user_index is None:
+        raise InputError(description=f'u_id: {u_id} does not exist')
+    return user_index
 
 def new_session_id(u_id):
     '''
-        Takens in a user id and returns a new login session id
+        Takens in a user id and returns a new login session id, session ids
+        are unique across all users
 
     Arguments:
         u_id (integer) - a user's unique identifier
@@ -80,19 +73,7 @@ def new_session_id(u_id):
     Return Value:
         Returns the new session_id integer
     '''
-
-    data = get_data()
-    new_session_id = 1
-    try:
-        user = data['users'][check_u_id(u_id)]
-
-        for session in user['sessions_list']:
-            if session['session_id'] == new_session_id:
-                new_session_id += 1
-    except InputError:
-        #if the user is being registered return 1
-        pass
-    return new_session_id
+    return data_store.next_id('session_id')
 
 def check_token(token):
     '''
@@ -107,43 +88,83 @@ def check_token(token):
     Return Value:
         Returns the index of the user that the token checks for in data['users']
     '''
+    return decode_token(token)[2]
+
+# tokens that were checked, most recently used last, for the database they were checked against
+_tokens = {
+    'data' : None,
+    # token -> (u_id, session_id, user_index)
+    'checked' : collections.OrderedDict(),
+    # u_id -> number of times their tokens were forgotten
+    'generations' : {},
+}
+_token_lock = threading.Lock()
+
+def decode_token(token):
+    '''
+        Checks a token like check_token, remembering the result so that using the
+        same token again doesn't decode it again
 
+    Arguments:
+        token (string) - a user's jwt session token
+
+    Exceptions:
+        AccessError - Occurs when the u_id or session_id doesn't match anything in data
+
+    Return Value:
+        Returns a tuple of the u_id and session_id in the token and the index of the
+        user in data['users']
+    '''
     data = get_data()
-    #print(f"token = {token}")
+    with _token_lock:
+        if _tokens['data'] is not data:
+            _tokens['data'] = data
+            _tokens['checked'].clear()
+        checked = _tokens['checked'].get(token) if isinstance(token, str) else None
+        if checked is not None:
+            _tokens['checked'].move_to_end(token)
+            return checked
     token_structure = jwt.decode(token, SECRET, algorithms=['HS256'])
+    with _token_lock:
+        generation = _tokens['generations'].get(token_structure['u_id'], 0)
     try:
         user_index = check_u_id(token_structure['u_id'])
-        if token_structure['session_id'] not in \
-            [session['session_id'] for session in data['users'][user_index]['sessions_list']]:
-            # print(data['users'][user_index]['sessions_list'])
+        if not index.has_session(user_index, token_structure['session_id']):
             raise AccessError(description='invalid token')
     except InputError:
         raise AccessError(description='invalid token') from None
-    return user_index
+    checked = (token_structure['u_id'], token_structure['session_id'], user_index)
+    with _token_lock:
+        # a logout since the session was checked must not have its token remembered
+        if _tokens['data'] is data and \
+                _tokens['generations'].get(checked[0], 0) == generation:
+            _tokens['checked'][token] = checked
+            if len(_tokens['checked']) > config.token_cache_size:
+                _tokens['checked'].popitem(last=False)
+    return checked
+
+def forget_tokens(u_id, session_id=None):
+    '''
+        Drops the remembered tokens of a user's session, or of all their sessions,
+        once they are logged out
+    '''
+    with _token_lock:
+        _tokens['generations'][u_id] = _tokens['generations'].get(u_id, 0) + 1
+        for token, (token_u_id, token_session_id, _) in list(_tokens['checked'].items()):
+            if token_u_id == u_id and session_id in (None, token_session_id):
+                del _tokens['checked'][token]
 
 #checks if a handle is already in use
 def handle_taken(handle):
-    data = get_data()
-    for user in data['users']:
-        if user['handle_str'] == handle:
-            return True
-    return False
+    return index.find_user('handle_str', handle) is not None
 
 #checks if an id is already used
 def id_taken(id_num):
-    data = get_data()
-    for user in data['users']:
-        if user['u_id'] == id_num:
-            return True
-    return False
+    return index.find_user('u_id', id_num) is not None
 
 #checks if an email is already in use
 def email_taken(email):
-    data = get_data()
-    for user in data['users']:
-        if email == user['email']:
-            return True
-    return False
+    return index.find_user('email', email) is not None
 
 def valid_email(email):
     return re.search('^[a-zA-Z0-9]+[\\._]?[a-zA-Z0-9]+[@]\\w+[.]\\w{2,3}$', email)
@@ -213,9 +234,7 @@ def auth_register(email, password, name_first, name_last):
         raise InputError(description="The last name is not valid")
 
     #Generate unique numbers for id
-    id_num = 1
-    while id_taken(id_num):
-        id_num += 1
+    id_num = data_store.next_id('u_id')
     session_id = new_session_id(id_num)
     data = get_data()
 
@@ -235,12 +254,16 @@ def auth_register(email, password, name_first, name_last):
         'handle_str': generate_handle(name_first, name_last),
         'sessions_list' : [{'session_id' : session_id}],
         'notifications' : [],
+        'notifications_head' : 0,
+        'notifications_archived' : 0,
         'permission_id' : permission_id,
         'reset_code' : '',
         'channels_joined' : [{'num_channels_joined' : 0, 'time_stamp' : ts}],
         'dms_joined' : [{'num_dms_joined' : 0, 'time_stamp' : ts}],
         'messages_sent' : [{'num_messages_sent' : 0, 'time_stamp' : ts}]
     })
+    index.update_user(len(data['users']) - 1)
+    data_store.mark_user(id_num)
     write_data(data)
     return {'token' : generate_token(id_num, session_id), 'auth_user_id' : id_num}
 
@@ -266,15 +289,17 @@ def auth_login(email, password):
     elif not email_taken(email):
         raise InputError(description="The email enetered does not belong to a user")
 
-    for user in data['users']:
-        if user['email'] == email and user['password'] == new_hash(password):
-            if user['name_first'] == 'Removed user' and user['name_last'] == 'Removed user':
-                raise InputError(description='User has been removed')
-            new_id = new_session_id(user['u_id'])
-            user['sessions_list'].append({'session_id' : new_id})
-            write_data(data)
-            return {'token' : generate_token(user['u_id'], new_id), \
-                'auth_user_id' : user['u_id']}
+    user = data['users'][index.find_user('email', email)]
+    if user['password'] == new_hash(password):
+        if user['name_first'] == 'Removed user' and user['name_last'] == 'Removed user':
+            raise InputError(description='User has been removed')
+        new_id = new_session_id(user['u_id'])
+        user['sessions_list'].append({'session_id' : new_id})
+        index.update_user(index.find_user('u_id', user['u_id']))
+        data_store.mark_user(user['u_id'])
+        write_data(data)
+        return {'token' : generate_token(user['u_id'], new_id), \
+            'auth_user_id' : user['u_id']}
          
     raise InputError(description="The password is not correct")
 
@@ -293,24 +318,26 @@ def auth_logout(token):
         Returns a dictionary containing if the logout was successful or not
     '''
     try:
-        user_index = check_token(token)
-        session_id = jwt.decode(token, SECRET, algorithms=['HS256'])['session_id']
+        u_id, session_id, user_index = decode_token(token)
         data = get_data()
         for session in data['users'][user_index]['sessions_list']:
             if session['session_id'] == session_id:
                 data['users'][user_index]['sessions_list'].remove(session)
+                index.update_user(user_index)
+                forget_tokens(u_id, session_id)
+                data_store.mark_user(data['users'][user_index]['u_id'])
                 write_data(data)
+                break
         return {'is_success' : True}
     except (AccessError, InputError):
         return {'is_success' : False}    
 
 #return the user with the correct reset code or throw an error if it doesn't exist
 def check_reset_code(reset_code):
-    data = get_data()
-    for i, user in enumerate(data['users']):
-        if user['reset_code'] == new_hash(reset_code):
-            return i
-    raise InputError(description='reset_code is not a valid reset code')
+    user_index = index.find_user('reset_code', new_hash(reset_code))
+    if user_index is None:
+        raise InputError(description='reset_code is not a valid reset code')
+    return user_index
 
 #generate a new reset code of random characters
 def generate_reset_code():
@@ -345,9 +372,10 @@ Return Value:
     if not email_taken(email):
         raise InputError(description='email entered does not exist')
     reset_code = generate_reset_code()
-    for i, user in enumerate(data['users']):
-        if user['email'] == email:
-            data['users'][i]['reset_code'] = new_hash(reset_code)
+    user_index = index.find_user('email', email)
+    data['users'][user_index]['reset_code'] = new_hash(reset_code)
+    index.update_user(user_index)
+    data_store.mark_user(data['users'][user_index]['u_id'])
     write_data(data)
     return reset_code
 
@@ -374,6 +402,9 @@ Return Value:
     data['users'][user_index]['password'] = new_hash(new_password)
     #log out all sessions after reset
     data['users'][user_index]['sessions_list'] = []
+    index.update_user(user_index)
+    forget_tokens(data['users'][user_index]['u_id'])
+    data_store.mark_user(data['users'][user_index]['u_id'])
     write_data(data)
     return {}
 
@@ -12,7 +12,9 @@ Date:
 from src.error import InputError, AccessError
 from src.auth import get_data, write_data, check_token, check_u_id
 from src.user import user_profile
-from src.helper import get_user_dictionary 
+from src.helper import get_user_dictionary, push_notification
+from src.data_store import mark_user, mark_channel
+from src import config, events, index
 
 import datetime
 import jwt
@@ -20,6 +22,15 @@ import jwt
 SECRET = 'atotallysecuresecret'
 
 def notify_user(u_id, channel_id, notification_message):
+    notify_users([u_id], channel_id, notification_message)
+
+def notify_users(u_ids, channel_id, notification_message):
+    '''
+    Gives each user the same notification about a channel or dm, writing the
+    data once for all of them
+    '''
+    if not u_ids:
+        return
     data = get_data()
     channel_index = get_channel_index(channel_id)
     notification = {
@@ -27,8 +38,12 @@ def notify_user(u_id, channel_id, notification_message):
         'dm_id' : channel_id if data['channels'][channel_index]['is_dm'] else -1,
         'notification_message' : notification_message
     }
-    data['users'][check_u_id(u_id)]['notifications'].insert(0, notification)
+    for u_id in u_ids:
+        push_notification(data['users'][check_u_id(u_id)], dict(notification))
+        mark_user(u_id)
     write_data(data)
+    for u_id in u_ids:
+        events.publish([u_id], dict(notification, type='notification'))
 
 def generate_addedChannel_notification(u_id, token, channel_name):
     data = get_data()
@@ -51,27 +66,31 @@ def channel_stats_update(func):
         resp = func(*args, **kw)
         data = get_data()
 
-        for i, user in enumerate(data['users']):
-            num_dms = 0
-            num_channels = 0
-            for channel in data['channels']:
-                if user_is_member(user['u_id'], channel):
-                    if channel['is_dm']:
-                        num_dms += 1
-                    else:
-                        num_channels += 1
-            user = update_user('channels_joined', num_channels, user)  
-            user = update_user('dms_joined', num_dms, user)
-            data['users'][i] = user
-        data = update_user('channels_exist', 
-            len([channel for channel in data['channels'] if not channel['is_dm']]), data)
-        data = update_user('dms_exist',
-            len([dm for dm in data['channels'] if dm['is_dm']]), data)
-        write_data(data)
+        # only users whose memberships changed since the last update can have new stats
+        stale = index.take_stale_members()
+        if stale is None:
+            users = data['users']
+        else:
+            positions = (index.find_user('u_id', u_id) for u_id in stale)
+            users = [data['users'][i] for i in sorted(i for i in positions if i is not None)]
+        changed = False
+        for user in users:
+            num_channels, num_dms = index.joined_counts(user['u_id'])
+            num_changes = len(user['channels_joined']) + len(user['dms_joined'])
+            update_user('channels_joined', num_channels, user)
+            update_user('dms_joined', num_dms, user)
+            if len(user['channels_joined']) + len(user['dms_joined']) != num_changes:
+                mark_user(user['u_id'])
+                changed = True
+        num_changes = len(data['channels_exist']) + len(data['dms_exist'])
+        num_channels, num_dms = index.channel_counts()
+        update_user('channels_exist', num_channels, data)
+        update_user('dms_exist', num_dms, data)
+        if changed or len(data['channels_exist']) + len(data['dms_exist']) != num_changes:
+            write_data(data)
         return resp
     return wrap
 
-@channel_stats_update
 def channel_invite(token, channel_id, u_id, is_dm = False):
     """
     Invites a user (with user id u_id) to join a channel with ID channel_id.
@@ -86,7 +105,30 @@ def channel_invite(token, channel_id, u_id, is_dm = False):
         InputError - Invalid auth_user_id or u_id or channel_id.
         InputError - User being invited is already a channel member.
         AccessError - When auth_user is not a member of the channel.
-c
+
+    Return Value:
+        None
+    """
+    return channel_invite_many(token, channel_id, [u_id])
+
+@channel_stats_update
+def channel_invite_many(token, channel_id, u_ids):
+    """
+    Invites several users to a channel at once. Either all of them are added or,
+    if any of them can't be, none are. The channel is written, the users are
+    notified and their stats are updated once for the whole batch.
+
+    Arguments:
+        token(string): Id of user in a certain session.
+        channel_id (int): Id to the channel the users are being invited to.
+        u_ids (list of int): Ids of the users to be invited.
+
+    Exceptions:
+        InputError - Invalid auth_user_id or u_id or channel_id.
+        InputError - A user being invited is already a channel member, or is
+            invited twice.
+        AccessError - When auth_user is not a member of the channel.
+
     Return Value:
         None
     """
@@ -94,40 +136,34 @@ c
     # Decode token to get the u_id
     auth_user_id = data['users'][check_token(token)]['u_id']
 
-    # Check if auth_user_id and/or u_id exists in the database.
-    check_u_id(u_id)
+    # Check if every u_id exists in the database.
+    for u_id in u_ids:
+        check_u_id(u_id)
 
     # Check if channel_id exists.
     if not channel_id_valid(channel_id, data['channels']):
         raise InputError(description="Invalid channel id!")
 
     # Authorised user is not a member of the channel
-    is_auth_a_member = member_check(auth_user_id, channel_id, data['channels'])
-    if not is_auth_a_member:
+    if not member_check(auth_user_id, channel_id, data['channels']):
         raise AccessError(description="Auth user is not a member of the channel!")
 
-    # Check if u_id is already a member of the channel
-    is_user_a_member = member_check(u_id, channel_id, data['channels'])
-    if is_user_a_member:
+    # Check if any u_id is already a member of the channel
+    members = index.channel_members(channel_id)
+    if len(set(u_ids)) != len(u_ids) or any(u_id in members for u_id in u_ids):
         raise InputError(description="User has already been added!")
-    
-    for valid_channel in data['channels']:
-        if valid_channel['channel_id'] == channel_id:
-            channel_name = valid_channel['name']
-            # Add user details to the all_members key.
-            valid_channel['all_members'].append({'u_id': u_id})
-    '''
-    if not is_dm:
-        num_channels_joined = data['users'][user_index]['channels_joined'][-1]['num_channels_joined'] + 1
-        data['users'][user_index]['channels_joined'].append({'num_channels_joined' : num_channels_joined})
-    else:
-        num_dms_joined = data['users'][users_index]['dms_joined'][-1]['num_dms_joined'] + 1
-        data['users'][user_index]['channels_joined'].append({'num_channels_joined' : num_channels_joined})
-    '''
+    if not u_ids:
+        return {}
+
+    valid_channel = data['channels'][index.find_channel(channel_id)]
+    # Add user details to the all_members key.
+    valid_channel['all_members'].extend({'u_id': u_id} for u_id in u_ids)
+    index.update_channel(channel_id)
+    mark_channel(channel_id)
     write_data(data)
-        
-    notification_message = generate_addedChannel_notification(u_id, token, channel_name)
-    notify_user(u_id, channel_id, notification_message)
+
+    notification_message = generate_addedChannel_notification(None, token, valid_channel['name'])
+    notify_users(u_ids, channel_id, notification_message)
     return {}
 
 def channel_details(token, channel_id):
@@ -159,17 +195,24 @@ def channel_details(token, channel_id):
     check_is_member(data['users'][user_index]['u_id'], data['channels'][channel_index]['all_members'])
     return get_channel_details(data['channels'][channel_index])
 
-def channel_messages(token, channel_id, start):
+def channel_messages(token, channel_id, start=None, before_message_id=None, after_message_id=None,
+    page_size=None):
     '''
     Index the list of channels in data and return the messages from the start index to 
-    the end as well as a new end
+    the end as well as a new end. Without a start the messages are paged by message id
+    instead, see message_page.
 
     Arguments:
         token (str) - session specific user ID
         channel_id (int) - ID of channel of which messages are requested
+        start (int) - how many of the newest messages to skip
+        before_message_id (int) - return the messages older than this one
+        after_message_id (int) - return the messages newer than this one
+        page_size (int) - most messages to return when paging by message id
 
     Exceptions:
         InputError  - Occurs when channel ID is not a valid ID
+        InputError  - Occurs when a message id to page from is not in the channel
         AccessError - Occurs when token is not valid or when user is not a 
             member of the specified channel
 
@@ -190,6 +233,9 @@ def channel_messages(token, channel_id, start):
     channel_index = check_channel_id(channel_id)
 
     check_is_member(data['users'][user_index]['u_id'], data['channels'][channel_index]['all_members'])
+
+    if start is None or before_message_id is not None or after_message_id is not None:
+        return message_page(channel_index, before_message_id, after_message_id, page_size)
     
     num_messages= len(data['channels'][channel_index]['messages'])
     if start > num_messages:
@@ -250,6 +296,8 @@ def channel_leave(token, channel_id):
     except:
         pass
         
+    index.update_channel(channel_id)
+    mark_channel(channel_id)
     write_data(data)
     return {}
 
@@ -291,6 +339,8 @@ def channel_join(token, channel_id):
         if not data['channels'][channel_index]['is_public']:
             check_global_owner(data['users'][user_index]['permission_id'])
         data['channels'][channel_index]['all_members'].append({'u_id' : data['users'][user_index]['u_id']})
+        index.update_channel(channel_id)
+        mark_channel(channel_id)
         write_data(data)
         return {}
 
@@ -326,11 +376,12 @@ def channel_addowner(token, channel_id, u_id):
     
     
     # Append user id to the owner list
-    for channel in data['channels']:
-        if channel['channel_id'] == channel_id:
-            channel['owner_members'].append({'u_id' : u_id})   
-            channel['all_members'].append({'u_id' : u_id})         
+    channel = data['channels'][index.find_channel(channel_id)]
+    channel['owner_members'].append({'u_id' : u_id})   
+    channel['all_members'].append({'u_id' : u_id})         
     
+    index.update_channel(channel_id)
+    mark_channel(channel_id)
     write_data(data)
 
     return {}
@@ -361,12 +412,13 @@ def channel_removeowner(token, channel_id, u_id):
     
     if not user_is_owner_uid(auth_user_id, channel_id):
         raise InputError(description="User is already an owner of the channel")
-    for i, channel in enumerate(data['channels']):
-        if channel['channel_id'] == channel_id:
-            if len(channel['owner_members']) <= 1:
-                raise InputError(description="User is the only owner of the channel")
-            data['channels'][i]['owner_members'].remove({'u_id' : u_id})
+    channel = data['channels'][index.find_channel(channel_id)]
+    if len(channel['owner_members']) <= 1:
+        raise InputError(description="User is the only owner of the channel")
+    channel['owner_members'].remove({'u_id' : u_id})
 
+    index.update_channel(channel_id)
+    mark_channel(channel_id)
     write_data(data)
     return {}
     
@@ -388,10 +440,7 @@ def channel_id_valid(channel_id, channels):
     Return value:
         (bool): Whether or not channel_id could be found.
     """
-    for valid_channel in channels:
-        if channel_id == valid_channel['channel_id']:
-            return True
-    return False
+    return index.find_channel(channel_id) is not None
 
 def user_is_member(user_id, channel):
     """
@@ -403,6 +452,120 @@ def user_is_member(user_id, channel):
             return True
     return False
 
+def channel_messages_changes(token, channel_id, since):
+    '''
+    Returns only the messages of a channel that were sent, edited, removed, pinned or
+    reacted to since the client last looked, so it doesn't have to fetch a whole page
+    again to find out
+
+    Arguments:
+        token (str) - session specific user ID
+        channel_id (int) - ID of channel of which changes are requested
+        since (int) - the change_seq returned by the client's previous call, 0 for
+            everything that is still remembered
+
+    Exceptions:
+        InputError  - Occurs when channel ID is not a valid ID
+        AccessError - Occurs when token is not valid or when user is not a 
+            member of the specified channel
+
+    Returns:
+        Returns (dict) which contains the changed messages newest first, the ids of
+        removed messages, the change_seq to pass next time and whether the changes
+        since then are no longer known, in which case the client has to fetch the
+        messages again with channel_messages
+    '''
+    data = get_data()
+    user_index = check_token(token)
+    channel_index = check_channel_id(channel_id)
+    check_is_member(data['users'][user_index]['u_id'], data['channels'][channel_index]['all_members'])
+
+    changed, change_seq = index.changes_since(channel_id, since)
+    if changed is None:
+        return {'messages' : [], 'removed_message_ids' : [], 'change_seq' : change_seq,
+            'reset' : True}
+
+    positions = []
+    removed = []
+    for message_id in changed:
+        found = index.find_message(message_id)
+        if found is None or found[0] != channel_index:
+            removed.append(message_id)
+        else:
+            positions.append(found[1])
+    messages = data['channels'][channel_index]['messages']
+    return {
+        'messages' : [messages[position] for position in sorted(positions, reverse=True)],
+        'removed_message_ids' : sorted(removed),
+        'change_seq' : change_seq,
+        'reset' : False,
+    }
+
+def message_page(channel_index, before_message_id=None, after_message_id=None, page_size=None):
+    """
+    Returns a page of a channel's messages, newest first. Pages are found by
+    message id rather than by offset, so messages sent in the meantime don't
+    move them.
+
+    Arguments:
+        channel_index (int): index of the channel in data['channels']
+        before_message_id (int): page back through the messages older than this one
+        after_message_id (int): page forward through the messages newer than this one,
+            the newest messages are returned if neither is given
+        page_size (int): most messages to return, config.messages_page_size by default
+
+    Exceptions:
+        InputError - Occurs when both message ids are given, page_size isn't positive
+            or a message id is not in the channel
+
+    Returns:
+        Returns (dict) which contains the messages, 'before_message_id' to ask for the
+        page before this one (-1 if there are no older messages or the page is empty) and 'after_message_id'
+        to ask for messages newer than this page (-1 if there are no messages or the page
+        is an empty one before the oldest message)
+    """
+    if before_message_id is not None and after_message_id is not None:
+        raise InputError(description='Only one of before_message_id and after_message_id can be given')
+    if page_size is None:
+        page_size = config.messages_page_size
+    if page_size < 1:
+        raise InputError(description='Page size must be at least 1')
+
+    messages = get_data()['channels'][channel_index]['messages']
+    if after_message_id is not None:
+        low = message_position(channel_index, after_message_id) + 1
+        high = min(len(messages), low + page_size)
+    else:
+        high = len(messages) if before_message_id is None else \
+            message_position(channel_index, before_message_id)
+        low = max(0, high - page_size)
+
+    if high > low:
+        newest = messages[high - 1]['message_id']
+    elif after_message_id is not None:
+        newest = after_message_id
+    elif before_message_id is not None:
+        # nothing is older than the oldest message, and newer than any message
+        # id would skip the oldest one
+        newest = -1
+    else:
+        newest = messages[-1]['message_id'] if messages else -1
+    return {
+        'messages' : messages[low:high][::-1],
+        'before_message_id' : messages[low]['message_id'] if 0 < low < high else -1,
+        'after_message_id' : newest,
+    }
+
+def message_position(channel_index, message_id):
+    """
+    Returns the index of a message in the channel's messages, raising InputError
+    if it isn't one of them
+    """
+    found = index.find_message(message_id)
+    if found is None or found[0] != channel_index:
+        raise InputError(description='Message ID is not in this channel')
+    return found[1]
+
 def get_channel_details(channel):
     """
     Get channel details of a given channel ID
@@ -458,12 +621,7 @@ def get_channel_index(channel_id):
     Returns:
         Returns i (int) which is the index of the given channel
     """
-    data = get_data()
-    i = 0
-    for channel in data['channels']:
-        if channel['channel_id'] == channel_id:
-            return i
-        i += 1
+    return index.find_channel(channel_id)
         
 def member_check(user_id, channel_id, channels):
     """
@@ -477,13 +635,7 @@ def member_check(user_id, channel_id, channels):
     Returns:
         (bool): Whether or not user could be found in the given channel.
     """
-    for valid_channel in channels:
-        if valid_channel['channel_id'] == channel_id:
-            # Check if auth_user is a part of members
-            for members in valid_channel['all_members']:
-                if members['u_id'] == user_id:
-                    return True
-    return False
+    return index.is_member(user_id, channel_id)
 
 def get_user_details(u_id):
     """
@@ -537,11 +689,10 @@ def check_channel_id(channel_id):
     Return value:
         i (int): index of channel 
     '''
-    data = get_data()
-    for i, channel in enumerate(data['channels']):
-        if channel['channel_id'] == channel_id:
-            return i
-    raise InputError(description='Channel ID not valid')
+    channel_index = index.find_channel(channel_id)
+    if channel_index is None:
+        raise InputError(description='Channel ID not valid')
+    return channel_index
 
 def user_is_owner_token(token, channel_id):
     ''' Checks if auth user is an owner of a channel given a 
@@ -557,12 +708,7 @@ def user_is_owner_token(token, channel_id):
 
     user_index = check_token(token)
     data = get_data()
-    for channel in data['channels']:
-        if channel['channel_id'] == channel_id:
-            for owner in channel['owner_members']:
-                if owner['u_id'] == data['users'][user_index]['u_id']:
-                    return True
-    return False
+    return index.is_owner(data['users'][user_index]['u_id'], channel_id)
 
 def user_is_owner_uid(u_id, channel_id):
     ''' Checks if user is an owner of a channel given a 
@@ -575,14 +721,7 @@ def user_is_owner_uid(u_id, channel_id):
         Returns:
             True if user is an owner, false otherwise.
     '''
-    
-    data = get_data()
-    for channel in data['channels']:
-        if channel['channel_id'] == channel_id:
-            for owner in channel['owner_members']:
-                if owner['u_id'] == u_id:
-                    return True
-    return False
+    return index.is_owner(u_id, channel_id)
 
 def channel_is_valid(channel_id):
     ''' Checks weather a channel is valid given a channel id. 
@@ -594,11 +733,7 @@ def channel_is_valid(channel_id):
             Returns True if a channel is found in the data, False otherwise. 
     '''
 
-    data = get_data()
-    for channel in data['channels']:
-        if channel['channel_id'] == channel_id:
-            return True
-    return False
+    return index.find_channel(channel_id) is not None
 
 def check_global_owner(permission_id):
     '''
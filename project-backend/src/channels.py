@@ -12,11 +12,10 @@ from src.channel import channel_stats_update
 from src.error import InputError, AccessError
 from src.user import user_profile
 from src.helper import channel_id_generate, create_channel_details
+from src.data_store import mark_channel
+from src import index
 
 import datetime
-import jwt
-
-SECRET = 'atotallysecuresecret'
 
 def channels_list(token, is_dm=False):
     '''
@@ -37,24 +36,20 @@ def channels_list(token, is_dm=False):
     # Check if auth_user exists in the database
     data = get_data()
     
-    check_token(token)
-
-    token_structure = jwt.decode(token, SECRET, algorithms=['HS256'])
-    u_id = token_structure['u_id']
+    u_id = data['users'][check_token(token)]['u_id']
     
     channel_dict = {'channels' : []}
 
-    # Loop through all channels stored in data file.
-    for channel in data['channels']:
+    # Only the channels the user has joined, in the order they are stored.
+    for channel_index in sorted(index.find_channel(channel_id) for channel_id in \
+        index.user_channels(u_id)):
+        channel = data['channels'][channel_index]
         if is_dm == channel['is_dm']:
             # Get details of the current channel.
-            curr_channel = {
+            channel_dict['channels'].append({
                 'channel_id': channel['channel_id'],
                 'name': channel['name']
-            }
-            for member in channel['all_members']:
-                if member["u_id"] == u_id:
-                    channel_dict['channels'].append(curr_channel)
+            })
     return channel_dict
 
 def channels_listall(token, is_dm=False):
@@ -118,7 +113,7 @@ def channels_create(token, name, is_public, is_dm=False):
     data = get_data()
 
     # Validate token
-    check_token(token)
+    u_id = data['users'][check_token(token)]['u_id']
 
     # Name is longer than 20 chars long.
     if not is_dm and len(name) > 20:
@@ -128,20 +123,13 @@ def channels_create(token, name, is_public, is_dm=False):
     if len(name) == 0:
         raise InputError(description="Invalid channel name!")
 
-    # Decode token to get the u_id
-    token_structure = jwt.decode(token, SECRET, algorithms=['HS256'])
-    u_id = token_structure['u_id']
-
     # Look into the database to find a new channel_id.
-    channel_id = channel_id_generate(data['channels'])
-
-    # Decode token to get the u_id
-    token_structure = jwt.decode(token, SECRET, algorithms=['HS256'])
-    u_id = token_structure['u_id']
+    channel_id = channel_id_generate()
 
     # Add channel details to the database.
     channel_details = create_channel_details(channel_id, name, token, u_id, is_public, is_dm)
     data['channels'].append(channel_details)
+    mark_channel(channel_id)
     write_data(data)
 
     return {
@@ -1,3 +1,61 @@
 port = 8087
 
-url = f"http://localhost:{port}/"
\ No newline at end of file
+url = f"http://localhost:{port}/"
+
+# file the in-memory database is persisted to
+data_file = 'data.json'
+
+# seconds between writes of dirty data to data_file, 0 writes on every write_data
+flush_interval = 1
+
+# 'snapshot' rewrites data_file on each flush, 'log' appends every change to log_file,
+# 'sqlite' stores everything in indexed tables in db_file
+storage_mode = 'snapshot'
+
+log_file = 'data.log'
+
+# number of log records after which the log is folded back into data_file
+compact_threshold = 1000
+
+db_file = 'data.sqlite'
+
+# lines sent to active standups are held in memory and appended to standup_journal,
+# at most standup_buffer_limit lines per standup
+standup_journal = 'standup.journal'
+standup_buffer_limit = 1000
+
+# messages in a page of channel/messages when paging by message id
+messages_page_size = 50
+
+# changes to messages remembered per channel for channel/messages/changes, clients
+# further behind than that have to fetch the messages again
+change_log_limit = 1000
+
+# notifications kept with each user, older ones are moved to notification_archive
+# (or dropped if it is None) and read back only when paging that far
+notification_limit = 100
+notification_archive = 'notifications.archive'
+
+# the search index is saved here, see src.search_index, and compacted after
+# search_compact_threshold changes
+search_index_file = 'search.index'
+search_compact_threshold = 1000
+
+# most messages in a page of search results
+search_limit = 100
+
+# checked tokens remembered so they aren't decoded again
+token_cache_size = 10000
+
+# events kept for clients long-polling events/v1, and the most seconds one request waits
+event_buffer_limit = 1000
+events_timeout = 30
+
+# uploaded profile pictures are saved in image_dir, see src.image_pipeline, they are
+# fetched image_chunk_size bytes at a time by image_fetch_workers threads and cropped
+# by image_crop_workers processes (0 crops in the fetching thread)
+image_dir = 'src/static'
+image_fetch_workers = 4
+image_crop_workers = 2
+image_fetch_timeout = 10
+image_chunk_size = 64 * 1024
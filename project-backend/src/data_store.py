@@ -0,0 +1,632 @@
+'''
+Resident copy of the Dreams database.
+
+get_data and write_data in src.auth hand out the dictionary held here instead
+of re-reading data.json, and write_data only marks it dirty. How dirty data
+reaches the disk depends on config.storage_mode:
+
+    'snapshot' - the whole database is written back to config.data_file by
+                 flush_data, either at a commit boundary or by a background
+                 timer once config.flush_interval seconds have passed.
+    'log'      - every write_data appends one small record per changed user,
+                 channel or message to config.log_file. Once the log holds
+                 config.compact_threshold records a background compactor
+                 folds it into a new snapshot. Loading replays the snapshot
+                 followed by the log.
+    'sqlite'   - the same records are applied as row updates to the tables
+                 in config.db_file, see src.sqlite_store.
+
+Mutating functions report what they changed with the mark_* functions below,
+the records they produce are idempotent so a log can safely be replayed on
+top of a snapshot that already contains some of it.
+
+Between begin_request and end_request (opened around every HTTP request by
+src.server) write_data only stages the data and the marks are kept with the
+request, everything the request changed is committed once when it ends.
+'''
+
+import atexit
+import datetime
+import json
+import os
+import threading
+import time
+
+from src import config, sqlite_store
+
+_lock = threading.RLock()
+_compact_lock = threading.Lock()
+_request = threading.local()
+
+_store = {
+    'data' : None,
+    'dirty' : False,
+    'last_flush' : 0,
+    'timer' : None,
+    'log' : None,
+    'log_records' : 0,
+    'compactor' : None,
+    'logged' : {},
+    'file_stat' : None,
+}
+
+# every kind of id handed out by next_id
+SEQUENCES = ('u_id', 'session_id', 'channel_id', 'message_id', 'job_id', 'change_seq',
+    'search_seq', 'image_id')
+
+_marks = {
+    'users' : set(),
+    'channels' : set(),
+    'messages' : set(),
+    'removed_messages' : set(),
+    'removed_channels' : set(),
+}
+
+def empty_data():
+    '''
+    Returns the structure of a freshly cleared database
+    '''
+    ts = datetime.datetime.now().timestamp()
+    return {
+        'users' : [],
+        'channels' : [],
+        'channels_exist' : [{'num_channels_exist' : 0, 'time_stamp' : ts}],
+        'dms_exist' : [{'num_dms_exist' : 0, 'time_stamp' : ts}],
+        'messages_exist' : [{'num_messages_exist' : 0, 'time_stamp' : ts}],
+        'sequences' : {key: 0 for key in SEQUENCES},
+    }
+
+def _file_stat(path, stat=None):
+    '''
+    Identifies the current version of the file at path, None if it doesn't exist
+    '''
+    try:
+        stat = stat or os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+def _write_atomic(path, text):
+    '''
+    Writes text to a temporary file next to path and renames it over path,
+    so a reader sees either the old or the new file but never part of one
+    '''
+    temp = path + '.tmp'
+    with open(temp, 'w') as tempfile:
+        tempfile.write(text)
+        tempfile.flush()
+        os.fsync(tempfile.fileno())
+    os.replace(temp, path)
+    return _file_stat(path)
+
+def _unchanged_on_disk():
+    if _store['data'] is None or _store['dirty'] or config.storage_mode == 'sqlite':
+        return False
+    if config.storage_mode == 'log' and (os.path.exists(config.log_file) or \
+            os.path.exists(config.log_file + '.compacting')):
+        return False
+    stat = _file_stat(config.data_file)
+    return stat is not None and stat == _store['file_stat']
+
+def load_data():
+    '''
+    Reads config.data_file into the store, starting from an empty database
+    if the file doesn't exist yet. In log mode any records written since the
+    snapshot are replayed on top of it. If the file is the same one that was
+    last loaded or written and nothing is pending, the resident copy is kept.
+
+    Return Value:
+        Returns the loaded data dictionary
+    '''
+    with _lock:
+        if _unchanged_on_disk():
+            return _store['data']
+        if config.storage_mode == 'sqlite':
+            data = sqlite_store.load_all() or empty_data()
+        else:
+            try:
+                with open(config.data_file, 'r') as datafile:
+                    # the file that was opened, a writer may rename a new one in meanwhile
+                    _store['file_stat'] = _file_stat(config.data_file, os.fstat(datafile.fileno()))
+                    data = json.load(datafile)
+            except FileNotFoundError:
+                data = empty_data()
+        _store['dirty'] = False
+        if config.storage_mode == 'log':
+            _close_log()
+            _store['log_records'] = replay_log(data, config.log_file + '.compacting') + \
+                replay_log(data, config.log_file)
+            _store['dirty'] = _store['log_records'] > 0
+        _store['data'] = data
+        _store['logged'] = _root_state(data)
+        _clear_marks()
+    if _store['dirty']:
+        # start the new log from a clean snapshot, a torn record would hide later ones
+        compact_log()
+    return data
+
+def get_store():
+    '''
+    Returns the resident data dictionary, loading it on first use
+    '''
+    if getattr(_request, 'counts', None) is not None:
+        _request.counts['reads'] += 1
+    data = _store['data']
+    if data is None:
+        data = load_data()
+    return data
+
+def set_store(data):
+    '''
+    Takes in the data dictionary after a mutation and commits it, or stages it
+    until end_request if called during a request.
+
+    Arguments:
+        data (dict) - the database, normally the dictionary from get_store
+
+    Return Value:
+        None
+    '''
+    if getattr(_request, 'counts', None) is not None:
+        _request.counts['writes'] += 1
+        _request.pending = data
+        with _lock:
+            _store['data'] = data
+        return
+    commit(data)
+
+def commit(data):
+    '''
+    Marks the data as dirty, writing it out now if the flush interval has
+    already passed. In log and sqlite mode the marked changes are written
+    straight away instead.
+    '''
+    if config.storage_mode == 'sqlite':
+        with _lock:
+            _store['data'] = data
+            records = collect_records(data)
+            if records:
+                sqlite_store.apply_records(records)
+            else:
+                # nothing was marked, only rewriting every table is known to be correct
+                sqlite_store.save_all(data)
+        return
+    if config.storage_mode == 'log':
+        with _lock:
+            _store['data'] = data
+            _store['dirty'] = True
+            records = collect_records(data)
+            if records:
+                append_log(records)
+        if not records:
+            # nothing was marked, only a full snapshot is known to be correct
+            compact_log()
+        return
+    with _lock:
+        _store['data'] = data
+        _store['dirty'] = True
+        if time.time() - _store['last_flush'] >= config.flush_interval:
+            flush_data()
+        elif _store['timer'] is None:
+            _store['timer'] = threading.Timer(config.flush_interval, flush_data)
+            _store['timer'].daemon = True
+            _store['timer'].start()
+
+def flush_data():
+    '''
+    Writes the store to config.data_file if it has changed since the last flush,
+    in log mode this folds the log into the snapshot
+    '''
+    if config.storage_mode == 'sqlite':
+        return
+    if config.storage_mode == 'log':
+        compact_log()
+        return
+    with _lock:
+        if _store['timer'] is not None:
+            _store['timer'].cancel()
+            _store['timer'] = None
+        if not _store['dirty']:
+            return
+        _store['file_stat'] = _write_atomic(config.data_file, json.dumps(_store['data'], indent=""))
+        _store['dirty'] = False
+        _store['last_flush'] = time.time()
+
+def reset_data():
+    '''
+    Replaces the store with an empty database and writes it out immediately
+    '''
+    with _lock:
+        _store['data'] = empty_data()
+        _store['dirty'] = True
+        _store['logged'] = _root_state(_store['data'])
+        _clear_marks()
+        if config.storage_mode == 'sqlite':
+            sqlite_store.save_all(_store['data'])
+    # the empty database is already written, nothing is left for end_request
+    _request.pending = None
+    flush_data()
+
+# --------------------------------------------------------------------------------------- #
+# ----------------------------- Unit of Work -------------------------------------------- #
+# --------------------------------------------------------------------------------------- #
+def begin_request():
+    '''
+    Starts staging writes made by the current thread and counting its store
+    reads, writes and commits
+    '''
+    _request.counts = {'reads' : 0, 'writes' : 0, 'commits' : 0}
+    _request.pending = None
+    _request.marks = _new_marks()
+
+def end_request():
+    '''
+    Commits whatever the current thread wrote since begin_request, at most once
+
+    Return Value:
+        Returns the dictionary of counts for the request, None outside one
+    '''
+    counts = getattr(_request, 'counts', None)
+    if counts is None:
+        return None
+    pending = _request.pending
+    _request.counts = None
+    _request.pending = None
+    _merge_marks(_request.marks)
+    _request.marks = None
+    if pending is not None:
+        commit(pending)
+        counts['commits'] += 1
+    return counts
+
+# --------------------------------------------------------------------------------------- #
+# ----------------------------- Sequences ----------------------------------------------- #
+# --------------------------------------------------------------------------------------- #
+def _seed_sequences(data):
+    '''
+    Finds the largest id of each kind in a database saved before it kept
+    sequences, so the ids carry on after them
+    '''
+    sequences = {key: 0 for key in SEQUENCES}
+    for user in data['users']:
+        sequences['u_id'] = max(sequences['u_id'], user['u_id'])
+        for session in user['sessions_list']:
+            sequences['session_id'] = max(sequences['session_id'], session['session_id'])
+    for channel in data['channels']:
+        sequences['channel_id'] = max(sequences['channel_id'], channel['channel_id'])
+        for message in channel['messages']:
+            sequences['message_id'] = max(sequences['message_id'], message['message_id'])
+    return sequences
+
+def next_id(key):
+    '''
+    Hands out the next id of a kind, ids are never reused even once the
+    thing they belonged to is removed
+
+    Arguments:
+        key (string) - one of SEQUENCES
+
+    Return Value:
+        Returns the new id
+    '''
+    with _lock:
+        data = get_store()
+        if 'sequences' not in data:
+            data['sequences'] = _seed_sequences(data)
+        data['sequences'][key] = data['sequences'].get(key, 0) + 1
+        return data['sequences'][key]
+
+# --------------------------------------------------------------------------------------- #
+# ----------------------------- Change Marks -------------------------------------------- #
+# --------------------------------------------------------------------------------------- #
+def _mark(kind, key):
+    '''
+    Remembers that something changed, in the current request's own marks until
+    it ends so other requests don't commit its half finished changes
+    '''
+    if config.storage_mode == 'snapshot':
+        return
+    marks = getattr(_request, 'marks', None)
+    if getattr(_request, 'counts', None) is not None and marks is not None:
+        marks[kind].add(key)
+        return
+    with _lock:
+        _marks[kind].add(key)
+
+def mark_user(u_id):
+    _mark('users', u_id)
+
+def mark_channel(channel_id):
+    _mark('channels', channel_id)
+
+def mark_message(channel_id, message_id):
+    _mark('messages', (channel_id, message_id))
+
+def mark_removed_message(channel_id, message_id):
+    _mark('removed_messages', (channel_id, message_id))
+
+def mark_removed_channel(channel_id):
+    _mark('removed_channels', channel_id)
+
+def _new_marks():
+    return {kind: set() for kind in _marks}
+
+def _merge_marks(marks):
+    with _lock:
+        for kind, marked in marks.items():
+            _marks[kind] |= marked
+
+def _take_marks():
+    '''
+    Swaps the marks made so far for empty ones and returns them
+    '''
+    with _lock:
+        taken = {kind: marked for kind, marked in _marks.items()}
+        for kind in taken:
+            _marks[kind] = set()
+    return taken
+
+def _clear_marks():
+    _take_marks()
+    _request.marks = _new_marks()
+
+# --------------------------------------------------------------------------------------- #
+# ----------------------------- Write-Ahead Log ----------------------------------------- #
+# --------------------------------------------------------------------------------------- #
+def _find(items, key, value):
+    for item in items:
+        if item[key] == value:
+            return item
+    return None
+
+def _channel_record(channel):
+    return {key: value for key, value in channel.items() if key != 'messages'}
+
+# top level lists that have entries taken out as well as appended, logged whole
+# whenever their json text changes rather than an entry at a time
+ROOT_SETS = ('scheduled',)
+
+def _root_logged(key, value):
+    if isinstance(value, list) and key not in ROOT_SETS:
+        return len(value)
+    return json.dumps(value)
+
+def _root_state(data):
+    '''
+    Remembers how much of each top level entry (other than users and channels)
+    has been logged, series by their length and anything else by its json text.
+    What was logged of each user is kept under 'users', see _user_state
+    '''
+    state = {}
+    for key, value in data.items():
+        if key in ('users', 'channels'):
+            continue
+        state[key] = _root_logged(key, value)
+    state['users'] = {user['u_id']: _user_state(user) for user in data['users']}
+    return state
+
+# stats that only ever grow, logged an entry at a time like root series
+USER_SERIES = ('channels_joined', 'dms_joined', 'messages_sent')
+# short lists that change in place, logged whole when they change
+USER_LISTS = ('sessions_list', 'notifications')
+
+def _user_scalars(user):
+    return {key: value for key, value in user.items() \
+        if key not in USER_SERIES and key not in USER_LISTS}
+
+def _user_state(user):
+    state = {key: len(user.get(key, [])) for key in USER_SERIES}
+    state.update({key: json.dumps(user.get(key, [])) for key in USER_LISTS})
+    state['scalars'] = json.dumps(_user_scalars(user))
+    return state
+
+def _user_records(user, logged):
+    '''
+    Returns the records for what changed in a user since logged, a user record
+    with the fields that aren't lists, appended entries of each stats series
+    and any of USER_LISTS that changed
+    '''
+    u_id = user['u_id']
+    records = []
+    scalars = _user_scalars(user)
+    if logged is None or logged['scalars'] != json.dumps(scalars):
+        records.append({'type' : 'user', 'value' : scalars})
+    for key in USER_SERIES:
+        series = user.get(key, [])
+        if logged is not None and logged[key] > len(series):
+            # entries were taken off, which appending can't express
+            records.append({'type' : 'user_set', 'u_id' : u_id, 'key' : key, 'value' : series})
+            continue
+        for index in range(0 if logged is None else logged[key], len(series)):
+            records.append({'type' : 'user_series', 'u_id' : u_id, 'key' : key,
+                'index' : index, 'value' : series[index]})
+    for key in USER_LISTS:
+        value = user.get(key, [])
+        if logged is None or logged[key] != json.dumps(value):
+            records.append({'type' : 'user_set', 'u_id' : u_id, 'key' : key, 'value' : value})
+    return records
+
+def collect_records(data):
+    '''
+    Turns the marks made since the last write into log records and clears them
+
+    Arguments:
+        data (dict) - the database the marks refer to
+
+    Return Value:
+        Returns a list of records, empty if nothing was marked
+    '''
+    records = []
+    marks = _take_marks()
+    logged = _store['logged']
+    logged_users = logged.setdefault('users', {})
+    for u_id in marks['users']:
+        user = _find(data['users'], 'u_id', u_id)
+        if user is not None:
+            records += _user_records(user, logged_users.get(u_id))
+            logged_users[u_id] = _user_state(user)
+    for channel_id in marks['channels']:
+        channel = _find(data['channels'], 'channel_id', channel_id)
+        if channel is not None:
+            records.append({'type' : 'channel', 'value' : _channel_record(channel)})
+    for channel_id, message_id in marks['messages']:
+        channel = _find(data['channels'], 'channel_id', channel_id)
+        message = None if channel is None else \
+            _find(reversed(channel['messages']), 'message_id', message_id)
+        if message is not None:
+            records.append({'type' : 'message', 'channel_id' : channel_id, 'value' : message})
+    for channel_id, message_id in marks['removed_messages']:
+        records.append({'type' : 'remove_message', 'channel_id' : channel_id,
+            'message_id' : message_id})
+    for channel_id in marks['removed_channels']:
+        records.append({'type' : 'remove_channel', 'channel_id' : channel_id})
+
+    for key, value in data.items():
+        if key in ('users', 'channels'):
+            continue
+        state = _root_logged(key, value)
+        if isinstance(state, int) and isinstance(logged.get(key, 0), int) and \
+                logged.get(key, 0) <= state:
+            for index in range(logged.get(key, 0), state):
+                records.append({'type' : 'series', 'key' : key, 'index' : index,
+                    'value' : value[index]})
+        elif logged.get(key) != state:
+            records.append({'type' : 'set', 'key' : key, 'value' : value})
+        logged[key] = state
+    return records
+
+def apply_record(data, record):
+    '''
+    Applies a single log record to data, applying it twice has no further effect
+    '''
+    kind = record['type']
+    if kind == 'user':
+        user = _find(data['users'], 'u_id', record['value']['u_id'])
+        if user is None:
+            data['users'].append(dict(record['value']))
+        else:
+            # the lists come in their own records, logs from before that have them here
+            lists = {key: value for key, value in user.items() \
+                if key in USER_SERIES or key in USER_LISTS}
+            user.clear()
+            user.update(lists)
+            user.update(record['value'])
+    elif kind == 'user_series':
+        user = _find(data['users'], 'u_id', record['u_id'])
+        if user is None:
+            return
+        series = user.setdefault(record['key'], [])
+        if record['index'] < len(series):
+            series[record['index']] = record['value']
+        else:
+            series.append(record['value'])
+    elif kind == 'user_set':
+        user = _find(data['users'], 'u_id', record['u_id'])
+        if user is not None:
+            user[record['key']] = record['value']
+    elif kind == 'channel':
+        channel = _find(data['channels'], 'channel_id', record['value']['channel_id'])
+        if channel is None:
+            data['channels'].append(dict(record['value'], messages=[]))
+        else:
+            channel.update(record['value'])
+    elif kind == 'message':
+        channel = _find(data['channels'], 'channel_id', record['channel_id'])
+        if channel is None:
+            return
+        for i, message in enumerate(channel['messages']):
+            if message['message_id'] == record['value']['message_id']:
+                channel['messages'][i] = record['value']
+                return
+        channel['messages'].append(record['value'])
+    elif kind == 'remove_message':
+        channel = _find(data['channels'], 'channel_id', record['channel_id'])
+        if channel is not None:
+            channel['messages'] = [message for message in channel['messages'] \
+                if message['message_id'] != record['message_id']]
+    elif kind == 'remove_channel':
+        data['channels'] = [channel for channel in data['channels'] \
+            if channel['channel_id'] != record['channel_id']]
+    elif kind == 'series':
+        series = data.setdefault(record['key'], [])
+        if record['index'] < len(series):
+            series[record['index']] = record['value']
+        else:
+            series.append(record['value'])
+    elif kind == 'set':
+        data[record['key']] = record['value']
+
+def replay_log(data, path):
+    '''
+    Applies every record in the log at path to data
+
+    Return Value:
+        Returns the number of records replayed
+    '''
+    count = 0
+    try:
+        with open(path, 'r') as logfile:
+            for line in logfile:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the process died part way through this record
+                    break
+                apply_record(data, record)
+                count += 1
+    except FileNotFoundError:
+        pass
+    return count
+
+def append_log(records):
+    '''
+    Appends records to config.log_file, starting the compactor once the log
+    has grown past config.compact_threshold records
+    '''
+    with _lock:
+        if _store['log'] is None:
+            _store['log'] = open(config.log_file, 'a')
+        _store['log'].write(''.join(json.dumps(record) + '\n' for record in records))
+        _store['log'].flush()
+        _store['log_records'] += len(records)
+        if _store['log_records'] >= config.compact_threshold and _store['compactor'] is None:
+            _store['compactor'] = threading.Thread(target=compact_log, daemon=True)
+            _store['compactor'].start()
+
+def _close_log():
+    if _store['log'] is not None:
+        _store['log'].close()
+        _store['log'] = None
+
+def compact_log():
+    '''
+    Folds the log into a new snapshot. The log is moved aside while holding
+    the store lock, so writers carry on into a fresh log while the snapshot
+    is written out. Must not be called while holding the store lock.
+    '''
+    with _compact_lock:
+        with _lock:
+            _store['compactor'] = None
+            if not _store['dirty'] and not _store['log_records']:
+                return
+            snapshot = json.dumps(_store['data'], indent="")
+            _close_log()
+            compacting = config.log_file + '.compacting'
+            if os.path.exists(config.log_file):
+                if os.path.exists(compacting):
+                    # an earlier compaction never finished, keep its records too
+                    with open(compacting, 'a') as old, open(config.log_file, 'r') as new:
+                        old.write(new.read())
+                    os.remove(config.log_file)
+                else:
+                    os.replace(config.log_file, compacting)
+            _store['dirty'] = False
+            _store['log_records'] = 0
+            _store['last_flush'] = time.time()
+        file_stat = _write_atomic(config.data_file, snapshot)
+        with _lock:
+            _store['file_stat'] = file_stat
+        if os.path.exists(compacting):
+            os.remove(compacting)
+
+atexit.register(flush_data)
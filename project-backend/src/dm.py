@@ -11,10 +11,12 @@ Date:
 from src.error import InputError, AccessError
 from src.auth import get_data, write_data, check_u_id, check_token, generate_handle, check_token
 from src.channels import channels_create, channels_list
-from src.channel import channel_invite, channel_details, channel_messages, get_channel_index
+from src.channel import channel_invite, channel_invite_many, channel_details, channel_messages, channel_messages_changes, get_channel_index
 from src.user import user_profile
 from src.other import notify_user, generate_addedChannel_notification
 from src.helper import find_dm, find_member, is_dm_creator
+from src.data_store import mark_channel, mark_removed_channel
+from src import index, search_index
 
 import jwt
 
@@ -37,12 +39,10 @@ def dm_create(token, u_ids):
     '''
     data = get_data()
 
-    # Append creator's u_id to u_id list to set dm name to include the creator
+    # dm name list is a concatenation of user handles, including the creator's
     creator_index = check_token(token)
-    u_ids.append(data['users'][creator_index]['u_id'])
-
-    # dm name list is a concatenation of user handles
     handle_list = [data['users'][check_u_id(u_id)]['handle_str'] for u_id in u_ids]
+    handle_list.append(data['users'][creator_index]['handle_str'])
     handle_list.sort()
     dm_name = ','.join(handle_list)
 
@@ -50,12 +50,8 @@ def dm_create(token, u_ids):
     # Pass in 4th arg as 'True' for 'is_dm'
     channel = channels_create(token, dm_name, False, True)
 
-    # Need to add the rest of u_ids to all members.
-    # First remove owner's u_id from u_ids
-    u_ids.remove(data['users'][creator_index]['u_id'])
-    for user in u_ids:
-        # Re-use channel_invite to append all member details
-        channel_invite(token, channel['channel_id'], user)
+    # Add the rest of u_ids to all members in one go
+    channel_invite_many(token, channel['channel_id'], list(u_ids))
     
     return {
         'dm_id': channel['channel_id'],
@@ -119,8 +115,11 @@ def dm_invite(token, dm_id, u_id):
     '''
     channel_invite(token, dm_id, u_id)
 
-def dm_messages(token, dm_id, start):
-    return channel_messages(token, dm_id, start)
+def dm_messages(token, dm_id, start=None, **kw):
+    return channel_messages(token, dm_id, start, **kw)
+
+def dm_messages_changes(token, dm_id, since):
+    return channel_messages_changes(token, dm_id, since)
 
 
 def dm_leave(token, dm_id):
@@ -150,6 +149,8 @@ def dm_leave(token, dm_id):
 
     dm['all_members'].remove({'u_id': data['users'][user_index]['u_id']})
     
+    index.update_channel(dm_id)
+    mark_channel(dm_id)
     write_data(data)
     return {}
 
@@ -181,6 +182,10 @@ def dm_remove(token, dm_id):
         raise AccessError(description='The user is not the original DM creator!')
 
     data['channels'].remove(dm)
+    for message in dm['messages']:
+        search_index.remove_message(message['message_id'])
 
+    index.remove_channel(dm_id)
+    mark_removed_channel(dm_id)
     write_data(data)
     return {}
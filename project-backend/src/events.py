@@ -0,0 +1,100 @@
+'''
+Wakes up clients waiting for something to happen in their channels, dms or
+notifications.
+
+Every change to a message and every notification is published here as a
+small event addressed to the users it concerns. Events are numbered from
+one counter and kept in a buffer of the latest config.event_buffer_limit,
+which /events/v1 long-polls: a client passes the id of the last event it
+has seen and is answered as soon as there is a newer one for it. Waiting
+clients all sleep on one condition that every publish notifies, so none
+of them poll.
+
+Events are not saved. A reload or clear empties the buffer, clients that
+were behind then are told to reset and fetch what they show again.
+'''
+
+import collections
+import threading
+import time
+
+from src import config
+from src.data_store import get_store
+
+_published = threading.Condition()
+
+_events = {
+    'data' : None,
+    'event_id' : 0,
+    # (event_id, u_ids it is for, event) of the latest events, oldest first
+    'buffer' : collections.deque(),
+    # clients that saw an event before this one may have missed some
+    'floor' : 0,
+}
+
+def _sync():
+    # events about another database mean nothing to the users of this one
+    data = get_store()
+    if _events['data'] is not data:
+        _events['data'] = data
+        _events['buffer'].clear()
+        _events['floor'] = _events['event_id']
+
+def publish(u_ids, event):
+    '''
+    Hands an event to the users it concerns and wakes up everyone waiting
+
+    Arguments:
+        u_ids (iterable) - the users that should receive the event
+        event (dict) - what happened, must be json serializable
+
+    Return Value:
+        Returns the id of the event
+    '''
+    with _published:
+        _sync()
+        _events['event_id'] += 1
+        event_id = _events['event_id']
+        _events['buffer'].append((event_id, frozenset(u_ids), dict(event, event_id=event_id)))
+        if len(_events['buffer']) > config.event_buffer_limit:
+            _events['floor'] = _events['buffer'].popleft()[0]
+        _published.notify_all()
+    return event_id
+
+def _events_for(u_id, since):
+    found = []
+    for event_id, u_ids, event in reversed(_events['buffer']):
+        if event_id <= since:
+            break
+        if u_id in u_ids:
+            found.append(event)
+    return found[::-1]
+
+def wait_for_events(u_id, since, timeout):
+    '''
+    Waits until there are events for a user newer than since
+
+    Arguments:
+        u_id (int) - the user waiting
+        since (int) - id of the last event the user has seen, None to wait for new ones
+        timeout (float) - most seconds to wait
+
+    Return Value:
+        Returns a dictionary of the events oldest first (empty if the time ran out),
+        the event_id to wait from next time and whether events since then may have
+        been missed
+    '''
+    end = time.time() + timeout
+    with _published:
+        _sync()
+        reset = since is not None and not _events['floor'] <= since <= _events['event_id']
+        if since is None or reset:
+            since = _events['event_id']
+        while True:
+            _sync()
+            events = _events_for(u_id, since)
+            remaining = end - time.time()
+            if events or remaining <= 0:
+                break
+            _published.wait(remaining)
+        return {'events' : events, 'event_id' : _events['event_id'], 'reset' : reset}
@@ -2,8 +2,14 @@ from src.auth import get_data
 from src.error import InputError, AccessError
 from src.auth import get_data, write_data, check_token, check_u_id
 
+from src import config, events, index
+from src.data_store import next_id
+
+import json
 import jwt
+import os
 import re
+import threading
 
 # --------------------------------------------------------------------------------------- #
 # ----------------------------- Channel Helpers  ---------------------------------------- #
@@ -19,11 +25,10 @@ def check_channel_id(channel_id):
     Return value:
         i (int): index of channel 
     '''
-    data = get_data()
-    for i, channel in enumerate(data['channels']):
-        if channel['channel_id'] == channel_id:
-            return i
-    raise InputError(description='Channel ID not valid')
+    channel_index = index.find_channel(channel_id)
+    if channel_index is None:
+        raise InputError(description='Channel ID not valid')
+    return channel_index
 
 def user_is_member(user_id, channel):
     """
@@ -38,22 +43,14 @@ def user_is_member(user_id, channel):
 # --------------------------------------------------------------------------------------- #
 # ----------------------------- Channels Helpers  --------------------------------------- #
 # --------------------------------------------------------------------------------------- #
-def channel_id_generate(all_channels):
+def channel_id_generate():
     """
     Generates a channel id for a given channel.
 
-    Arguments:
-        all_channels (list): Contains a list of existing channels.
-
     Return Value:
         Available channel_id (int).
     """
-    channel_id = 1
-    for channel in all_channels:
-        if channel['channel_id'] == channel_id:
-            # Keep incrementing channel_id by 1 until we get a new channel_id
-            channel_id += 1
-    return channel_id
+    return next_id('channel_id')
 
 def create_channel_details(channel_id, name, token, u_id, is_public, is_dm):
     """
@@ -100,10 +97,10 @@ def create_channel_details(channel_id, name, token, u_id, is_public, is_dm):
 # ----------------------------- Dm Helpers ---------------------------------------------- #
 # --------------------------------------------------------------------------------------- #
 def find_dm(dm_id, data):
-    for channel in data['channels']:
-        if channel['channel_id'] == dm_id:
-            return channel
-    return None
+    dm_index = index.find_channel(dm_id)
+    if dm_index is None:
+        return None
+    return data['channels'][dm_index]
 
 def find_member(dm, u_id):
     for member in dm['all_members']:
@@ -120,16 +117,22 @@ def is_dm_creator(dm, u_id):
 # --------------------------------------------------------------------------------------- #
 # ----------------------------- Message Helpers  ---------------------------------------- #
 # --------------------------------------------------------------------------------------- #
+def message_changed(channel_id, message_id):
+    '''
+    Records a change to a message for channel/messages/changes and tells the
+    members of its channel about it
+    '''
+    change_seq = index.record_change(channel_id, message_id)
+    events.publish(index.channel_members(channel_id), {
+        'type' : 'message',
+        'channel_id' : channel_id,
+        'message_id' : message_id,
+        'change_seq' : change_seq,
+    })
+
 # Creates a new unique id for message.
 def message_id_generate():
-    data = get_data()
-    message_id = 1
-    # Search across all channels and all messages.
-    for channels in data['channels']:
-        for message in channels['messages']:
-            if message['message_id'] == message_id:
-                message_id += 1
-    return message_id
+    return next_id('message_id')
 
 def message_too_long(message):
     if len(message) > 1000:
@@ -140,13 +143,12 @@ def search_message_id(message_id):
     Given a message_id, search the channel database to return channel_id & the index of the message.
     '''
     data = get_data()
-    for channel in data['channels']:
-        for msg_index, message in enumerate(channel['messages']):
-            if message['message_id'] == message_id:
-                return (channel['channel_id'], msg_index)
-    
-    # Message not found.
-    raise InputError(description="Message_id is not valid!")
+    found = index.find_message(message_id)
+    if found is None:
+        # Message not found.
+        raise InputError(description="Message_id is not valid!")
+    channel_index, msg_index = found
+    return (data['channels'][channel_index]['channel_id'], msg_index)
 
 def owner_check(owner_members, u_id):
     for member in owner_members:
@@ -156,11 +158,11 @@ def owner_check(owner_members, u_id):
     
 def message_id_exists(message_id):
     data = get_data()
-    for channel in data['channels']:
-        for message in channel['messages']:
-            if message['message_id'] == message_id:
-                return (message, channel)
-    return (None, None)
+    found = index.find_message(message_id)
+    if found is None:
+        return (None, None)
+    channel = data['channels'][found[0]]
+    return (channel['messages'][found[1]], channel)
 
 def message_is_sender(u_id, message):
     if u_id == message['u_id']:
@@ -214,3 +216,126 @@ def get_user_dictionary_for_user_profile(user):
 
 
 
+
+# --------------------------------------------------------------------------------------- #
+# ----------------------------- Notification Helpers  ----------------------------------- #
+# --------------------------------------------------------------------------------------- #
+# A user's notifications are a ring of at most config.notification_limit, oldest first
+# from user['notifications_head']. Older ones are appended to config.notification_archive.
+_archive_lock = threading.Lock()
+
+def _notification_ring(user):
+    # a list saved before notifications were kept in a ring is newest first
+    if 'notifications_head' not in user:
+        return user['notifications'][::-1], 0
+    return user['notifications'], user['notifications_head']
+
+def push_notification(user, notification):
+    '''
+    Adds a notification to a user in constant time, overwriting the oldest one
+    once config.notification_limit are kept
+
+    Arguments:
+        user (dict): the user being notified
+        notification (dict): the notification to add
+    '''
+    ring, head = _notification_ring(user)
+    limit = config.notification_limit
+    if len(ring) > limit or (head and len(ring) < limit) or 'notifications_head' not in user:
+        # the limit changed since the ring filled up, or it is still an old list
+        ordered = ring[head:] + ring[:head]
+        excess = max(0, len(ordered) - limit)
+        _archive(user, ordered[:excess])
+        ring, head = ordered[excess:], 0
+        user['notifications'] = ring
+    if len(ring) < limit:
+        ring.append(notification)
+    else:
+        _archive(user, [ring[head]])
+        ring[head] = notification
+        head = (head + 1) % limit
+    user['notifications_head'] = head
+
+def _archive(user, notifications):
+    if archive_notifications(user['u_id'], notifications) and 'notifications_archived' in user:
+        user['notifications_archived'] += len(notifications)
+
+def _has_archived(user, skip):
+    '''
+    Returns whether the archive may hold any of a user's notifications past the
+    first skip of them
+    '''
+    if 'notifications_archived' not in user:
+        # users from before the count was kept can only have archived once their ring filled
+        ring, _ = _notification_ring(user)
+        return len(ring) >= config.notification_limit
+    return user['notifications_archived'] > skip
+
+def newest_notifications(user, start, count):
+    '''
+    Returns a user's notifications newest first, reading the archive only for
+    notifications older than the ones kept and only if the user has any there
+
+    Arguments:
+        user (dict): the user whose notifications are read
+        start (int): number of newer notifications to skip
+        count (int): most notifications to return
+
+    Return value:
+        notifications (list): the notifications from start
+    '''
+    ring, head = _notification_ring(user)
+    newest = [ring[(head - 1 - i) % len(ring)] for i in range(start, min(start + count, len(ring)))]
+    skip = max(0, start - len(ring))
+    if len(newest) < count and _has_archived(user, skip):
+        archived = archived_notifications(user['u_id'])
+        newest += archived[::-1][skip:skip + count - len(newest)]
+    return newest
+
+def archive_notifications(u_id, notifications):
+    '''
+    Appends notifications that no longer fit in a user's ring to the archive, oldest
+    first, they are dropped if config.notification_archive is None. Returns whether
+    they were archived
+    '''
+    if not notifications or config.notification_archive is None:
+        return False
+    with _archive_lock:
+        with open(config.notification_archive, 'a') as archive:
+            for notification in notifications:
+                archive.write(json.dumps({'u_id': u_id, 'notification': notification}) + '\n')
+    return True
+
+def archived_notifications(u_id):
+    '''
+    Returns the archived notifications of a user, oldest first
+    '''
+    if config.notification_archive is None:
+        return []
+    notifications = []
+    with _archive_lock:
+        try:
+            with open(config.notification_archive, 'r') as archive:
+                for line in archive:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the process died part way through this line
+                        break
+                    if entry['u_id'] == u_id:
+                        notifications.append(entry['notification'])
+        except FileNotFoundError:
+            pass
+    return notifications
+
+def drop_notification_archive():
+    '''
+    Deletes the archive along with the database it belonged to
+    '''
+    if config.notification_archive is None:
+        return
+    with _archive_lock:
+        try:
+            os.remove(config.notification_archive)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,179 @@
+'''
+Fetches and crops uploaded profile pictures in the background.
+
+user/profile/uploadphoto hands the image here and returns straight away.
+A pool of config.image_fetch_workers threads downloads each image once,
+streaming it to a part file in config.image_dir, and the decode, crop and
+re-encode runs in a pool of config.image_crop_workers processes so it
+doesn't hold up the server (0 crops in the fetching thread instead). Once
+the crop is saved the user's profile_img_url is pointed at it.
+
+Images are named after the persisted 'image_id' sequence, so names are
+never reused, even after a restart. When a user uploads again before an
+earlier upload finished only the latest one is applied, and uploads for a
+database that has since been reloaded or cleared are dropped.
+
+Problems found after the request returned (the url can't be fetched, it
+isn't an image, the crop doesn't fit) leave the picture as it was. They are
+logged, and raised as an InputError from wait.
+'''
+
+import concurrent.futures
+import functools
+import logging
+import multiprocessing
+import os
+import shutil
+import threading
+import urllib.error
+import urllib.request
+
+from PIL import Image
+
+from src import config, index
+from src.data_store import get_store, set_store, mark_user, next_id
+from src.error import InputError
+
+_lock = threading.Lock()
+
+_pipeline = {
+    'fetchers' : None,
+    'croppers' : None,
+    # u_id -> (image_id, future) of the user's latest upload
+    'uploads' : {},
+}
+
+def start():
+    '''
+    Creates the worker pools if they don't exist yet. The crop processes are
+    spawned rather than forked, a fork of the threaded server could inherit
+    locks held by other threads
+    '''
+    with _lock:
+        if _pipeline['fetchers'] is None:
+            _pipeline['fetchers'] = concurrent.futures.ThreadPoolExecutor(
+                config.image_fetch_workers, thread_name_prefix='image-fetch')
+        if _pipeline['croppers'] is None and config.image_crop_workers:
+            _pipeline['croppers'] = concurrent.futures.ProcessPoolExecutor(
+                config.image_crop_workers, mp_context=multiprocessing.get_context('spawn'))
+
+def image_path(u_id, image_id):
+    '''
+    Returns where an uploaded image is saved, relative to config.image_dir
+    '''
+    return f"image{u_id}-{image_id}.jpg"
+
+def crop_image(source, destination, box):
+    '''
+    Crops an image file and saves it as a jpg, runs in a worker process
+
+    Arguments:
+        source (string) - path of the downloaded image
+        destination (string) - path to save the crop to
+        box (tuple) - (x_start, y_start, x_end, y_end) of the crop
+
+    Return Value:
+        Returns the size of the image, None if the box isn't within it
+    '''
+    with Image.open(source) as image:
+        width, height = image.size
+        x_start, y_start, x_end, y_end = box
+        if x_end > width or y_end > height:
+            return None
+        image.crop(box).convert('RGB').save(destination, 'JPEG')
+        return width, height
+
+def _fetch(img_url, destination):
+    # one request, read in chunks straight to disk
+    try:
+        with urllib.request.urlopen(img_url, timeout=config.image_fetch_timeout) as response:
+            if response.getcode() != 200:
+                raise InputError(description='img_url returns an HTTP status other than 200')
+            with open(destination, 'wb') as image_file:
+                shutil.copyfileobj(response, image_file, config.image_chunk_size)
+    except (urllib.error.URLError, ValueError, OSError) as error:
+        raise InputError(description='img_url returns an HTTP status other than 200') from error
+
+def _process(data, u_id, image_id, img_url, box):
+    name = image_path(u_id, image_id)
+    destination = os.path.join(config.image_dir, name)
+    part = destination + '.part'
+    try:
+        _fetch(img_url, part)
+        croppers = _pipeline['croppers']
+        try:
+            if croppers is None:
+                size = crop_image(part, destination, box)
+            else:
+                size = croppers.submit(crop_image, part, destination, box).result()
+        except (OSError, ValueError) as error:
+            raise InputError(description='img_url is not a JPG image') from error
+        if size is None:
+            raise InputError(description='any of x_start, y_start, x_end, y_end are not ' \
+                'within the dimension of the image at the URL')
+    finally:
+        if os.path.exists(part):
+            os.remove(part)
+    profile_img_url = f"{config.url}/static/{name}"
+    _apply(data, u_id, image_id, profile_img_url)
+    return profile_img_url
+
+def _apply(data, u_id, image_id, profile_img_url):
+    # a later upload or a reload since this one started wins
+    with _lock:
+        latest = _pipeline['uploads'].get(u_id, (None,))[0]
+    if latest != image_id or get_store() is not data:
+        return
+    position = index.find_user('u_id', u_id)
+    if position is None:
+        return
+    data['users'][position]['profile_img_url'] = profile_img_url
+    mark_user(u_id)
+    set_store(data)
+
+def upload(u_id, img_url, box):
+    '''
+    Queues an image to be fetched, cropped and made a user's profile picture
+
+    Arguments:
+        u_id (int) - the user uploading
+        img_url (string) - where to fetch the image from
+        box (tuple) - (x_start, y_start, x_end, y_end) of the crop
+
+    Return Value:
+        Returns the id of the image
+    '''
+    start()
+    data = get_store()
+    image_id = next_id('image_id')
+    with _lock:
+        future = _pipeline['fetchers'].submit(_process, data, u_id, image_id, img_url, tuple(box))
+        _pipeline['uploads'][u_id] = (image_id, future)
+    future.add_done_callback(functools.partial(_report, u_id, image_id, img_url))
+    return image_id
+
+def _report(u_id, image_id, img_url, future):
+    # nobody waits for the upload outside of tests, so say why it didn't happen
+    if not future.cancelled() and future.exception() is not None:
+        logging.getLogger(__name__).warning('image %s for user %s from %s was dropped',
+            image_id, u_id, img_url, exc_info=future.exception())
+
+def wait(u_id, timeout=None):
+    '''
+    Waits for a user's latest upload to finish
+
+    Arguments:
+        u_id (int) - the user that uploaded
+        timeout (float) - most seconds to wait, None waits until it's done
+
+    Exceptions:
+        InputError - Occurs when the image couldn't be fetched or cropped
+
+    Return Value:
+        Returns the new profile_img_url, None if the user hasn't uploaded anything
+    '''
+    with _lock:
+        upload_info = _pipeline['uploads'].get(u_id)
+    if upload_info is None:
+        return None
+    return upload_info[1].result(timeout)
@@ -0,0 +1,455 @@
+'''
+Hash indexes over the resident database.
+
+Each index belongs to one data dictionary and is rebuilt from scratch the
+first time it is used after the store hands out a different one (a reload
+or a clear). In between, the functions that change an indexed field tell
+the index with the update_* and remove_* functions below.
+
+The change log at the end is not built from the data: it only knows about
+changes made since it was last reset, and says so to anyone asking from
+further back.
+'''
+
+import collections
+import threading
+
+from src import config
+from src.data_store import get_store, next_id
+
+_lock = threading.RLock()
+
+def _lookup(mapping, key, default=None):
+    try:
+        return mapping.get(key, default)
+    except TypeError:
+        # a key that can't be hashed (a malformed request) can't match anything either
+        return default
+
+# --------------------------------------------------------------------------------------- #
+# ----------------------------- User Index ---------------------------------------------- #
+# --------------------------------------------------------------------------------------- #
+USER_KEYS = ('u_id', 'email', 'handle_str', 'reset_code')
+
+_users = {
+    'data' : None,
+    # position in data['users'] -> the values it is currently indexed under
+    'indexed' : [],
+    'u_id' : {},
+    'email' : {},
+    'handle_str' : {},
+    'reset_code' : {},
+    # position in data['users'] -> ids of the sessions the user is logged in with
+    'sessions' : [],
+}
+
+def _user_entries(user):
+    # an empty reset code means the user hasn't asked for one
+    return {key: user[key] for key in USER_KEYS if user.get(key) not in (None, '')}
+
+def _index_user(data, position):
+    entries = _user_entries(data['users'][position])
+    for key, value in entries.items():
+        _users[key][value] = position
+    sessions = {session['session_id'] for session in data['users'][position]['sessions_list']}
+    if position < len(_users['indexed']):
+        _users['indexed'][position] = entries
+        _users['sessions'][position] = sessions
+    else:
+        _users['indexed'].append(entries)
+        _users['sessions'].append(sessions)
+
+def _user_index():
+    '''
+    Returns the data the user index is for, building it if it belongs to
+    another dictionary and indexing users appended since the last call
+    '''
+    data = get_store()
+    with _lock:
+        if _users['data'] is not data:
+            _users['data'] = data
+            _users['indexed'] = []
+            _users['sessions'] = []
+            for key in USER_KEYS:
+                _users[key] = {}
+        for position in range(len(_users['indexed']), len(data['users'])):
+            _index_user(data, position)
+    return data
+
+def find_user(key, value):
+    '''
+    Looks up a user by one of USER_KEYS
+
+    Arguments:
+        key (string) - 'u_id', 'email', 'handle_str' or 'reset_code' (hashed)
+        value - the value to look for
+
+    Return Value:
+        Returns the index of the user in data['users'], None if there isn't one
+    '''
+    data = _user_index()
+    position = _lookup(_users[key], value)
+    if position is None or data['users'][position].get(key) != value:
+        return None
+    return position
+
+def has_session(position, session_id):
+    '''
+    Returns whether the user at position in data['users'] is logged in with a session
+    '''
+    _user_index()
+    return session_id in _users['sessions'][position]
+
+def update_user(position):
+    '''
+    Re-indexes the user at position in data['users'] after an indexed field
+    or their sessions have changed
+    '''
+    data = _user_index()
+    with _lock:
+        for key, value in _users['indexed'][position].items():
+            if _users[key].get(value) == position:
+                del _users[key][value]
+        _index_user(data, position)
+
+# --------------------------------------------------------------------------------------- #
+# ----------------------------- Channel Index ------------------------------------------- #
+# --------------------------------------------------------------------------------------- #
+_channels = {
+    'data' : None,
+    # channel_id of each position in data['channels'] that has been indexed
+    'ids' : [],
+    'position' : {},
+    'members' : {},
+    'owners' : {},
+    # u_id -> ids of the channels and dms they are a member of
+    'joined' : {},
+    'dms' : set(),
+    # u_ids whose memberships changed since take_stale_members, None for everyone
+    'stale' : None,
+}
+
+def _index_channel(channel, track=True):
+    channel_id = channel['channel_id']
+    old_members = _channels['members'].get(channel_id, set())
+    for u_id in old_members:
+        _channels['joined'][u_id].discard(channel_id)
+    members = {member['u_id'] for member in channel['all_members']}
+    for u_id in members:
+        _channels['joined'].setdefault(u_id, set()).add(channel_id)
+    _channels['members'][channel_id] = members
+    _channels['owners'][channel_id] = {owner['u_id'] for owner in channel['owner_members']}
+    if channel['is_dm']:
+        _channels['dms'].add(channel_id)
+    if track and _channels['stale'] is not None:
+        _channels['stale'] |= old_members ^ members
+
+def _rebuild_channels(data):
+    if _channels['data'] is not data and _channels['ids'] is not None:
+        # a different database, nothing is known about what changed in it
+        _channels['stale'] = None
+    _channels['data'] = data
+    _channels['ids'] = []
+    _channels['dms'] = set()
+    for key in ('position', 'members', 'owners', 'joined'):
+        _channels[key] = {}
+
+def _channel_index():
+    '''
+    Returns the data the channel index is for, building it if it belongs to
+    another dictionary or channels were removed behind its back, and
+    indexing channels appended since the last call
+    '''
+    data = get_store()
+    with _lock:
+        rebuilt = _channels['data'] is not data or _channels['ids'] is None or \
+            len(_channels['ids']) > len(data['channels'])
+        if rebuilt:
+            _rebuild_channels(data)
+        for position in range(len(_channels['ids']), len(data['channels'])):
+            channel = data['channels'][position]
+            _channels['ids'].append(channel['channel_id'])
+            _channels['position'][channel['channel_id']] = position
+            _index_channel(channel, track=not rebuilt)
+    return data
+
+def find_channel(channel_id):
+    '''
+    Looks up a channel or dm by its id
+
+    Return Value:
+        Returns the index of the channel in data['channels'], None if there isn't one
+    '''
+    data = _channel_index()
+    position = _lookup(_channels['position'], channel_id)
+    if position is not None and data['channels'][position]['channel_id'] != channel_id:
+        # the list was reordered without telling the index
+        with _lock:
+            _channels['data'] = None
+        return find_channel(channel_id)
+    return position
+
+def channel_members(channel_id):
+    '''
+    Returns the set of u_ids in the channel's all_members, empty if there is no such channel
+    '''
+    _channel_index()
+    return _lookup(_channels['members'], channel_id, set())
+
+def channel_owners(channel_id):
+    '''
+    Returns the set of u_ids in the channel's owner_members, empty if there is no such channel
+    '''
+    _channel_index()
+    return _lookup(_channels['owners'], channel_id, set())
+
+def user_channels(u_id):
+    '''
+    Returns the set of ids of every channel and dm the user is a member of
+    '''
+    _channel_index()
+    return _lookup(_channels['joined'], u_id, set())
+
+def joined_counts(u_id):
+    '''
+    Returns a tuple of how many channels and how many dms the user is a member of
+    '''
+    joined = user_channels(u_id)
+    num_dms = len(joined & _channels['dms'])
+    return (len(joined) - num_dms, num_dms)
+
+def channel_counts():
+    '''
+    Returns a tuple of how many channels and how many dms there are
+    '''
+    _channel_index()
+    return (len(_channels['ids']) - len(_channels['dms']), len(_channels['dms']))
+
+def take_stale_members():
+    '''
+    Returns the u_ids of the users whose memberships changed since the last
+    call, or None if that isn't known and every user has to be checked
+    '''
+    _channel_index()
+    with _lock:
+        stale = _channels['stale']
+        _channels['stale'] = set()
+    return stale
+
+def is_member(u_id, channel_id):
+    return u_id in channel_members(channel_id)
+
+def is_owner(u_id, channel_id):
+    return u_id in channel_owners(channel_id)
+
+def update_channel(channel_id):
+    '''
+    Re-indexes the members and owners of a channel after they have changed
+    '''
+    data = _channel_index()
+    position = find_channel(channel_id)
+    if position is not None:
+        with _lock:
+            _index_channel(data['channels'][position])
+
+def remove_channel(channel_id):
+    '''
+    Drops a channel that has been taken out of data['channels']. Positions
+    after it have moved, so the index is rebuilt on next use.
+    '''
+    with _lock:
+        if _channels['stale'] is not None:
+            _channels['stale'] |= _channels['members'].get(channel_id, set())
+        _channels['ids'] = None
+        for message_id in _messages['by_channel'].pop(channel_id, ()):
+            _unindex_message(message_id)
+        _messages['total'] -= _messages['lengths'].pop(channel_id, 0)
+
+# --------------------------------------------------------------------------------------- #
+# ----------------------------- Message Index ------------------------------------------- #
+# --------------------------------------------------------------------------------------- #
+_messages = {
+    'data' : None,
+    # message_id -> (channel_id, position in that channel's messages)
+    'location' : {},
+    # channel_id -> ids of the messages indexed in it
+    'by_channel' : {},
+    # u_id -> ids of the messages they sent, and message_id -> its sender
+    'by_sender' : {},
+    'sender' : {},
+    # channel_id -> number of messages in it, and the sum of them all
+    'lengths' : {},
+    'total' : 0,
+}
+
+def _index_message(channel_id, position, message):
+    # the first message found with an id keeps it, as a scan would have
+    message_id = message['message_id']
+    if message_id not in _messages['location']:
+        _messages['location'][message_id] = (channel_id, position)
+        _messages['by_channel'].setdefault(channel_id, set()).add(message_id)
+        _messages['sender'][message_id] = message['u_id']
+        _messages['by_sender'].setdefault(message['u_id'], set()).add(message_id)
+
+def _unindex_message(message_id):
+    del _messages['location'][message_id]
+    _messages['by_sender'][_messages['sender'].pop(message_id)].discard(message_id)
+
+def _index_channel_messages(channel):
+    channel_id = channel['channel_id']
+    for message_id in _messages['by_channel'].pop(channel_id, ()):
+        _unindex_message(message_id)
+    for position, message in enumerate(channel['messages']):
+        _index_message(channel_id, position, message)
+    _messages['total'] += len(channel['messages']) - _messages['lengths'].get(channel_id, 0)
+    _messages['lengths'][channel_id] = len(channel['messages'])
+
+def _message_index():
+    '''
+    Returns the data the message index is for, building it if it belongs to
+    another dictionary
+    '''
+    data = get_store()
+    with _lock:
+        if _messages['data'] is not data:
+            _messages['data'] = data
+            _messages['location'] = {}
+            _messages['by_channel'] = {}
+            _messages['by_sender'] = {}
+            _messages['sender'] = {}
+            _messages['lengths'] = {}
+            _messages['total'] = 0
+            for channel in data['channels']:
+                _index_channel_messages(channel)
+    return data
+
+def find_message(message_id):
+    '''
+    Looks up a message in any channel or dm by its id
+
+    Return Value:
+        Returns a tuple of the index of the channel in data['channels'] and the
+        index of the message in its messages, None if there isn't one
+    '''
+    data = _message_index()
+    found = _locate(data, message_id)
+    if found is None and _lookup(_messages['location'], message_id) is not None:
+        # the messages were changed without telling the index
+        with _lock:
+            _messages['data'] = None
+        found = _locate(_message_index(), message_id)
+    return found
+
+def _locate(data, message_id):
+    location = _lookup(_messages['location'], message_id)
+    if location is None:
+        return None
+    channel_index = find_channel(location[0])
+    if channel_index is None:
+        return None
+    messages = data['channels'][channel_index]['messages']
+    if location[1] >= len(messages) or messages[location[1]]['message_id'] != message_id:
+        return None
+    return (channel_index, location[1])
+
+def add_message(channel_id, position):
+    '''
+    Indexes a message that has just been appended to a channel at position
+    '''
+    data = _message_index()
+    channel = data['channels'][find_channel(channel_id)]
+    with _lock:
+        _index_message(channel_id, position, channel['messages'][position])
+        # a build that just ran has counted it already
+        length = max(_messages['lengths'].get(channel_id, 0), position + 1)
+        _messages['total'] += length - _messages['lengths'].get(channel_id, 0)
+        _messages['lengths'][channel_id] = length
+
+def user_messages(u_id):
+    '''
+    Returns the set of ids of the messages a user has sent that are still in a
+    channel or dm, it must not be changed
+    '''
+    _message_index()
+    return _lookup(_messages['by_sender'], u_id, set())
+
+def message_count():
+    '''
+    Returns the number of messages in every channel and dm together
+    '''
+    _message_index()
+    return _messages['total']
+
+def update_messages(channel_id):
+    '''
+    Re-indexes every message in a channel after one has been removed from it
+    '''
+    data = _message_index()
+    channel_index = find_channel(channel_id)
+    if channel_index is not None:
+        with _lock:
+            _index_channel_messages(data['channels'][channel_index])
+
+# --------------------------------------------------------------------------------------- #
+# ----------------------------- Change Log ---------------------------------------------- #
+# --------------------------------------------------------------------------------------- #
+_changes = {
+    'data' : None,
+    # channel_id -> (change_seq, message_id) of its latest changes, oldest first
+    'log' : {},
+    # channel_id -> the change_seq from which its log is complete
+    'floor' : {},
+    # the change_seq the log was started from
+    'start' : 0,
+}
+
+def _change_log():
+    '''
+    Returns the data the change log is for, starting an empty one if it
+    belongs to another dictionary
+    '''
+    data = get_store()
+    with _lock:
+        if _changes['data'] is not data:
+            _changes['data'] = data
+            _changes['log'] = {}
+            _changes['floor'] = {}
+            _changes['start'] = data.get('sequences', {}).get('change_seq', 0)
+    return data
+
+def record_change(channel_id, message_id):
+    '''
+    Notes that a message in a channel was sent, edited, removed, pinned or
+    reacted to
+
+    Return Value:
+        Returns the change_seq of the change
+    '''
+    _change_log()
+    seq = next_id('change_seq')
+    with _lock:
+        log = _changes['log'].setdefault(channel_id, collections.deque())
+        log.append((seq, message_id))
+        if len(log) > config.change_log_limit:
+            _changes['floor'][channel_id] = log.popleft()[0]
+    return seq
+
+def changes_since(channel_id, since):
+    '''
+    Finds the messages in a channel that changed after a change_seq
+
+    Arguments:
+        channel_id (int) - the channel or dm to look in
+        since (int) - the last change_seq the caller has seen
+
+    Return Value:
+        Returns a tuple of the set of ids of the changed messages, None if the
+        log doesn't reach back that far, and the latest change_seq
+    '''
+    data = _change_log()
+    with _lock:
+        latest = data.get('sequences', {}).get('change_seq', 0)
+        if since < _changes['floor'].get(channel_id, _changes['start']) or since > latest:
+            return (None, latest)
+        return ({message_id for seq, message_id in _changes['log'].get(channel_id, ()) \
+            if seq > since}, latest)
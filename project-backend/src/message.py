@@ -13,28 +13,25 @@ from src.auth import auth_register, check_token, get_data, write_data, check_u_i
 from src.channels import channels_create
 from src.channel import channel_id_valid, member_check, get_channel_index, user_is_owner_token, user_is_member, user_is_owner_uid, check_channel_id, check_is_member, update_user
 from datetime import datetime, timezone
-from src.other import insert_tag_notification
-import threading
-import time
+from src.other import notify_tagged
 from src.helper import message_id_exists, message_id_generate, message_is_sender, message_too_long, \
-search_message_id, owner_check, already_reacted, edit_react
+search_message_id, owner_check, already_reacted, edit_react, message_changed
+from src.data_store import mark_user, mark_message, mark_removed_message
+from src import index, scheduler, search_index
 
 import jwt
 
 SECRET = 'atotallysecuresecret'
-message_id_queue = [] #The reason to have this global variable is for the message_sendlater which requires
-#threading.Timer that can't return the variable from message_send
 
 
 def update_message_stats(func):
     def wrap(*args, **kw):
         resp = func(*args, **kw)
-        msgs_exist = 0
         data = get_data()
-        for channel in data['channels']:
-            msgs_exist += len(channel['messages'])
-        data = update_user('messages_exist', msgs_exist, data)
-        write_data(data)
+        num_changes = len(data['messages_exist'])
+        update_user('messages_exist', index.message_count(), data)
+        if len(data['messages_exist']) != num_changes:
+            write_data(data)
         return resp
     return wrap
 
@@ -58,21 +55,34 @@ def message_send(token, channel_id, message, **kw):
         Dictionary containing 'message_id'.
     ''' 
     user_index = check_token(token)
+    u_id = get_data()['users'][user_index]['u_id']
+    return _deliver(u_id, channel_id, message)
 
+@update_message_stats
+def message_send_as(u_id, channel_id, message):
+    '''
+    Sends a message from a user without a session of theirs, for messages the
+    server sends on a user's behalf such as the summary of a standup they started
+    '''
+    return _deliver(u_id, channel_id, message)
+
+def _deliver(u_id, channel_id, message, message_id=None):
+    '''
+    Appends a message from a user to a channel after checking they can post
+    there, message_id is the id reserved for it or None to hand out a new one
+    '''
     data = get_data()
     if not channel_id_valid(channel_id, data['channels']):
         raise InputError(description="Invalid channel id!")
     
     message_too_long(message)
     
-    # Decode token to get u_id
-    token_structure = jwt.decode(token, SECRET, algorithms=['HS256'])
-    u_id = token_structure['u_id']
     if not member_check(u_id, channel_id, data['channels']):
         raise AccessError(description="User is not a member of the channel!")
 
     # Generate unique id for message
-    message_id = message_id_generate()
+    if message_id is None:
+        message_id = message_id_generate()
 
     # Go to the channel and append the message and message_id
     channel_index = get_channel_index(channel_id)
@@ -90,7 +100,11 @@ def message_send(token, channel_id, message, **kw):
             'is_this_user_reacted': False
         }]
     })
+    index.add_message(channel_id, len(data['channels'][channel_index]['messages']) - 1)
+    search_index.index_message(data['channels'][channel_index]['messages'][-1])
+    message_changed(channel_id, message_id)
 
+    user_index = index.find_user('u_id', u_id)
     user = data['users'][user_index]
     num_messages = user['messages_sent'][-1]['num_messages_sent']
     
@@ -98,11 +112,10 @@ def message_send(token, channel_id, message, **kw):
         'num_messages_sent' : num_messages + 1,
         'time_stamp' : datetime.now().timestamp()
     })
+    mark_message(channel_id, message_id)
+    mark_user(u_id)
     write_data(data)
-    insert_tag_notification(token, channel_id, message)
-    #get the message_id for sendlater
-    global message_id_queue
-    message_id_queue.append(message_id) #For message_sendlater threading.Timer
+    notify_tagged(u_id, channel_id, message)
     return {
         'message_id': message_id,
     }
@@ -143,10 +156,12 @@ def message_remove(token, message_id):
     if user_is_owner_token(token, channel['channel_id']) == False:
         raise AccessError(description="The authorised user is an owner of this channel (if it was sent to a channel) or the **Dreams**!")
 
-    for ch in data['channels']:
-        if ch['channel_id'] == channel['channel_id']:
-            ch['messages'].remove(message)
+    channel['messages'].remove(message)
+    index.update_messages(channel['channel_id'])
+    search_index.remove_message(message_id)
+    message_changed(channel['channel_id'], message_id)
 
+    mark_removed_message(channel['channel_id'], message_id)
     write_data(data)
     return {}
 
@@ -174,9 +189,7 @@ def message_edit(token, message_id, message):
     # InputError - Length of new message is over 1000 characters.
     message_too_long(message)
 
-    check_token(token)
-    token_structure = jwt.decode(token, SECRET, algorithms=['HS256'])
-    auth_user_id = token_structure['u_id']
+    auth_user_id = data['users'][check_token(token)]['u_id']
 
     # InputError - Message_id refers to a deleted message.
     channel_id, msg_index = search_message_id(message_id)
@@ -194,10 +207,15 @@ def message_edit(token, message_id, message):
     # If given empty string
     if len(message) == 0:
         message_remove(token, message_id)
-    
+        return {
+        }
+
     # Otherwise edit the old message.
     data['channels'][channel_index]['messages'][msg_index]['message'] = message
+    search_index.index_message(data['channels'][channel_index]['messages'][msg_index])
+    message_changed(channel_id, message_id)
     
+    mark_message(channel_id, message_id)
     write_data(data)
     return {
     }
@@ -247,10 +265,7 @@ def message_share(token, og_message_id, message, channel_id, dm_id):
     '''
     data = get_data()
 
-    check_token(token)
-
-    token_structure = jwt.decode(token, SECRET, algorithms=['HS256'])
-    u_id = token_structure['u_id']
+    u_id = data['users'][check_token(token)]['u_id']
 
     # First fetch the actual og message from og_msg_id.
     og_channel_id, og_msg_index = search_message_id(og_message_id)
@@ -306,21 +321,34 @@ def message_sendlater(token, channel_id, message, time_sent, **kw):
     data = get_data()
     check_is_member(data['users'][check_token(token)]['u_id'], data['channels'][check_channel_id(channel_id)]['all_members'])
 
-    #send the user after the time_sent
-    # print()
-    time_count = time_sent - timestamp_now
-    # t = threading.Timer(time_count, message_send, [token, channel_id, message])
-    # .start()
-    time.sleep(time_count)
-    message_id = message_send(token, channel_id, message)
-    # message_id = message_id_queue.pop()
+    #reserve the message_id now and send the message as the user once time_sent is up
+    message_id = message_id_generate()
+    scheduler.schedule(time_sent, 'message_send', {
+        'u_id': data['users'][check_token(token)]['u_id'],
+        'channel_id': channel_id,
+        'message': message,
+        'message_id': message_id
+    })
     return {
         'message_id': message_id
     }
 
 def message_sendlaterdm(token, dm_id, message, time_sent, **kw):
-    # print(f'token = {token}, dm_id = {dm_id}, message = {message}')
-    return message_sendlater(token, dm_id, message, time_sent)['message_id']
+    return message_sendlater(token, dm_id, message, time_sent)
+
+@update_message_stats
+def send_scheduled(channel_id, message, message_id, u_id=None, token=None):
+    '''
+    Sends a message scheduled by message_sendlater, unless it was already
+    sent before a restart. Jobs saved before they kept the sender's u_id
+    have the token it was scheduled with instead
+    '''
+    if u_id is None:
+        u_id = jwt.decode(token, SECRET, algorithms=['HS256'])['u_id']
+    if index.find_message(message_id) is None:
+        _deliver(u_id, channel_id, message, message_id)
+
+scheduler.register('message_send', send_scheduled)
 
 def message_pin(token, message_id):
     '''
@@ -357,12 +385,10 @@ def message_pin(token, message_id):
     if user_is_owner_uid(data['users'][user_index]['u_id'], channel['channel_id']) == False:
         raise AccessError
 
-    for ch in data['channels']:
-        if ch['channel_id'] == channel['channel_id']:
-            for msg in ch['messages']:
-                if msg['message_id'] == message['message_id']:
-                    msg['is_pinned'] = True
+    message['is_pinned'] = True
+    message_changed(channel['channel_id'], message_id)
 
+    mark_message(channel['channel_id'], message_id)
     write_data(data)
     return {}
 
@@ -400,12 +426,10 @@ def message_unpin(token, message_id):
     if user_is_owner_uid(data['users'][user_index]['u_id'], channel['channel_id']) == False:
         raise AccessError
 
-    for ch in data['channels']:
-        if ch['channel_id'] == channel['channel_id']:
-            for msg in ch['messages']:
-                if msg['message_id'] == message['message_id']:
-                    msg['is_pinned'] = False
+    message['is_pinned'] = False
+    message_changed(channel['channel_id'], message_id)
 
+    mark_message(channel['channel_id'], message_id)
     write_data(data)
     return {}
 
@@ -449,12 +473,10 @@ def message_react(token, message_id, react_id):
     if user_is_member(data['users'][user_index]['u_id'], channel) == False:
         raise AccessError
 
-    for ch in data['channels']:
-        if ch['channel_id'] == channel['channel_id']:
-            for msg in ch['messages']:
-                if msg['message_id'] == message['message_id']:
-                    edit_react(msg, react_id, data['users'][user_index]['u_id'], 'append')
+    edit_react(message, react_id, data['users'][user_index]['u_id'], 'append')
+    message_changed(channel['channel_id'], message_id)
 
+    mark_message(channel['channel_id'], message_id)
     write_data(data)
     return {}
 
@@ -498,12 +520,10 @@ def message_unreact(token, message_id, react_id):
     if user_is_member(data['users'][user_index]['u_id'], channel) == False:
         raise AccessError
 
-    for ch in data['channels']:
-        if ch['channel_id'] == channel['channel_id']:
-            for msg in ch['messages']:
-                if msg['message_id'] == message['message_id']:
-                    edit_react(msg, react_id, data['users'][user_index]['u_id'], 'remove')
+    edit_react(message, react_id, data['users'][user_index]['u_id'], 'remove')
+    message_changed(channel['channel_id'], message_id)
 
+    mark_message(channel['channel_id'], message_id)
     write_data(data)
     return {}
 
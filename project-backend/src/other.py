@@ -8,11 +8,13 @@ Date:
 
 from src.error import InputError, AccessError
 from src.auth import check_token, get_data, check_u_id, write_data
-from src.channel import check_is_member, notify_user
+from src.channel import check_is_member, notify_user, notify_users
 from flask import Flask
-from json import dumps, dump
-from src import config
-from src.auth import get_data, write_data, check_u_id, check_token
+from json import dumps
+from src import config, events, index, search_index
+from src.data_store import reset_data, mark_user, mark_message
+from src.helper import newest_notifications, drop_notification_archive, message_changed
+from src.auth import get_data, write_data, check_u_id, check_token, forget_tokens
 import re
 import datetime
 OWNER = 1
@@ -31,159 +33,163 @@ def clear():
     Return Values:
         None
     '''
-    ts = datetime.datetime.now().timestamp()
-    with open("data.json", "w+") as f:
-        data = {
-            "users" : [],
-            "channels" : [],
-            'channels_exist' : [{'num_channels_exist' : 0, 'time_stamp' : ts}],
-            'dms_exist' : [{'num_dms_exist' : 0, 'time_stamp' : ts}],
-            'messages_exist' : [{'num_messages_exist' : 0, 'time_stamp' : ts }]
-        }
-        dump(data, f)
-        return dumps({})
-
-
-def notifications_get(token):
+    reset_data()
+    drop_notification_archive()
+    return dumps({})
+
+
+def notifications_get(token, start=0):
     '''
     This function get the first 20 notifications for a user
 
     Arguments:
         token(string) - The user's token
+        start(int) - how many newer notifications to skip, to page through older ones
 
     Returns:
-        notifications(list of dictioanry) - user's top 20 notifications
+        notifications(list of dictioanry) - user's top 20 notifications from start
     '''
 
     data = get_data()
     #return the top 20 notifications
-    notifications = []
-    i = 0
+    return {'notifications' : newest_notifications(data['users'][check_token(token)], start, 20)}
+
+def events_get(token, since=None, timeout=None):
+    '''
+    Waits for new messages in the user's channels and dms or new notifications, and
+    returns them as soon as there are any
+
+    Arguments:
+        token(string) - The user's token
+        since(int) - event_id returned by the previous call, None to wait for new events
+        timeout(float) - most seconds to wait, at most config.events_timeout
 
-    for notification in data['users'][check_token(token)]['notifications']:
-        if i >= 20 or not notification:
-            break
-        notifications.append(notification)
-        i += 1
-    return {'notifications' : notifications}
+    Returns:
+        events(list of dictionary) - what happened, oldest first, empty if nothing did
+        event_id(int) - pass as since next time
+        reset(bool) - events may have been missed, eg. the server restarted
+    '''
+    u_id = get_data()['users'][check_token(token)]['u_id']
+    if timeout is None or timeout > config.events_timeout:
+        timeout = config.events_timeout
+    return events.wait_for_events(u_id, since, timeout)
 
 
-def search(token, query_str):
+def search(token, query_str, limit=None, cursor=None):
     '''
         searches through all channels and dms a user is part of and returns 
-        all the messages that include the query string
+        all the messages that include the query string. Given a limit or a cursor
+        only a page of the newest of them is returned instead.
 
     Arguments:
         token (string) - a user's session jwt token
         query_str (string) - the given search term
+        limit (int) - most messages in the page, at most config.search_limit
+        cursor (string) - next_cursor of the previous page
         
     Exceptions:
         InputError - when the query_str is longer than a thousand characters
+        InputError - when the limit is less than 1 or the cursor isn't valid
         
     Return Value:
-        Returns a list of all the related messages
+        Returns a list of all the related messages, or a page of them newest first
+        and the next_cursor for the page after it (None on the last page)
     '''
     if len(query_str) > 1000:
         raise InputError(description='query_str is above 1000 characters')
     data = get_data()
     u_id = data['users'][check_token(token)]['u_id']
+    if limit is not None or cursor is not None:
+        return search_page(u_id, query_str, limit, cursor)
     messages = []
-    for channel in data['channels']:
-        for message in channel['messages']:
-            if (query_str in message['message'] or not query_str) and message['u_id'] == u_id:
-                messages.append(
-                    {
-                        'message_id' : message['message_id'],
-                        'u_id' : message['u_id'],
-                        'message' : message['message'],
-                        'time_created' : message['time_created'],
-                    }
-                )
+    for message in search_index.search_messages(query_str, u_id):
+        messages.append(search_info(message))
     return {
         'messages': messages,
     }
 
-def tagged_info(message):
-    data = get_data()
-    tagged_names = []
-    user_info = []
-    if '@' in message:
-        names = re.findall(r"@\w+", message)
-        for name in names:
-            name = name[1:]
-            tagged_names.append(name)
-        #Find the tagged_name's u_id:
-        for tagged_name in tagged_names:
-            for user in data['users']:
-                if user['handle_str'] == tagged_name:
-                    user_info.append({
-                        'u_id': user['u_id'],
-                        'handle_str': user['handle_str']
-                    })
-                    break
-    return user_info
-
-def valid_tag_target(handle, u_id, channel_id):
-    data = get_data()
-    #Check the user's handle 
-    if data['users'][check_u_id(u_id)]['handle_str'] == handle and \
-    check_valid_dm_member(u_id, channel_id):
-        return True
-    return False
+def search_info(message):
+    return {
+        'message_id' : message['message_id'],
+        'u_id' : message['u_id'],
+        'message' : message['message'],
+        'time_created' : message['time_created'],
+    }
 
-def check_valid_dm_member(u_id, channel_id):
-    data = get_data()
-    for channel in data['channels']:
-        if channel['channel_id'] == channel_id:
-            for eachMember in channel['all_members']:
-                if u_id == eachMember['u_id']:
-                    return True
-    return False  
-
-def generate_tag_notification_message(u_id, channel_id, token, message):
+def search_page(u_id, query_str, limit, cursor):
+    '''
+        returns a page of the newest messages that include the query string, see search
+    '''
+    if limit is None or limit > config.search_limit:
+        limit = config.search_limit
+    if limit < 1:
+        raise InputError(description='limit must be at least 1')
+    before = None
+    if cursor is not None:
+        try:
+            before = tuple(int(part) for part in cursor.split('_'))
+        except ValueError:
+            raise InputError(description='cursor is not valid') from None
+        if len(before) != 2:
+            raise InputError(description='cursor is not valid')
+    messages, more = search_index.newest_messages(query_str, u_id, limit, before)
+    last = messages[-1] if messages else None
+    return {
+        'messages' : [search_info(message) for message in messages],
+        'next_cursor' : f"{last['time_created']}_{last['message_id']}" if more else None,
+    }
+
+def tagged_info(message, data):
     '''
-    This function only returns the tag notificatoin
+    Finds the users tagged in a message by their handles
 
     Arguments:
-        u_id(integer)
-        token(integer)
-        channel_name(string)
         message(string)
-    
+        data(dictionary) - the database the users are in
+
     Returns:
-        Tag notificatoin
+        u_ids(list of integer) - each tagged user once, in the order they were first tagged
     '''
-    data = get_data()
-    channel_name = ''
-    for channel in data['channels']:
-        if channel['channel_id'] == channel_id:
-            channel_name = channel['name']
-    handle_string = data['users'][check_token(token)]['handle_str']
-    return f"{handle_string} tagged you in {channel_name}: {message[:20]}"
+    u_ids = []
+    for handle in dict.fromkeys(re.findall(r"@(\w+)", message)):
+        user_index = index.find_user('handle_str', handle)
+        if user_index is not None:
+            u_ids.append(data['users'][user_index]['u_id'])
+    return u_ids
 
 
 def insert_tag_notification(token, channel_id, message):
     '''
-        searches through all channels and dms a user is part of and returns 
-        all the messages that include the query string
+    Notifies every member of the channel or dm tagged in a message, all of them
+    at once
 
     Arguments:
         token (string) - a user's session jwt token
-        query_str (string) - the given search term
-        
-    Exceptions:
-        InputError - when the query_str is longer than a thousand characters
-        
+        channel_id (int) - the channel or dm the message was sent to
+        message (string) - the message that was sent
+
     Return Value:
-        Returns a list of all the related messages
+        None
     '''
     if '@' not in message:
         return
-    targets_info = tagged_info(message)
-    for target_info in targets_info:
-        if valid_tag_target(target_info['handle_str'], target_info['u_id'], channel_id):
-            notify_user(target_info['u_id'], channel_id, \
-            generate_tag_notification_message(target_info['u_id'], channel_id, token, message))
+    notify_tagged(get_data()['users'][check_token(token)]['u_id'], channel_id, message)
+
+def notify_tagged(u_id, channel_id, message):
+    '''
+    Notifies the members tagged in a message like insert_tag_notification, for
+    a sender given by u_id rather than by a session
+    '''
+    if '@' not in message:
+        return
+    data = get_data()
+    members = index.channel_members(channel_id)
+    targets = [target for target in tagged_info(message, data) if target in members]
+    if not targets:
+        return
+    channel_name = data['channels'][index.find_channel(channel_id)]['name']
+    handle_string = data['users'][index.find_user('u_id', u_id)]['handle_str']
+    notify_users(targets, channel_id, f"{handle_string} tagged you in {channel_name}: {message[:20]}")
 
 
 def generate_addedChannel_notification(u_id, token, channel_name):
@@ -230,12 +236,22 @@ def admin_user_remove(token, u_id):
     data['users'][user_index]['name_first'] = 'Removed user'
     data['users'][user_index]['name_last'] = 'Removed user'
     
-    for channel in data['channels']:
-        for message in channel['messages']:
-            if message['u_id'] == u_id:
-                message['message'] = 'Removed user'
+    # only the messages the user sent, rather than every message
+    for message_id in list(index.user_messages(u_id)):
+        found = index.find_message(message_id)
+        if found is None:
+            continue
+        channel = data['channels'][found[0]]
+        message = channel['messages'][found[1]]
+        message['message'] = 'Removed user'
+        search_index.index_message(message)
+        message_changed(channel['channel_id'], message_id)
+        mark_message(channel['channel_id'], message_id)
     
     data['users'][user_index]['sessions_list'] = []
+    index.update_user(user_index)
+    forget_tokens(u_id)
+    mark_user(u_id)
     write_data(data)
     return {}
 
@@ -268,6 +284,7 @@ def admin_userpermission_change(token, u_id, permission_id):
         raise InputError(description='permission_id does not refer to a value permission')
         
     data['users'][user_index]['permission_id'] = permission_id
+    mark_user(u_id)
     write_data(data)
     return {}
     
@@ -0,0 +1,111 @@
+'''
+Runs work at a later time on a single background thread.
+
+Jobs are kept in data['scheduled'] so they are saved with the rest of the
+database, and in a heap ordered by when they are due so the thread only
+ever waits for the earliest one. A job is taken out of data['scheduled']
+once its handler has run, so a job that was due while the server was down
+runs as soon as the scheduler starts again. Handlers must therefore cope
+with being run twice for the same job.
+'''
+
+import heapq
+import logging
+import threading
+import time
+
+from src import data_store
+
+_wakeup = threading.Condition()
+
+_scheduler = {
+    'queue' : [],
+    # the database the queue was built from
+    'data' : None,
+    'thread' : None,
+    'handlers' : {},
+}
+
+def register(kind, handler):
+    '''
+    Sets the function that runs jobs of a kind, it is called with the job's
+    payload as keyword arguments
+    '''
+    _scheduler['handlers'][kind] = handler
+
+def schedule(when, kind, payload):
+    '''
+    Adds a job to run at a given time
+
+    Arguments:
+        when (float) - unix timestamp the job is due at
+        kind (string) - the kind of job, see register
+        payload (dict) - keyword arguments for the handler, must be json serializable
+
+    Return Value:
+        Returns the id of the job
+    '''
+    data = data_store.get_store()
+    job = {'job_id' : data_store.next_id('job_id'), 'time' : when, 'kind' : kind,
+        'payload' : payload}
+    data.setdefault('scheduled', []).append(job)
+    data_store.set_store(data)
+    with _wakeup:
+        if _scheduler['data'] is data:
+            heapq.heappush(_scheduler['queue'], (when, job['job_id']))
+        _wakeup.notify()
+    start()
+    return job['job_id']
+
+def start():
+    '''
+    Starts the scheduler thread if it isn't running yet
+    '''
+    with _wakeup:
+        if _scheduler['thread'] is None:
+            _scheduler['thread'] = threading.Thread(target=_run_forever, daemon=True)
+            _scheduler['thread'].start()
+
+def _sync():
+    # a reload or clear replaced the database, so the jobs come from the new one
+    data = data_store.get_store()
+    if _scheduler['data'] is not data:
+        _scheduler['data'] = data
+        _scheduler['queue'] = [(job['time'], job['job_id']) for job in data.get('scheduled', [])]
+        heapq.heapify(_scheduler['queue'])
+
+def _next_due():
+    '''
+    Waits until the earliest job is due and takes it off the queue
+    '''
+    with _wakeup:
+        while True:
+            _sync()
+            queue = _scheduler['queue']
+            if queue and queue[0][0] <= time.time():
+                return heapq.heappop(queue)[1]
+            # wake up now and then to notice a reload or clear
+            _wakeup.wait(min(queue[0][0] - time.time(), 1) if queue else 1)
+
+def run_job(job_id):
+    '''
+    Runs the job with the given id if it is still scheduled and removes it
+    '''
+    data = data_store.get_store()
+    job = next((job for job in data.get('scheduled', []) if job['job_id'] == job_id), None)
+    if job is None:
+        return
+    try:
+        _scheduler['handlers'][job['kind']](**job['payload'])
+    except Exception:
+        # the job can't be run any more, eg. its user has since left the channel
+        logging.getLogger(__name__).warning('%s job %s was dropped', job['kind'], job_id,
+            exc_info=True)
+    data = data_store.get_store()
+    if job in data.get('scheduled', []):
+        data['scheduled'].remove(job)
+        data_store.set_store(data)
+
+def _run_forever():
+    while True:
+        run_job(_next_due())
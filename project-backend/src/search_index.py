@@ -0,0 +1,261 @@
+'''
+Trigram index over the text of every message, for search.
+
+Every three character substring (trigram) of a message maps to the ids of
+the messages containing it. A message can only contain a query if it
+contains each of the query's trigrams, so only the messages in all of
+their posting lists are checked with the substring test search has always
+used and the results are the same. Search only looks at the caller's own
+messages, so the candidates are also narrowed to the user's posting list
+from index.user_messages. Queries of one or two characters have no
+trigrams and are checked against every message the user sent.
+
+A page of the newest matches walks back through the user's messages in
+the order they were created, kept in the index, from the cursor until the
+page is full. When the query's rarest trigram is in fewer messages than
+that, only those are sorted and walked instead.
+
+The index is saved to config.search_index_file as a compacted snapshot on
+the first line followed by one line per change. Changes are numbered from
+the persisted 'search_seq' sequence, so on load the file is only used if it
+holds every change up to the number saved with the database. Otherwise (or
+after a clear) the index is rebuilt from the messages and the file is
+rewritten. It is also rewritten once config.search_compact_threshold
+changes have been appended, so it stays about the size of the index.
+'''
+
+import bisect
+import json
+import os
+import threading
+
+from src import config
+from src.data_store import get_store, next_id
+from src import index
+
+_lock = threading.RLock()
+
+_search = {
+    'data' : None,
+    # message_id -> (u_id of the sender, the message's trigrams, time_created)
+    'messages' : {},
+    # trigram -> ids of the messages containing it
+    'postings' : {},
+    # change lines appended since the file was last rewritten
+    'records' : 0,
+    # u_id -> (time_created, message_id) of the user's messages in order, None
+    # while the index is being filled
+    'timelines' : {},
+}
+
+# what the saved file indexes, a file from another kind of index is rebuilt
+FORMAT = 'trigram-time'
+
+def trigrams(text):
+    '''
+    Returns the set of three character substrings of a piece of text
+    '''
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def _add(message_id, u_id, message_grams, time_created):
+    _remove(message_id)
+    _search['messages'][message_id] = (u_id, message_grams, time_created)
+    for gram in message_grams:
+        _search['postings'].setdefault(gram, set()).add(message_id)
+    if _search['timelines'] is not None:
+        # messages are sent in time order, so this is nearly always an append
+        bisect.insort(_search['timelines'].setdefault(u_id, []), (time_created, message_id))
+
+def _remove(message_id):
+    u_id, message_grams, time_created = _search['messages'].pop(message_id, (None, (), None))
+    if u_id is not None and _search['timelines'] is not None:
+        timeline = _search['timelines'][u_id]
+        del timeline[bisect.bisect_left(timeline, (time_created, message_id))]
+    for gram in message_grams:
+        posting = _search['postings'][gram]
+        posting.discard(message_id)
+        if not posting:
+            del _search['postings'][gram]
+
+def _load(data):
+    '''
+    Fills the index from the file if it is in step with data, returns whether it was
+    '''
+    saved_seq = data.get('sequences', {}).get('search_seq', 0)
+    try:
+        with open(config.search_index_file, 'r') as index_file:
+            snapshot = json.loads(index_file.readline())
+            if snapshot.get('format') != FORMAT or snapshot['seq'] > saved_seq:
+                return False
+            for message_id, (u_id, message_grams, time_created) in snapshot['messages']:
+                _add(message_id, u_id, set(message_grams), time_created)
+            seq = snapshot['seq']
+            for line in index_file:
+                if seq == saved_seq:
+                    break
+                try:
+                    change = json.loads(line)
+                except ValueError:
+                    # the process died part way through this line
+                    break
+                if change['seq'] != seq + 1:
+                    break
+                seq = change['seq']
+                if change['grams'] is None:
+                    _remove(change['message_id'])
+                else:
+                    _add(change['message_id'], change['u_id'], set(change['grams']),
+                        change['time_created'])
+            return seq == saved_seq
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        return False
+
+def _rewrite(data):
+    temp = config.search_index_file + '.tmp'
+    with open(temp, 'w') as index_file:
+        index_file.write(json.dumps({
+            'format' : FORMAT,
+            'seq' : data.get('sequences', {}).get('search_seq', 0),
+            'messages' : [[message_id, [u_id, sorted(message_grams), time_created]]
+                for message_id, (u_id, message_grams, time_created) in _search['messages'].items()],
+        }) + '\n')
+    os.replace(temp, config.search_index_file)
+    _search['records'] = 0
+
+def _search_index():
+    '''
+    Returns the data the index is for, loading or rebuilding it if it belongs
+    to another dictionary
+    '''
+    data = get_store()
+    with _lock:
+        if _search['data'] is not data:
+            _search['data'] = data
+            _search['messages'] = {}
+            _search['postings'] = {}
+            # sorted once at the end rather than kept in order while filling
+            _search['timelines'] = None
+            if not _load(data):
+                _search['messages'] = {}
+                _search['postings'] = {}
+                for channel in data['channels']:
+                    for message in channel['messages']:
+                        _add(message['message_id'], message['u_id'], trigrams(message['message']),
+                            message['time_created'])
+            timelines = {}
+            for message_id, (u_id, _, time_created) in _search['messages'].items():
+                timelines.setdefault(u_id, []).append((time_created, message_id))
+            for timeline in timelines.values():
+                timeline.sort()
+            _search['timelines'] = timelines
+            _rewrite(data)
+    return data
+
+def _record(message_id, u_id=None, message_grams=None, time_created=None):
+    change = {'seq' : next_id('search_seq'), 'message_id' : message_id, 'u_id' : u_id,
+        'grams' : None if message_grams is None else sorted(message_grams),
+        'time_created' : time_created}
+    with open(config.search_index_file, 'a') as index_file:
+        index_file.write(json.dumps(change) + '\n')
+    _search['records'] += 1
+    if _search['records'] >= config.search_compact_threshold:
+        # fold the changes into a new snapshot so the file doesn't keep growing
+        _rewrite(_search['data'])
+
+def index_message(message):
+    '''
+    Indexes a message that was sent, or indexes it again after its text changed
+    '''
+    _search_index()
+    with _lock:
+        message_grams = trigrams(message['message'])
+        _add(message['message_id'], message['u_id'], message_grams, message['time_created'])
+        _record(message['message_id'], message['u_id'], message_grams, message['time_created'])
+
+def remove_message(message_id):
+    '''
+    Drops a message that was removed, on its own or with its dm
+    '''
+    _search_index()
+    with _lock:
+        if message_id in _search['messages']:
+            _remove(message_id)
+            _record(message_id)
+
+def _candidates(query_str, u_id):
+    # ids of the messages sent by the user that have every trigram of the query,
+    # one and two character queries have none so all the user's messages are candidates
+    postings = sorted([index.user_messages(u_id)] + [_search['postings'].get(gram, set()) \
+        for gram in trigrams(query_str)], key=len)
+    # starting from the rarest keeps the intersection small
+    return [message_id for message_id in postings[0].intersection(*postings[1:]) \
+        if message_id in _search['messages']]
+
+def _matching(data, message_id, query_str, u_id):
+    location = index.find_message(message_id)
+    if location is None:
+        return None
+    message = data['channels'][location[0]]['messages'][location[1]]
+    if query_str in message['message'] and message['u_id'] == u_id:
+        return location, message
+    return None
+
+def search_messages(query_str, u_id):
+    '''
+    Finds the messages sent by a user that contain a string
+
+    Arguments:
+        query_str (string) - the string to look for, every message matches ''
+        u_id (int) - the sender of the messages
+
+    Return Value:
+        Returns the matching messages in the order they are stored
+    '''
+    data = _search_index()
+    with _lock:
+        candidates = _candidates(query_str, u_id)
+    found = [match for match in (_matching(data, message_id, query_str, u_id) \
+        for message_id in candidates) if match is not None]
+    return [message for _, message in sorted(found, key=lambda item: item[0])]
+
+def newest_messages(query_str, u_id, limit, before=None):
+    '''
+    Finds a page of the newest messages sent by a user that contain a string,
+    checking candidates only until the page is full
+
+    Arguments:
+        query_str (string) - the string to look for, every message matches ''
+        u_id (int) - the sender of the messages
+        limit (int) - most messages to return
+        before (tuple) - (time_created, message_id) of the last message of the
+            previous page, None for the first page
+
+    Return Value:
+        Returns a tuple of the matching messages newest first and whether there
+        are older matches after them
+    '''
+    data = _search_index()
+    query_grams = trigrams(query_str)
+    page = []
+    with _lock:
+        timeline = _search['timelines'].get(u_id, [])
+        end = len(timeline) if before is None else bisect.bisect_left(timeline, tuple(before))
+        rarest = min((_search['postings'].get(gram, set()) for gram in query_grams),
+            key=len, default=None)
+        if rarest is not None and len(rarest) < end:
+            # fewer messages have the rarest trigram than are left to walk through
+            keys = sorted(key for key in ((_search['messages'][message_id][2], message_id) \
+                for message_id in _candidates(query_str, u_id)) if before is None or key < before)
+            newest_first = reversed(keys)
+        else:
+            newest_first = (timeline[i] for i in range(end - 1, -1, -1))
+        # walk back from the newest until the page and one more match are found
+        for _, message_id in newest_first:
+            if len(page) > limit:
+                break
+            if not query_grams <= _search['messages'][message_id][1]:
+                continue
+            match = _matching(data, message_id, query_str, u_id)
+            if match is not None:
+                page.append(match[1])
+    return page[:limit], len(page) > limit
@@ -1,10 +1,12 @@
+import os
 import sys
 from json import dumps
-from flask import Flask, request, send_file
+from flask import Flask, request, send_from_directory
 from flask_cors import CORS
 from flask_mail import Mail, Message
 from src.error import InputError
-from src import other, config, channel, channels, auth, user, dm, message, standup
+from src import other, config, channel, channels, auth, user, dm, message, standup, data_store, \
+    scheduler, image_pipeline
 from src.user import user_profile_uploadphoto
 
 def defaultHandler(err):
@@ -34,6 +36,25 @@ mail = Mail(APP)
 APP.config['TRAP_HTTP_EXCEPTIONS'] = True
 APP.register_error_handler(Exception, defaultHandler)
 
+# Each request works on the resident data and commits its changes once at the end
+@APP.before_request
+def open_unit_of_work():
+    data_store.begin_request()
+
+@APP.after_request
+def commit_unit_of_work(response):
+    counts = data_store.end_request()
+    if counts is not None:
+        response.headers['X-Storage-Reads'] = counts['reads']
+        response.headers['X-Storage-Writes'] = counts['writes']
+        response.headers['X-Storage-Commits'] = counts['commits']
+    return response
+
+@APP.teardown_request
+def close_unit_of_work(_):
+    # only does anything if after_request never ran
+    data_store.end_request()
+
 # Example
 @APP.route("/echo", methods=['GET'])
 def echo():
@@ -64,6 +85,10 @@ def channels_create():
 def channel_invite():
     return dumps(channel.channel_invite(**request.get_json()))
 
+@APP.route('/channel/invite/batch/v1', methods=['POST'])
+def channel_invite_many():
+    return dumps(channel.channel_invite_many(**request.get_json()))
+
 @APP.route('/channel/details/v2', methods=['GET'])
 def channel_details():
     return dumps(channel.channel_details(request.args.get('token'), int(request.args.get('channel_id'))))
@@ -72,10 +97,28 @@ def channel_details():
 def channel_join():
     return dumps(channel.channel_join(**request.get_json()))
 
+# Reads an optional integer query parameter
+def int_arg(name):
+    value = request.args.get(name)
+    return None if value is None else int(value)
+
+# Paging by start offset, or by before_message_id/after_message_id and page_size
+def message_page_args():
+    return {
+        'start' : int_arg('start'),
+        'before_message_id' : int_arg('before_message_id'),
+        'after_message_id' : int_arg('after_message_id'),
+        'page_size' : int_arg('page_size'),
+    }
+
 @APP.route('/channel/messages/v2', methods=['GET'])
 def channel_messages():
-    resp = dumps(channel.channel_messages(request.args.get('token'), int(request.args.get('channel_id')), int(request.args.get('start'))))
+    resp = dumps(channel.channel_messages(request.args.get('token'), int(request.args.get('channel_id')), **message_page_args()))
     return resp
+
+@APP.route('/channel/messages/changes/v1', methods=['GET'])
+def channel_messages_changes():
+    return dumps(channel.channel_messages_changes(request.args.get('token'), int(request.args.get('channel_id')), int(request.args.get('since', 0))))
     
 @APP.route('/channels/list/v2', methods=['GET']) 
 def channels_list(): 
@@ -127,7 +170,11 @@ def dm_details():
 
 @APP.route('/dm/messages/v1', methods=['GET'])
 def dm_messages():
-    return dumps(dm.dm_messages(request.args.get('token'), int(request.args.get('dm_id')), int(request.args.get('start'))))
+    return dumps(dm.dm_messages(request.args.get('token'), int(request.args.get('dm_id')), **message_page_args()))
+
+@APP.route('/dm/messages/changes/v1', methods=['GET'])
+def dm_messages_changes():
+    return dumps(dm.dm_messages_changes(request.args.get('token'), int(request.args.get('dm_id')), int(request.args.get('since', 0))))
 
 @APP.route('/message/share/v1', methods=['POST'])
 def message_share():
@@ -205,7 +252,8 @@ def users_all():
 
 @APP.route('/search/v2', methods=['GET'])
 def search():
-    return dumps(other.search(request.args.get('token'), request.args.get('query_string')))
+    return dumps(other.search(request.args.get('token'), request.args.get('query_string'),
+        int_arg('limit'), request.args.get('cursor')))
 
 @APP.route('/admin/user/remove/v1', methods=['DELETE'])
 def admin_user_remove():
@@ -237,7 +285,7 @@ def user_profile_uploadphotofunction():
 
 @APP.route('/static/<path:path>', methods=['GET'])
 def send_photo(path):
-    return send_file(f"src/static/{path}")
+    return send_from_directory(os.path.abspath(config.image_dir), path)
 
 @APP.route('/clear/v1', methods=['DELETE'])
 def clear():
@@ -245,7 +293,13 @@ def clear():
 
 @APP.route('/notifications/get/v1', methods=['GET'])
 def notifications_get_v1():
-    return dumps(other.notifications_get(request.args.get('token')))
+    return dumps(other.notifications_get(request.args.get('token'), int(request.args.get('start', 0))))
+
+@APP.route('/events/v1', methods=['GET'])
+def events_get():
+    timeout = request.args.get('timeout')
+    return dumps(other.events_get(request.args.get('token'), int_arg('since'),
+        None if timeout is None else float(timeout)))
 
 @APP.route('/user/stats/v1', methods=['GET'])
 def get_user_stats():
@@ -256,4 +310,7 @@ def get_users_stats():
     return dumps(user.users_stats(request.args.get('token')))
     
 if __name__ == "__main__":
+    # deliver anything that came due while the server was down
+    scheduler.start()
+    image_pipeline.start()
     APP.run(port=config.port) # Do not edit this port
@@ -0,0 +1,415 @@
+'''
+SQLite backend for the data store, selected with config.storage_mode = 'sqlite'.
+
+Users, sessions, notifications, user stats entries, channels, members,
+messages and reacts each get their own table, indexed on the keys the rest of the backend looks things
+up by. The data store still hands out one resident dictionary, this module
+turns the records produced by src.data_store.collect_records into row updates
+and rebuilds the dictionary from the tables on load.
+
+An existing data.json can be imported with
+
+    python3 -m src.sqlite_store [data.json] [data.sqlite]
+'''
+
+import json
+import sqlite3
+import sys
+import threading
+
+from src import config
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    u_id INTEGER PRIMARY KEY,
+    name_first TEXT,
+    name_last TEXT,
+    email TEXT,
+    password TEXT,
+    profile_img_url TEXT,
+    handle_str TEXT,
+    permission_id INTEGER,
+    reset_code TEXT,
+    channels_joined TEXT,
+    dms_joined TEXT,
+    messages_sent TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS users_email ON users (email);
+CREATE INDEX IF NOT EXISTS users_handle_str ON users (handle_str);
+CREATE INDEX IF NOT EXISTS users_reset_code ON users (reset_code);
+
+CREATE TABLE IF NOT EXISTS sessions (
+    u_id INTEGER,
+    session_id INTEGER,
+    PRIMARY KEY (u_id, session_id)
+);
+
+CREATE TABLE IF NOT EXISTS notifications (
+    u_id INTEGER,
+    position INTEGER,
+    channel_id INTEGER,
+    dm_id INTEGER,
+    notification_message TEXT,
+    PRIMARY KEY (u_id, position)
+);
+
+CREATE TABLE IF NOT EXISTS channels (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel_id INTEGER UNIQUE,
+    name TEXT,
+    is_public INTEGER,
+    is_dm INTEGER,
+    standup TEXT,
+    extra TEXT
+);
+
+CREATE TABLE IF NOT EXISTS members (
+    channel_id INTEGER,
+    role TEXT,
+    position INTEGER,
+    u_id INTEGER,
+    PRIMARY KEY (channel_id, role, position)
+);
+CREATE INDEX IF NOT EXISTS members_u_id ON members (u_id);
+
+CREATE TABLE IF NOT EXISTS messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel_id INTEGER,
+    message_id INTEGER,
+    u_id INTEGER,
+    message TEXT,
+    time_created INTEGER,
+    is_pinned INTEGER,
+    extra TEXT,
+    UNIQUE (channel_id, message_id)
+);
+CREATE INDEX IF NOT EXISTS messages_message_id ON messages (message_id);
+CREATE INDEX IF NOT EXISTS messages_u_id ON messages (u_id);
+
+CREATE TABLE IF NOT EXISTS reacts (
+    channel_id INTEGER,
+    message_id INTEGER,
+    position INTEGER,
+    react_id INTEGER,
+    u_ids TEXT,
+    is_this_user_reacted INTEGER,
+    PRIMARY KEY (channel_id, message_id, position)
+);
+
+CREATE TABLE IF NOT EXISTS user_series (
+    u_id INTEGER,
+    key TEXT,
+    position INTEGER,
+    value TEXT,
+    PRIMARY KEY (u_id, key, position)
+);
+
+CREATE TABLE IF NOT EXISTS series (
+    key TEXT,
+    position INTEGER,
+    value TEXT,
+    PRIMARY KEY (key, position)
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+USER_COLUMNS = ['u_id', 'name_first', 'name_last', 'email', 'password', 'profile_img_url',
+    'handle_str', 'permission_id', 'reset_code']
+USER_SERIES = ['channels_joined', 'dms_joined', 'messages_sent']
+CHANNEL_COLUMNS = ['channel_id', 'name', 'is_public', 'is_dm']
+MESSAGE_COLUMNS = ['message_id', 'u_id', 'message', 'time_created', 'is_pinned']
+TABLES = ['users', 'sessions', 'notifications', 'channels', 'members', 'messages',
+    'reacts', 'user_series', 'series', 'meta']
+
+_db = {
+    'path' : None,
+    'connection' : None,
+}
+_lock = threading.RLock()
+
+def connect(path):
+    '''
+    Opens a connection to the database at path, creating the tables if needed
+    '''
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(SCHEMA)
+    return connection
+
+def get_connection():
+    '''
+    Returns the connection to config.db_file, opening it on first use
+    '''
+    if _db['path'] != config.db_file:
+        if _db['connection'] is not None:
+            _db['connection'].close()
+        _db['connection'] = connect(config.db_file)
+        _db['path'] = config.db_file
+    return _db['connection']
+
+def _extra(item, known):
+    return json.dumps({key: value for key, value in item.items() if key not in known})
+
+# --------------------------------------------------------------------------------------- #
+# ----------------------------- Writing ------------------------------------------------- #
+# --------------------------------------------------------------------------------------- #
+def save_user(cursor, user):
+    save_user_fields(cursor, user)
+    for key in USER_SERIES:
+        save_user_list(cursor, user['u_id'], key, user.get(key, []))
+    for key in ('sessions_list', 'notifications'):
+        save_user_list(cursor, user['u_id'], key, user.get(key, []))
+
+def save_user_fields(cursor, user):
+    known = USER_COLUMNS + USER_SERIES + ['sessions_list', 'notifications']
+    cursor.execute(f'''INSERT INTO users ({', '.join(USER_COLUMNS)}, extra)
+        VALUES ({', '.join('?' * (len(USER_COLUMNS) + 1))}) ON CONFLICT (u_id) DO UPDATE SET
+        {', '.join(f'{column} = excluded.{column}' for column in USER_COLUMNS[1:])},
+        extra = excluded.extra''',
+        [user.get(column) for column in USER_COLUMNS] + [_extra(user, known)])
+
+def save_user_list(cursor, u_id, key, value):
+    if key in USER_SERIES:
+        # databases from before user_series kept the whole series in the users row
+        cursor.execute(f'UPDATE users SET {key} = NULL WHERE u_id = ?', (u_id,))
+        cursor.execute('DELETE FROM user_series WHERE u_id = ? AND key = ?', (u_id, key))
+        cursor.executemany('INSERT INTO user_series VALUES (?, ?, ?, ?)',
+            [(u_id, key, i, json.dumps(entry)) for i, entry in enumerate(value)])
+    elif key == 'sessions_list':
+        cursor.execute('DELETE FROM sessions WHERE u_id = ?', (u_id,))
+        cursor.executemany('INSERT OR REPLACE INTO sessions VALUES (?, ?)',
+            [(u_id, session['session_id']) for session in value])
+    elif key == 'notifications':
+        cursor.execute('DELETE FROM notifications WHERE u_id = ?', (u_id,))
+        cursor.executemany('INSERT INTO notifications VALUES (?, ?, ?, ?, ?)',
+            [(u_id, i, notification.get('channel_id'), notification.get('dm_id'),
+            notification.get('notification_message'))
+            for i, notification in enumerate(value)])
+
+def append_user_series(cursor, u_id, key, index, value):
+    cursor.execute('INSERT OR REPLACE INTO user_series VALUES (?, ?, ?, ?)',
+        (u_id, key, index, json.dumps(value)))
+
+def save_channel(cursor, channel):
+    known = CHANNEL_COLUMNS + ['standup', 'owner_members', 'all_members', 'messages']
+    cursor.execute('''INSERT INTO channels (channel_id, name, is_public, is_dm, standup, extra)
+        VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (channel_id) DO UPDATE SET name = excluded.name,
+        is_public = excluded.is_public, is_dm = excluded.is_dm, standup = excluded.standup,
+        extra = excluded.extra''',
+        [channel.get(column) for column in CHANNEL_COLUMNS] +
+        [json.dumps(channel.get('standup')), _extra(channel, known)])
+    cursor.execute('DELETE FROM members WHERE channel_id = ?', (channel['channel_id'],))
+    for role in ('owner_members', 'all_members'):
+        cursor.executemany('INSERT INTO members VALUES (?, ?, ?, ?)',
+            [(channel['channel_id'], role, i, member['u_id'])
+            for i, member in enumerate(channel.get(role, []))])
+
+def save_message(cursor, channel_id, message):
+    known = MESSAGE_COLUMNS + ['reacts']
+    cursor.execute('''INSERT INTO messages (channel_id, message_id, u_id, message, time_created,
+        is_pinned, extra) VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (channel_id, message_id)
+        DO UPDATE SET u_id = excluded.u_id, message = excluded.message,
+        time_created = excluded.time_created, is_pinned = excluded.is_pinned,
+        extra = excluded.extra''',
+        [channel_id] + [message.get(column) for column in MESSAGE_COLUMNS] +
+        [_extra(message, known)])
+    cursor.execute('DELETE FROM reacts WHERE channel_id = ? AND message_id = ?',
+        (channel_id, message['message_id']))
+    cursor.executemany('INSERT INTO reacts VALUES (?, ?, ?, ?, ?, ?)',
+        [(channel_id, message['message_id'], i, react['react_id'], json.dumps(react['u_ids']),
+        react['is_this_user_reacted']) for i, react in enumerate(message.get('reacts', []))])
+
+def remove_message(cursor, channel_id, message_id):
+    cursor.execute('DELETE FROM messages WHERE channel_id = ? AND message_id = ?',
+        (channel_id, message_id))
+    cursor.execute('DELETE FROM reacts WHERE channel_id = ? AND message_id = ?',
+        (channel_id, message_id))
+
+def remove_channel(cursor, channel_id):
+    for table in ('channels', 'members', 'messages', 'reacts'):
+        cursor.execute(f'DELETE FROM {table} WHERE channel_id = ?', (channel_id,))
+
+def save_root(cursor, key, value):
+    if isinstance(value, list):
+        cursor.execute('DELETE FROM series WHERE key = ?', (key,))
+        cursor.executemany('INSERT INTO series VALUES (?, ?, ?)',
+            [(key, i, json.dumps(entry)) for i, entry in enumerate(value)])
+    else:
+        cursor.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, json.dumps(value)))
+
+def apply_records(records):
+    '''
+    Writes a batch of data store records to the database in one transaction
+
+    Arguments:
+        records (list) - records as produced by src.data_store.collect_records
+
+    Return Value:
+        None
+    '''
+    with _lock:
+        connection = get_connection()
+        with connection:
+            cursor = connection.cursor()
+            for record in records:
+                kind = record['type']
+                if kind == 'user':
+                    save_user_fields(cursor, record['value'])
+                elif kind == 'user_series':
+                    append_user_series(cursor, record['u_id'], record['key'], record['index'],
+                        record['value'])
+                elif kind == 'user_set':
+                    save_user_list(cursor, record['u_id'], record['key'], record['value'])
+                elif kind == 'channel':
+                    save_channel(cursor, record['value'])
+                elif kind == 'message':
+                    save_message(cursor, record['channel_id'], record['value'])
+                elif kind == 'remove_message':
+                    remove_message(cursor, record['channel_id'], record['message_id'])
+                elif kind == 'remove_channel':
+                    remove_channel(cursor, record['channel_id'])
+                elif kind == 'series':
+                    cursor.execute('INSERT OR REPLACE INTO series VALUES (?, ?, ?)',
+                        (record['key'], record['index'], json.dumps(record['value'])))
+                elif kind == 'set':
+                    save_root(cursor, record['key'], record['value'])
+
+def save_all(data, connection=None):
+    '''
+    Replaces the whole database with the given data in one transaction, in
+    config.db_file unless another connection is given
+    '''
+    with _lock:
+        connection = connection or get_connection()
+        with connection:
+            cursor = connection.cursor()
+            for table in TABLES:
+                cursor.execute(f'DELETE FROM {table}')
+            for user in data['users']:
+                save_user(cursor, user)
+            for channel in data['channels']:
+                save_channel(cursor, channel)
+                for message in channel['messages']:
+                    save_message(cursor, channel['channel_id'], message)
+            for key, value in data.items():
+                if key not in ('users', 'channels'):
+                    save_root(cursor, key, value)
+
+# --------------------------------------------------------------------------------------- #
+# ----------------------------- Reading ------------------------------------------------- #
+# --------------------------------------------------------------------------------------- #
+def _group(rows, width=1):
+    grouped = {}
+    for row in rows:
+        key = row[0] if width == 1 else tuple(row[:width])
+        grouped.setdefault(key, []).append(row[width:])
+    return grouped
+
+def load_all():
+    '''
+    Rebuilds the data dictionary from the database
+
+    Return Value:
+        Returns the data dictionary, or None if the database is empty
+    '''
+    with _lock:
+        connection = get_connection()
+        if not any(connection.execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone()
+            for table in ('users', 'channels', 'series', 'meta')):
+            return None
+
+        sessions = _group(connection.execute(
+            'SELECT u_id, session_id FROM sessions ORDER BY rowid'))
+        notifications = _group(connection.execute('''SELECT u_id, channel_id, dm_id,
+            notification_message FROM notifications ORDER BY u_id, position'''))
+        series = _group(connection.execute(
+            'SELECT u_id, key, position, value FROM user_series ORDER BY u_id, key, position'), 2)
+        users = []
+        for row in connection.execute('SELECT * FROM users ORDER BY u_id'):
+            user = dict(zip(USER_COLUMNS, row[:len(USER_COLUMNS)]))
+            user['sessions_list'] = [{'session_id' : session_id}
+                for session_id, in sessions.get(user['u_id'], [])]
+            user['notifications'] = [{
+                'channel_id' : channel_id,
+                'dm_id' : dm_id,
+                'notification_message' : notification_message
+            } for channel_id, dm_id, notification_message in notifications.get(user['u_id'], [])]
+            for key, value in zip(USER_SERIES, row[len(USER_COLUMNS):-1]):
+                user[key] = [] if value is None else json.loads(value)
+                for position, entry in series.get((user['u_id'], key), []):
+                    if position < len(user[key]):
+                        user[key][position] = json.loads(entry)
+                    else:
+                        user[key].append(json.loads(entry))
+            user.update(json.loads(row[-1]))
+            users.append(user)
+
+        members = _group(connection.execute(
+            'SELECT channel_id, role, u_id FROM members ORDER BY channel_id, role, position'))
+        reacts = _group(connection.execute('''SELECT channel_id, message_id, react_id, u_ids,
+            is_this_user_reacted FROM reacts ORDER BY channel_id, message_id, position'''), 2)
+        messages = _group(connection.execute(f'''SELECT channel_id, {', '.join(MESSAGE_COLUMNS)},
+            extra FROM messages ORDER BY seq'''))
+        channels = []
+        for row in connection.execute(f'''SELECT {', '.join(CHANNEL_COLUMNS)}, standup, extra
+            FROM channels ORDER BY seq'''):
+            channel = dict(zip(CHANNEL_COLUMNS, row[:len(CHANNEL_COLUMNS)]))
+            channel['is_public'] = bool(channel['is_public'])
+            channel['is_dm'] = bool(channel['is_dm'])
+            for role in ('owner_members', 'all_members'):
+                channel[role] = [{'u_id' : u_id} for member_role, u_id
+                    in members.get(channel['channel_id'], []) if member_role == role]
+            channel['messages'] = []
+            for message_row in messages.get(channel['channel_id'], []):
+                message = dict(zip(MESSAGE_COLUMNS, message_row[:len(MESSAGE_COLUMNS)]))
+                message['is_pinned'] = bool(message['is_pinned'])
+                message['reacts'] = [{
+                    'react_id' : react_id,
+                    'u_ids' : json.loads(u_ids),
+                    'is_this_user_reacted' : bool(reacted)
+                } for react_id, u_ids, reacted
+                    in reacts.get((channel['channel_id'], message['message_id']), [])]
+                message.update(json.loads(message_row[-1]))
+                channel['messages'].append(message)
+            channel['standup'] = json.loads(row[-2])
+            channel.update(json.loads(row[-1]))
+            channels.append(channel)
+
+        data = {'users' : users, 'channels' : channels}
+        for key, value in connection.execute('SELECT key, value FROM meta'):
+            data[key] = json.loads(value)
+        for key, _, value in connection.execute('SELECT * FROM series ORDER BY key, position'):
+            data.setdefault(key, []).append(json.loads(value))
+        return data
+
+def migrate(json_file, db_file):
+    '''
+    Imports an existing data.json into a SQLite database, replacing its contents
+
+    Arguments:
+        json_file (string) - path of the data.json to import
+        db_file (string) - path of the database to write
+
+    Return Value:
+        Returns the number of users and channels imported in a dictionary
+    '''
+    with open(json_file, 'r') as datafile:
+        data = json.load(datafile)
+    connection = connect(db_file)
+    try:
+        save_all(data, connection)
+    finally:
+        connection.close()
+    return {'users' : len(data['users']), 'channels' : len(data['channels'])}
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    imported = migrate(args[0] if args else config.data_file,
+        args[1] if len(args) > 1 else config.db_file)
+    print(f"imported {imported['users']} users and {imported['channels']} channels")
@@ -6,13 +6,17 @@ Date:
     12 April 2021
 '''
 
+import json
+import os
+import threading
 import time
 
 from src.auth import check_token, get_data, write_data, check_u_id, check_token
 from src.error import InputError, AccessError
 from src.helper import check_channel_id, user_is_member, get_user_dictionary
-from src.message import message_send
-from threading import Timer
+from src.message import message_send_as
+from src.data_store import mark_channel
+from src import config, index, scheduler
 
 def standup_start(token, channel_id, length):
     '''
@@ -42,9 +46,8 @@ def standup_start(token, channel_id, length):
     channel_index = check_channel_id(channel_id)
 
     # Raise InputError if an active standup is already occurring.
-    if data['channels'][channel_index]['standup']['time_finish'] != None:
-        if int(time.time()) < data['channels'][channel_index]['standup']['time_finish']:
-            raise InputError(description="Active standup already occurring!")
+    if standup_is_active(data['channels'][channel_index]['standup']):
+        raise InputError(description="Active standup already occurring!")
     
     # Raise AccessError is user is not part of the channel.
     if not user_is_member(user_id, data['channels'][channel_index]):
@@ -59,13 +62,17 @@ def standup_start(token, channel_id, length):
         'queued_messages': []
     }
 
+    mark_channel(channel_id)
     write_data(data)
 
     # Reset the StandUp Dict after 'length' seconds.
-    Timer(length, standUp_reset, args=(token, channel_id)).start()
+    scheduler.schedule(end_time, 'standup_reset', {
+        'channel_id': channel_id,
+        'time_finish': end_time
+    })
 
     return {
-        'time_finish': data['channels'][channel_index]['standup']['time_finish']
+        'time_finish': end_time
     }
 
 def standup_active(token, channel_id):
@@ -87,18 +94,26 @@ def standup_active(token, channel_id):
 
     channel_index = check_channel_id(channel_id)
 
-    is_active = data['channels'][channel_index]['standup']['is_active']
-    time_finish = data['channels'][channel_index]['standup']['time_finish']
+    # Worked out from time_finish, the reset only happens a moment after it.
+    standup = data['channels'][channel_index]['standup']
+    is_active = standup_is_active(standup)
     
     return {
         'is_active': is_active,
-        'time_finish': time_finish
+        'time_finish': standup['time_finish'] if is_active else None
     }
 
+def standup_is_active(standup):
+    '''
+    Returns whether a channel's standup dict is for a standup that hasn't finished yet.
+    '''
+    return standup['time_finish'] is not None and time.time() < standup['time_finish']
+
 def standup_send(token, channel_id, message):
     '''
     Sending a message to get buffered in the standup queue, 
-    assuming a standup is currently active.
+    assuming a standup is currently active. The queue is held in memory
+    and appended to config.standup_journal rather than written to the database.
 
     Arguments:
         token (string) - JWT token encrypted with user's u_id and session_id.
@@ -109,6 +124,7 @@ def standup_send(token, channel_id, message):
         InputError - Channel ID is not a valid channel.
         InputError - Message is more than 1000 characters (not including the username and colon).
         InputError - An active standup is not currently running in this channel.
+        InputError - The standup already holds config.standup_buffer_limit messages.
         AccessError - The authorised user is not a member of the channel that the message is within
 
     Return Value:
@@ -134,35 +150,46 @@ def standup_send(token, channel_id, message):
     
     username = get_user_dictionary(data['users'][user_index])['handle_str']
     formatted_msg = username + ": " + message
-    data['channels'][channel_index]['standup']['queued_messages'].append(formatted_msg)
-
-    write_data(data)
+    buffer_standup_line(channel_id, data['channels'][channel_index]['standup']['time_finish'], \
+        formatted_msg)
 
     return {
     }
 
-def standUp_reset(token, channel_id):
+def standUp_reset(channel_id, time_finish=None, token=None):
     '''
     Resets the StandUp dict after 'length' seconds have passed since
     the starting of a StandUp. Also directs all queued messages from 
-    the stand up into the channel.
+    the stand up into the channel. Run by the scheduler, which does nothing
+    if the standup finishing at time_finish has already been reset. Jobs saved
+    before the starter was taken from the standup itself also have a token,
+    which isn't needed.
     '''
     
     channel_index = check_channel_id(channel_id)
-    # Takes buffered messages and inserts them into channel "messages"
-    unqueue_messages(token, channel_id, channel_index)
-
-    # Reset StandUp Items after 'length' seconds.
-    standUp_clear(channel_index)
-
-def unqueue_messages(token, channel_id, channel_index):
+    if time_finish is not None and \
+        get_data()['channels'][channel_index]['standup']['time_finish'] != time_finish:
+        return
+    try:
+        # Takes buffered messages and inserts them into channel "messages"
+        unqueue_messages(channel_id, channel_index)
+    finally:
+        # Reset StandUp Items after 'length' seconds, even if the starter can't post any more.
+        standUp_clear(channel_index)
+
+def unqueue_messages(channel_id, channel_index):
     '''
-    Sends queued messages from standup into the actual messages list in channel.
+    Sends queued messages from standup into the actual messages list in channel,
+    from the user who started the standup.
     '''
     data = get_data()
 
-    standup_message = '\n'.join(data['channels'][channel_index]['standup']['queued_messages'])
-    message_send(token, channel_id, standup_message)
+    # Lines queued in the channel itself by an older version come first.
+    standup = data['channels'][channel_index]['standup']
+    lines = standup.get('queued_messages', []) + buffered_standup_lines(channel_id, standup['time_finish'])
+    standup_message = '\n'.join(lines)
+    message_send_as(standup['u_id'], channel_id, standup_message)
+    drop_standup_buffer(channel_id)
 
 def standUp_clear(channel_index):
     '''
@@ -177,4 +204,95 @@ def standUp_clear(channel_index):
         'queued_messages': []
     }
 
+    mark_channel(data['channels'][channel_index]['channel_id'])
     write_data(data)
+
+# --------------------------------------------------------------------------------------- #
+# ----------------------------- StandUp Buffer ------------------------------------------ #
+# --------------------------------------------------------------------------------------- #
+_buffer_lock = threading.Lock()
+
+_buffers = {
+    'data' : None,
+    # channel_id -> {'time_finish', 'lines'} of the standup running in it
+    'standups' : {},
+}
+
+def _standup_buffers():
+    '''
+    Returns the buffers for the current database. After a restart or reload
+    they are recovered from the journal, keeping only lines for standups
+    that are still waiting to be reset.
+    '''
+    data = get_data()
+    if _buffers['data'] is data:
+        return _buffers['standups']
+    _buffers['data'] = data
+    _buffers['standups'] = {}
+    try:
+        with open(config.standup_journal, 'r') as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the process died part way through this line
+                    break
+                channel_index = index.find_channel(entry['channel_id'])
+                if channel_index is not None and entry['time_finish'] == \
+                    data['channels'][channel_index]['standup']['time_finish']:
+                    _buffers['standups'].setdefault(entry['channel_id'], {
+                        'time_finish': entry['time_finish'],
+                        'lines': []
+                    })['lines'].append(entry['line'])
+    except FileNotFoundError:
+        pass
+    _rewrite_journal()
+    return _buffers['standups']
+
+def _rewrite_journal():
+    temp = config.standup_journal + '.tmp'
+    with open(temp, 'w') as journal:
+        for channel_id, standup in _buffers['standups'].items():
+            for line in standup['lines']:
+                journal.write(json.dumps({'channel_id': channel_id,
+                    'time_finish': standup['time_finish'], 'line': line}) + '\n')
+    os.replace(temp, config.standup_journal)
+
+def buffer_standup_line(channel_id, time_finish, line):
+    '''
+    Adds a line to the buffer of the standup finishing at time_finish,
+    writing it to the journal before it is accepted.
+    '''
+    with _buffer_lock:
+        standups = _standup_buffers()
+        standup = standups.get(channel_id)
+        if standup is None or standup['time_finish'] != time_finish:
+            standup = standups[channel_id] = {'time_finish': time_finish, 'lines': []}
+        if len(standup['lines']) >= config.standup_buffer_limit:
+            raise InputError(description="The standup queue is full!")
+        with open(config.standup_journal, 'a') as journal:
+            journal.write(json.dumps({'channel_id': channel_id, 'time_finish': time_finish,
+                'line': line}) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        standup['lines'].append(line)
+
+def buffered_standup_lines(channel_id, time_finish):
+    '''
+    Returns the lines buffered for the standup finishing at time_finish.
+    '''
+    with _buffer_lock:
+        standup = _standup_buffers().get(channel_id)
+        if standup is None or standup['time_finish'] != time_finish:
+            return []
+        return list(standup['lines'])
+
+def drop_standup_buffer(channel_id):
+    '''
+    Forgets the buffer of a channel once its standup has been sent.
+    '''
+    with _buffer_lock:
+        if _standup_buffers().pop(channel_id, None) is not None:
+            _rewrite_journal()
+
+scheduler.register('standup_reset', standUp_reset)
@@ -12,13 +12,8 @@ from src.error import AccessError, InputError
 from src.auth import check_token, check_u_id, get_data, write_data, \
     valid_email, valid_name, email_taken, handle_taken, get_data
 from src.helper import valid_handle, get_user_dictionary_for_user_profile, get_user_dictionary
-import urllib.request
-from PIL import Image
-import random 
-import os
-from src.config import url
-
-image_number = 0
+from src.data_store import mark_user
+from src import index, image_pipeline
 
 def user_profile(token, u_id):
     '''
@@ -94,6 +89,7 @@ def user_profile_setname(token, name_first, name_last):
         data = get_data()
         data['users'][user_index]['name_first'] = name_first
         data['users'][user_index]['name_last'] = name_last
+        mark_user(data['users'][user_index]['u_id'])
         write_data(data)
         
     return {}
@@ -124,6 +120,8 @@ def user_profile_setemail(token, email):
     else:
         data = get_data()
         data['users'][user_index]['email'] = email
+        index.update_user(user_index)
+        mark_user(data['users'][user_index]['u_id'])
         write_data(data)
         
     return {}
@@ -155,60 +153,40 @@ def user_profile_sethandle(token, handle_str):
     else:
         data = get_data()
         data['users'][user_index]['handle_str'] = handle_str
+        index.update_user(user_index)
+        mark_user(data['users'][user_index]['u_id'])
         write_data(data)
         
     return {}
 
 def user_profile_uploadphoto(token, img_url, x_start, y_start, x_end, y_end):
     '''
-    This function allows the user to crops image
+    Starts cropping the image at a url into the user's profile picture, the
+    image is fetched and cropped in the background by src.image_pipeline and
+    profile_img_url changes once it's done
+
     Arguments:
-        token(str)
-        img_url(str)
-        x_start(int)
-        y_start(int)
-        x_end(int)
-        y_end(int)
-    Returns:
-        None
+        token (string) - A jwt token for authorizing a user
+        img_url (string) - url of a jpg image
+        x_start, y_start, x_end, y_end (int) - the corners of the crop
+
+    Exceptions:
+        InputError  - Occurs when img_url isn't a jpg or the corners don't make a box
+        AccessError - Occurs when the token given is invalid
+
+    Return Value:
+        Returns an empty dictionary
     '''
-    #img_url returns an HTTP status other than 200.
-    if urllib.request.urlopen(img_url).getcode() != 200:
-        raise InputError(description='img_url returns an HTTP status other than 200')
     if img_url[-3:] != 'jpg':
         raise InputError(description='Image uploaded is not a JPG')
-
-    #getting the u_id and save their image based on their u_id
-    user_index = check_token(token)
-    data = get_data()
-    u_id = data['users'][user_index]['u_id']
-
-    global image_number
-    #Download the pic to the local file called "static"
-    profile_img_url = f"src/static/image{u_id}-{image_number}.jpg"
-    urllib.request.urlretrieve(img_url, profile_img_url)
-
-    #open the image
-    imageObject = Image.open(profile_img_url)
-
-    #Get the size
-    width, height = imageObject.size
-    if x_start > width or y_start > height or x_end > width or y_end > width:
-        #delelte the file
-        os.remove(profile_img_url)
+    if not 0 <= x_start < x_end or not 0 <= y_start < y_end:
         raise InputError(description='any of x_start, y_start, x_end, y_end are not within the dimension of the image at the URL')
 
-    cropped = imageObject.crop((x_start, y_start, x_end, y_end))
-    cropped.save(profile_img_url)
-    
-    #update the users' info related to the profile_img_url
-    data['users'][user_index]['profile_img_url'] = f"{url}/static/image{u_id}-{image_number}.jpg"
-    
-    image_number += 1
-    write_data(data)
+    user_index = check_token(token)
+    u_id = get_data()['users'][user_index]['u_id']
+    image_pipeline.upload(u_id, img_url, (x_start, y_start, x_end, y_end))
     return {}
 
-    
 def get_last_stat(key, user):
     return user[key][-1]['num_' + key]
 
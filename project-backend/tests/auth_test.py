@@ -7,10 +7,11 @@ Date:
 '''
 
 import pytest
+from src import auth, config
 from src.auth import auth_login, auth_register, get_data, \
-    auth_logout, auth_request_reset, auth_reset_password
-from src.other import clear
-from src.error import InputError
+    auth_logout, auth_request_reset, auth_reset_password, check_token
+from src.other import clear, admin_user_remove
+from src.error import InputError, AccessError
 
 @pytest.fixture
 def register_input():
@@ -190,3 +191,47 @@ def test_password_reset(login_input):
         auth_login(**login_input['user1'])
     login_input['user1']['password'] = 'newpassword'
     auth_login(**login_input['user1'])
+
+#test that a token that was checked before stops working once its session is gone
+def test_checked_token_revoked(login_input):
+    token = auth_login(**login_input['user1'])['token']
+    other = auth_login(**login_input['user1'])['token']
+    check_token(token)
+    auth_logout(token)
+    with pytest.raises(AccessError):
+        check_token(token)
+    check_token(other)
+    auth_reset_password(auth_request_reset(login_input['user1']['email']), 'newpassword')
+    with pytest.raises(AccessError):
+        check_token(other)
+
+#test that a removed user's checked tokens stop working
+def test_checked_token_removed_user(login_input):
+    owner = auth_login(**login_input['user1'])
+    token = auth_login(**login_input['user2'])['token']
+    u_id = check_token(token)
+    admin_user_remove(owner['token'], get_data()['users'][u_id]['u_id'])
+    with pytest.raises(AccessError):
+        check_token(token)
+
+#test that a logout racing a check doesn't leave the logged out token remembered
+def test_checked_token_logout_race(login_input, monkeypatch):
+    token = auth_login(**login_input['user1'])['token']
+    has_session = auth.index.has_session
+    def logout_after_check(position, session_id):
+        found = has_session(position, session_id)
+        monkeypatch.setattr(auth.index, 'has_session', has_session)
+        auth_logout(token)
+        return found
+    monkeypatch.setattr(auth.index, 'has_session', logout_after_check)
+    check_token(token)
+    with pytest.raises(AccessError):
+        check_token(token)
+
+#test that only the most recently used tokens are remembered
+def test_checked_token_limit(login_input, monkeypatch):
+    monkeypatch.setattr(config, 'token_cache_size', 2)
+    tokens = [auth_login(**login_input['user1'])['token'] for _ in range(3)]
+    for token in tokens + tokens[:1]:
+        check_token(token)
+    assert list(auth._tokens['checked']) == [tokens[2], tokens[0]]
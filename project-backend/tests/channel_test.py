@@ -7,15 +7,18 @@ Date:
     7 March 2021
 '''
 
+import copy
 import pytest
 
 from src.error import InputError, AccessError
 from src.auth import auth_register
 from src.other import clear
 from src.channels import channels_list, channels_create
-from src.channel import channel_messages, channel_invite, channel_details, channel_join, channel_addowner, channel_removeowner
-from src.user import user_profile
-from src.message import message_send
+from src.channel import channel_messages, channel_messages_changes, channel_invite, channel_invite_many, channel_details, channel_join, channel_addowner, channel_removeowner
+from src.user import user_profile, user_stats
+from src.other import notifications_get
+from src.message import message_send, message_edit, message_remove, message_pin, message_react
+from src import data_store
 
 @pytest.fixture(name='create_users_channels')
 def fixture_create_users_channels():
@@ -250,6 +253,107 @@ def test_channel_messages_invalid_token(create_users_channels):
     with pytest.raises(AccessError):
         channel_messages(channels['user2']['token'], new_pub_channel['channel_id'], 0)
 
+def test_channel_messages_cursor(create_users_channels):
+    '''
+    Tests that paging by message id walks back through every message once, newest first,
+    even when new messages arrive between pages
+    '''
+    channels = create_users_channels
+    token = channels['user1']['token']
+    ids = [message_send(token, channels['pub_channel'], str(i))['message_id'] for i in range(5)]
+
+    page = channel_messages(token, channels['pub_channel'], page_size=2)
+    assert [message['message_id'] for message in page['messages']] == [ids[4], ids[3]]
+    assert page['after_message_id'] == ids[4]
+    newer = message_send(token, channels['pub_channel'], 'newer')['message_id']
+
+    page = channel_messages(token, channels['pub_channel'], before_message_id=page['before_message_id'],
+        page_size=2)
+    assert [message['message_id'] for message in page['messages']] == [ids[2], ids[1]]
+    page = channel_messages(token, channels['pub_channel'], before_message_id=page['before_message_id'],
+        page_size=2)
+    assert [message['message_id'] for message in page['messages']] == [ids[0]]
+    assert page['before_message_id'] == -1
+
+    page = channel_messages(token, channels['pub_channel'], after_message_id=ids[4])
+    assert [message['message_id'] for message in page['messages']] == [newer]
+    page = channel_messages(token, channels['pub_channel'], after_message_id=newer)
+    assert page['messages'] == []
+    assert page['after_message_id'] == newer
+
+def test_channel_messages_before_oldest(create_users_channels):
+    '''
+    Tests that the empty page before the oldest message doesn't hand back a cursor
+    that skips messages
+    '''
+    channels = create_users_channels
+    token = channels['user1']['token']
+    ids = [message_send(token, channels['pub_channel'], str(i))['message_id'] for i in range(5)]
+
+    page = channel_messages(token, channels['pub_channel'], before_message_id=ids[0])
+    assert page == {'messages' : [], 'before_message_id' : -1, 'after_message_id' : -1}
+
+def test_channel_messages_cursor_invalid(create_users_channels):
+    '''
+    Tests that paging from a message in another channel, from both directions at once or
+    with an empty page returns an Input error
+    '''
+    channels = create_users_channels
+    token = channels['user1']['token']
+    message_id = message_send(token, channels['priv_channel'], 'private')['message_id']
+
+    with pytest.raises(InputError):
+        channel_messages(token, channels['pub_channel'], before_message_id=message_id)
+    with pytest.raises(InputError):
+        channel_messages(token, channels['priv_channel'], before_message_id=message_id,
+            after_message_id=message_id)
+    with pytest.raises(InputError):
+        channel_messages(token, channels['priv_channel'], page_size=0)
+
+def test_channel_messages_changes(create_users_channels):
+    '''
+    Tests that only the messages sent, edited, removed, pinned or reacted to since the
+    returned change_seq come back
+    '''
+    channels = create_users_channels
+    token = channels['user1']['token']
+    ids = [message_send(token, channels['pub_channel'], str(i))['message_id'] for i in range(4)]
+    message_send(token, channels['priv_channel'], 'elsewhere')
+
+    changes = channel_messages_changes(token, channels['pub_channel'], 0)
+    assert [message['message_id'] for message in changes['messages']] == ids[::-1]
+    assert not changes['reset']
+    since = changes['change_seq']
+    assert channel_messages_changes(token, channels['pub_channel'], since)['messages'] == []
+
+    message_edit(token, ids[0], 'edited')
+    message_pin(token, ids[1])
+    message_react(token, ids[1], 1)
+    message_remove(token, ids[2])
+    changes = channel_messages_changes(token, channels['pub_channel'], since)
+    assert [(message['message_id'], message['message']) for message in changes['messages']] == \
+        [(ids[1], '1'), (ids[0], 'edited')]
+    assert changes['removed_message_ids'] == [ids[2]]
+    assert changes['change_seq'] > since
+
+def test_channel_messages_changes_reset(create_users_channels):
+    '''
+    Tests that a client asking from before the server last loaded its data is told to
+    fetch the messages again, and that a non-member can't ask at all
+    '''
+    channels = create_users_channels
+    token = channels['user1']['token']
+    message_send(token, channels['pub_channel'], 'before')
+    # a reload hands out a new copy of the same data
+    data_store.set_store(copy.deepcopy(data_store.get_store()))
+    changes = channel_messages_changes(token, channels['pub_channel'], 0)
+    assert changes['reset']
+    message_id = message_send(token, channels['pub_channel'], 'after')['message_id']
+    changes = channel_messages_changes(token, channels['pub_channel'], changes['change_seq'])
+    assert [message['message_id'] for message in changes['messages']] == [message_id]
+    with pytest.raises(AccessError):
+        channel_messages_changes(channels['user2']['token'], channels['priv_channel'], 0)
+
 def test_channel_join_public(create_users_channels):
     '''
     Tests channel_join adds a user to a channel
@@ -314,6 +418,36 @@ def test_channel_invite_already_member(create_users_channels):
     with pytest.raises(InputError):
         channel_invite(user1, channels['pub_channel'], user2)
 
+def test_channel_invite_many(create_users_channels):
+    '''
+    Tests that a batch of users are all added, notified and counted in their stats
+    '''
+    channels = create_users_channels
+    token = channels['user1']['token']
+    others = [auth_register(f'other{i}@email.com', 'password', 'other', 'user') for i in range(3)]
+    channel_invite_many(token, channels['pub_channel'], [user['auth_user_id'] for user in others])
+
+    members = channel_details(token, channels['pub_channel'])['all_members']
+    assert [member['u_id'] for member in members][1:] == [user['auth_user_id'] for user in others]
+    for user in others:
+        assert len(notifications_get(user['token'])['notifications']) == 1
+        stats = user_stats(user['token'])['user_stats']
+        assert stats['channels_joined'][-1]['num_channels_joined'] == 1
+
+def test_channel_invite_many_all_or_nothing(create_users_channels):
+    '''
+    Tests that no one is added when one of the users in a batch can't be
+    '''
+    channels = create_users_channels
+    token = channels['user1']['token']
+    other = auth_register('other@email.com', 'password', 'other', 'user')
+    with pytest.raises(InputError):
+        channel_invite_many(token, channels['pub_channel'], [other['auth_user_id'],
+            channels['user1']['auth_user_id']])
+    with pytest.raises(InputError):
+        channel_invite_many(token, channels['pub_channel'], [other['auth_user_id']] * 2)
+    assert len(channel_details(token, channels['pub_channel'])['all_members']) == 1
+
 def test_channel_addowner(create_users_channels):
     channels = create_users_channels
     channel_invite(channels['user1']['token'], channels['pub_channel'], channels['user2']['auth_user_id'])
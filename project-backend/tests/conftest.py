@@ -0,0 +1,45 @@
+'''
+Runs every test against both the json file and the SQLite storage backends,
+and provides fixtures shared between test files.
+'''
+
+import functools
+import http.server
+import threading
+import pytest
+from PIL import Image
+
+from src import config, data_store
+
+@pytest.fixture(autouse=True, params=['snapshot', 'sqlite'])
+def storage_mode(request, monkeypatch, tmp_path):
+    monkeypatch.setattr(config, 'storage_mode', request.param)
+    monkeypatch.setattr(config, 'db_file', str(tmp_path / 'data.sqlite'))
+    data_store.load_data()
+    return request.param
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def image_server(tmp_path, monkeypatch):
+    '''
+    Serves a 300x200 jpg and some other files from a local http server, and
+    saves uploaded pictures to a temporary directory
+    '''
+    served = tmp_path / 'served'
+    served.mkdir()
+    Image.new('RGB', (300, 200), (255, 0, 0)).save(served / 'picture.jpg')
+    (served / 'notanimage.jpg').write_text('not an image')
+    uploads = tmp_path / 'uploads'
+    uploads.mkdir()
+    monkeypatch.setattr(config, 'image_dir', str(uploads))
+
+    handler = functools.partial(QuietHandler, directory=str(served))
+    server = http.server.ThreadingHTTPServer(('localhost', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://localhost:{server.server_address[1]}", uploads
+    server.shutdown()
+    server.server_close()
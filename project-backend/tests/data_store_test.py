@@ -0,0 +1,255 @@
+'''
+Tests for the resident data store behind get_data and write_data.
+'''
+
+import copy
+import json
+import os
+import pytest
+import threading
+import time
+
+from src import config, data_store
+from src.auth import auth_register, get_data, write_data
+from src.channels import channels_create
+from src.message import message_send, message_remove
+from src.user import user_profile_setname
+from src.other import clear
+
+@pytest.fixture
+def user():
+    clear()
+    return auth_register("email@email.com", "password", "firstname", "lastname")
+
+@pytest.fixture
+def snapshot_only(storage_mode):
+    if storage_mode != 'snapshot':
+        pytest.skip('only the snapshot mode writes config.data_file')
+
+def read_file():
+    with open(config.data_file, 'r') as datafile:
+        return json.load(datafile)
+
+#test that every call shares the one resident dictionary
+def test_get_data_is_resident(user):
+    assert get_data() is get_data()
+    assert get_data()['users'][0]['u_id'] == user['auth_user_id']
+
+#test that clear writes an empty database straight to disk
+def test_clear_flushes(snapshot_only):
+    clear()
+    assert read_file()['users'] == []
+
+#test that writes are held in memory until the store is flushed
+def test_write_behind(snapshot_only, user, monkeypatch):
+    monkeypatch.setattr(config, 'flush_interval', 60)
+    data_store.flush_data()
+    monkeypatch.setitem(data_store._store, 'last_flush', time.time())
+    data = get_data()
+    data['users'][0]['name_first'] = 'changed'
+    write_data(data)
+    assert read_file()['users'][0]['name_first'] == 'firstname'
+    data_store.flush_data()
+    assert read_file()['users'][0]['name_first'] == 'changed'
+
+#test that a reload picks up what was flushed
+def test_reload(user):
+    data_store.flush_data()
+    data = data_store.load_data()
+    assert data['users'][0]['email'] == 'email@email.com'
+    assert get_data() is data
+
+@pytest.fixture
+def log_mode(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, 'storage_mode', 'log')
+    monkeypatch.setattr(config, 'data_file', str(tmp_path / 'data.json'))
+    monkeypatch.setattr(config, 'log_file', str(tmp_path / 'data.log'))
+    clear()
+    yield tmp_path
+    data_store.compact_log()
+
+def read_log():
+    with open(config.log_file, 'r') as logfile:
+        return [json.loads(line) for line in logfile]
+
+#test that changes are appended to the log rather than rewriting the snapshot
+def test_log_appends_records(log_mode):
+    user = auth_register("email@email.com", "password", "firstname", "lastname")
+    channel_id = channels_create(user['token'], 'channel', True)['channel_id']
+    message_send(user['token'], channel_id, 'hello')
+    assert read_file()['users'] == []
+    records = read_log()
+    assert {'user', 'channel', 'message'} <= {record['type'] for record in records}
+
+#test that loading replays the log on top of the snapshot
+def test_log_replay(log_mode):
+    user = auth_register("email@email.com", "password", "firstname", "lastname")
+    channel_id = channels_create(user['token'], 'channel', True)['channel_id']
+    message_id = message_send(user['token'], channel_id, 'hello')['message_id']
+    message_send(user['token'], channel_id, 'world')
+    message_remove(user['token'], message_id)
+    user_profile_setname(user['token'], 'new', 'name')
+
+    data = data_store.load_data()
+    assert data['users'][0]['name_first'] == 'new'
+    assert [message['message'] for message in data['channels'][0]['messages']] == ['world']
+    assert data['messages_exist'][-1]['num_messages_exist'] == 1
+
+#test that a send logs the new stats entry rather than the sender's whole history
+def test_log_user_series(log_mode):
+    user = auth_register("email@email.com", "password", "firstname", "lastname")
+    channel_id = channels_create(user['token'], 'channel', True)['channel_id']
+    for i in range(20):
+        message_send(user['token'], channel_id, str(i))
+    logged = len(read_log())
+    message_send(user['token'], channel_id, 'last')
+    records = read_log()[logged:]
+    assert [(record['key'], record['index']) for record in records \
+        if record['type'] == 'user_series'] == [('messages_sent', 21)]
+    assert all('messages_sent' not in record['value'] for record in records \
+        if record['type'] == 'user')
+    expected = copy.deepcopy(get_data()['users'])
+    assert data_store.load_data()['users'] == expected
+
+#test that a list that has entries taken out is logged whole when it changes
+def test_log_root_set(log_mode):
+    data = get_data()
+    data['scheduled'] = [{'job_id' : 1}]
+    write_data(data)
+    data['scheduled'] = [{'job_id' : 2}]
+    write_data(data)
+    assert [record['value'] for record in read_log() if record.get('key') == 'scheduled'] == \
+        [[{'job_id' : 1}], [{'job_id' : 2}]]
+    assert data_store.load_data()['scheduled'] == [{'job_id' : 2}]
+
+#test that compaction folds the log into the snapshot
+def test_log_compaction(log_mode):
+    auth_register("email@email.com", "password", "firstname", "lastname")
+    data_store.compact_log()
+    assert read_file()['users'][0]['email'] == 'email@email.com'
+    assert not os.path.exists(config.log_file)
+    assert data_store.load_data()['users'][0]['email'] == 'email@email.com'
+
+#test that a record cut off part way through is ignored on recovery
+def test_log_torn_record(log_mode):
+    auth_register("email@email.com", "password", "firstname", "lastname")
+    with open(config.log_file, 'a') as logfile:
+        logfile.write('{"type" : "us')
+    data = data_store.load_data()
+    assert len(data['users']) == 1
+    auth_register("email1@email.com", "password", "firstname", "lastname")
+    assert len(data_store.load_data()['users']) == 2
+
+#test that writes made during a request are committed once when it ends
+def test_unit_of_work_commits_once(user, monkeypatch):
+    commits = []
+    monkeypatch.setattr(data_store, 'commit', commits.append)
+    data_store.begin_request()
+    channels_create(user['token'], 'channel', True)
+    user_profile_setname(user['token'], 'new', 'name')
+    assert commits == []
+    counts = data_store.end_request()
+    assert commits == [get_data()]
+    assert counts['writes'] >= 2
+    assert counts['commits'] == 1
+    assert counts['reads'] >= 2
+
+#test that marking from another thread never breaks a commit that is collecting marks
+def test_marks_threads(user, storage_mode):
+    if storage_mode != 'sqlite':
+        pytest.skip('marks are only kept in the sqlite and log modes')
+    stop = threading.Event()
+    def mark():
+        while not stop.is_set():
+            data_store.mark_user(user['auth_user_id'])
+    thread = threading.Thread(target=mark)
+    thread.start()
+    try:
+        for i in range(50):
+            user_profile_setname(user['token'], 'name', str(i))
+    finally:
+        stop.set()
+        thread.join()
+    assert data_store.load_data()['users'][0]['name_last'] == '49'
+
+#test that a request's marks are only committed by the request itself
+def test_marks_kept_with_request(user, storage_mode):
+    if storage_mode != 'sqlite':
+        pytest.skip('marks are only kept in the sqlite and log modes')
+    data_store.begin_request()
+    user_profile_setname(user['token'], 'new', 'name')
+    result = {}
+    def other_request():
+        result['records'] = data_store.collect_records(get_data())
+    thread = threading.Thread(target=other_request)
+    thread.start()
+    thread.join()
+    assert result['records'] == []
+    data_store.end_request()
+    assert data_store.load_data()['users'][0]['name_first'] == 'new'
+
+#test that a request which only reads commits nothing
+def test_unit_of_work_read_only(user):
+    data_store.begin_request()
+    get_data()
+    assert data_store.end_request() == {'reads' : 1, 'writes' : 0, 'commits' : 0}
+    assert data_store.end_request() is None
+
+#test that the server reports the storage counts of each request
+def test_unit_of_work_headers(user):
+    from src.server import APP
+    response = APP.test_client().post('/channels/create/v2', json={
+        'token' : user['token'], 'name' : 'channel', 'is_public' : True})
+    assert int(response.headers['X-Storage-Writes']) >= 1
+    assert response.headers['X-Storage-Commits'] == '1'
+    assert len(get_data()['channels']) == 1
+
+#test that flushing replaces the file in one rename and leaves no temporary file behind
+def test_flush_atomic(snapshot_only, user):
+    data_store.flush_data()
+    inode = os.stat(config.data_file).st_ino
+    data = get_data()
+    data['users'][0]['name_first'] = 'changed'
+    write_data(data)
+    data_store.flush_data()
+    assert os.stat(config.data_file).st_ino != inode
+    assert not os.path.exists(config.data_file + '.tmp')
+
+#test that loading an unchanged file keeps the resident copy and a changed one is parsed
+def test_reload_skips_unchanged(snapshot_only, user):
+    data_store.flush_data()
+    data = data_store.load_data()
+    assert data_store.load_data() is data
+    on_disk = read_file()
+    on_disk['users'][0]['name_first'] = 'edited'
+    with open(config.data_file, 'w') as datafile:
+        json.dump(on_disk, datafile)
+    assert data_store.load_data()['users'][0]['name_first'] == 'edited'
+
+#test that ids are not handed out again once what they belonged to is removed
+def test_ids_not_reused(user):
+    channel_id = channels_create(user['token'], 'channel', True)['channel_id']
+    message_id = message_send(user['token'], channel_id, 'hello')['message_id']
+    message_remove(user['token'], message_id)
+    assert message_send(user['token'], channel_id, 'hello')['message_id'] == message_id + 1
+
+#test that sequences survive a reload and are seeded for databases without them
+def test_sequences_persisted(user):
+    data_store.flush_data()
+    data = data_store.load_data()
+    assert data['sequences']['u_id'] == user['auth_user_id']
+    del data['sequences']
+    assert data_store.next_id('u_id') == user['auth_user_id'] + 1
+
+#test that concurrent allocations never share an id
+def test_next_id_threads(user):
+    ids = []
+    def allocate():
+        for _ in range(200):
+            ids.append(data_store.next_id('message_id'))
+    threads = [threading.Thread(target=allocate) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(ids)) == 800
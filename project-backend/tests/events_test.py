@@ -0,0 +1,78 @@
+'''
+Tests for the events/v1 long-poll.
+'''
+
+import threading
+import time
+import pytest
+
+from src import events
+from src.auth import auth_register
+from src.channels import channels_create
+from src.channel import channel_invite
+from src.message import message_send, message_edit
+from src.channel import channel_messages_changes
+from src.other import clear, events_get, admin_user_remove
+
+@pytest.fixture
+def users():
+    clear()
+    user1 = auth_register("email1@email.com", "password", "first", "user")
+    user2 = auth_register("email2@email.com", "password", "second", "user")
+    channel_id = channels_create(user1['token'], 'channel', True)['channel_id']
+    return user1, user2, channel_id
+
+def send_after(delay, *args):
+    timer = threading.Timer(delay, message_send, args)
+    timer.start()
+    return timer
+
+#test that a waiting client is answered as soon as a message is sent, not when it times out
+def test_woken_by_message(users):
+    user1, _, channel_id = users
+    since = events_get(user1['token'], timeout=0)['event_id']
+    send_after(0.2, user1['token'], channel_id, 'hello')
+    start = time.time()
+    resp = events_get(user1['token'], since, timeout=5)
+    assert time.time() - start < 2
+    assert [(event['type'], event['channel_id']) for event in resp['events']] == \
+        [('message', channel_id)]
+    assert resp['event_id'] == resp['events'][0]['event_id']
+    assert not resp['reset']
+
+#test that users only get events for their own channels and notifications
+def test_only_own_events(users):
+    user1, user2, channel_id = users
+    since = events_get(user2['token'], timeout=0)['event_id']
+    message_id = message_send(user1['token'], channel_id, 'hello')['message_id']
+    assert events_get(user2['token'], since, timeout=0.1)['events'] == []
+    channel_invite(user1['token'], channel_id, user2['auth_user_id'])
+    message_edit(user1['token'], message_id, 'edited')
+    resp = events_get(user2['token'], since, timeout=0)
+    assert [event['type'] for event in resp['events']] == ['notification', 'message']
+    assert resp['events'][1]['message_id'] == message_id
+
+#test that clients that can't have seen every event since are told to reset
+def test_reset(users, monkeypatch):
+    user1, _, channel_id = users
+    monkeypatch.setattr(events.config, 'event_buffer_limit', 2)
+    since = events_get(user1['token'], timeout=0)['event_id']
+    for i in range(3):
+        message_send(user1['token'], channel_id, str(i))
+    resp = events_get(user1['token'], since, timeout=0)
+    assert resp['reset']
+    assert resp['events'] == []
+    assert not events_get(user1['token'], resp['event_id'], timeout=0)['reset']
+
+#test that removing a user tells clients about the messages rewritten to 'Removed user'
+def test_removed_user_messages(users):
+    user1, user2, channel_id = users
+    channel_invite(user1['token'], channel_id, user2['auth_user_id'])
+    message_id = message_send(user2['token'], channel_id, 'hello')['message_id']
+    change_seq = channel_messages_changes(user1['token'], channel_id, 0)['change_seq']
+    since = events_get(user1['token'], timeout=0)['event_id']
+    admin_user_remove(user1['token'], user2['auth_user_id'])
+    assert [event['message_id'] for event in events_get(user1['token'], since, timeout=0)['events'] \
+        if event['type'] == 'message'] == [message_id]
+    changes = channel_messages_changes(user1['token'], channel_id, change_seq)
+    assert [message['message'] for message in changes['messages']] == ['Removed user']
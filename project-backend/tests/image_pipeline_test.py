@@ -0,0 +1,85 @@
+'''
+Tests for the background pipeline behind user/profile/uploadphoto.
+'''
+
+import os
+import time
+import pytest
+from PIL import Image
+
+from src import config, image_pipeline
+from src.auth import auth_register, get_data
+from src.user import user_profile, user_profile_uploadphoto
+from src.other import clear
+from src.error import InputError
+
+@pytest.fixture
+def user():
+    clear()
+    return auth_register("email@email.com", "password", "firstname", "lastname")
+
+def logged(caplog, text):
+    return any(text in record.getMessage() and record.exc_info \
+        for record in caplog.records if record.name == 'src.image_pipeline')
+
+def profile_img_url(user):
+    return user_profile(user['token'], user['auth_user_id'])['user']['profile_img_url']
+
+#test that the crop is saved and becomes the profile picture once it's done
+def test_upload(image_server, user):
+    base, uploads = image_server
+    before = profile_img_url(user)
+    assert user_profile_uploadphoto(user['token'], f"{base}/picture.jpg", 10, 20, 110, 70) == {}
+    new_url = image_pipeline.wait(user['auth_user_id'], timeout=10)
+    assert profile_img_url(user) == new_url != before
+    name = new_url.rsplit('/', 1)[1]
+    with Image.open(uploads / name) as image:
+        assert image.size == (100, 50)
+    # the downloaded original isn't left behind
+    assert os.listdir(uploads) == [name]
+
+#test that image names carry on from the saved sequence rather than starting again
+def test_names_not_reused(image_server, user):
+    base, _ = image_server
+    user_profile_uploadphoto(user['token'], f"{base}/picture.jpg", 0, 0, 10, 10)
+    first = image_pipeline.wait(user['auth_user_id'], timeout=10)
+    user_profile_uploadphoto(user['token'], f"{base}/picture.jpg", 0, 0, 10, 10)
+    second = image_pipeline.wait(user['auth_user_id'], timeout=10)
+    assert first != second
+    assert get_data()['sequences']['image_id'] == 2
+
+#test that problems found in the background leave the picture alone
+def test_background_errors(image_server, user):
+    base, uploads = image_server
+    before = profile_img_url(user)
+    for img_url, box in [(f"{base}/picture.jpg", (0, 0, 301, 50)),
+            (f"{base}/picture.jpg", (0, 0, 50, 201)),
+            (f"{base}/missing.jpg", (0, 0, 10, 10)),
+            (f"{base}/notanimage.jpg", (0, 0, 10, 10))]:
+        user_profile_uploadphoto(user['token'], img_url, *box)
+        with pytest.raises(InputError):
+            image_pipeline.wait(user['auth_user_id'], timeout=10)
+    assert profile_img_url(user) == before
+    assert os.listdir(uploads) == []
+
+#test that failures nobody waits for are logged, and crops run in spawned processes
+def test_background_errors_logged(image_server, user, caplog):
+    base, _ = image_server
+    user_profile_uploadphoto(user['token'], f"{base}/missing.jpg", 0, 0, 10, 10)
+    with pytest.raises(InputError):
+        image_pipeline.wait(user['auth_user_id'], timeout=10)
+    # the callback runs just after waiters are woken
+    end = time.time() + 3
+    while not logged(caplog, 'missing.jpg') and time.time() < end:
+        time.sleep(0.01)
+    assert logged(caplog, 'missing.jpg')
+    assert image_pipeline._pipeline['croppers']._mp_context.get_start_method() == 'spawn'
+
+#test that the crop also works without the process pool
+def test_crop_in_thread(image_server, user, monkeypatch):
+    base, _ = image_server
+    monkeypatch.setattr(config, 'image_crop_workers', 0)
+    monkeypatch.setitem(image_pipeline._pipeline, 'croppers', None)
+    user_profile_uploadphoto(user['token'], f"{base}/picture.jpg", 0, 0, 10, 10)
+    new_url = image_pipeline.wait(user['auth_user_id'], timeout=10)
+    assert profile_img_url(user) == new_url
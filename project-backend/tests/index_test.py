@@ -0,0 +1,191 @@
+'''
+Tests for the hash indexes over the resident database.
+'''
+
+import pytest
+
+from src import config, index
+from src.auth import auth_register, auth_request_reset, auth_reset_password, get_data, \
+    new_hash
+from src.user import user_profile_setemail, user_profile_sethandle
+from src.other import clear, admin_user_remove
+from src.channels import channels_create
+from src.channel import channel_join, channel_leave, channel_addowner, channel_removeowner
+from src.dm import dm_create, dm_leave, dm_remove
+from src.message import message_send, message_senddm, message_remove, message_edit, message_react
+
+@pytest.fixture
+def users():
+    clear()
+    user1 = auth_register("email1@email.com", "password", "first", "user")
+    user2 = auth_register("email2@email.com", "password", "second", "user")
+    return user1, user2
+
+#test that every indexed field finds the right user
+def test_find_user(users):
+    _, user2 = users
+    position = index.find_user('u_id', user2['auth_user_id'])
+    assert get_data()['users'][position]['u_id'] == user2['auth_user_id']
+    assert index.find_user('email', 'email2@email.com') == position
+    assert index.find_user('handle_str', 'seconduser') == position
+    assert index.find_user('email', 'nobody@email.com') is None
+
+#test that changing an email or handle moves the user to the new key
+def test_update_email_handle(users):
+    user1, _ = users
+    user_profile_setemail(user1['token'], 'changed@email.com')
+    user_profile_sethandle(user1['token'], 'newhandle')
+    assert index.find_user('email', 'email1@email.com') is None
+    assert index.find_user('handle_str', 'firstuser') is None
+    assert index.find_user('email', 'changed@email.com') == 0
+    assert index.find_user('handle_str', 'newhandle') == 0
+
+#test that reset codes are indexed until they are used
+def test_reset_code(users):
+    reset_code = auth_request_reset('email2@email.com')
+    assert index.find_user('reset_code', new_hash(reset_code)) == 1
+    auth_reset_password(reset_code, 'newpassword')
+    assert index.find_user('reset_code', new_hash(reset_code)) is None
+
+#test that removed users can still be found by id
+def test_removed_user(users):
+    user1, user2 = users
+    admin_user_remove(user1['token'], user2['auth_user_id'])
+    assert index.find_user('u_id', user2['auth_user_id']) == 1
+
+#test that the index is rebuilt when the store hands out a new database
+def test_rebuilt_on_clear(users):
+    clear()
+    assert index.find_user('email', 'email2@email.com') is None
+    auth_register("email2@email.com", "password", "second", "user")
+    assert index.find_user('email', 'email2@email.com') == 0
+
+@pytest.fixture
+def channels(users):
+    user1, user2 = users
+    channel_id = channels_create(user1['token'], 'channel', True)['channel_id']
+    dm_id = dm_create(user1['token'], [user2['auth_user_id']])['dm_id']
+    return channel_id, dm_id
+
+#test that channels are found by id and members by the channels they joined
+def test_find_channel(users, channels):
+    user1, user2 = users
+    channel_id, dm_id = channels
+    assert get_data()['channels'][index.find_channel(dm_id)]['channel_id'] == dm_id
+    assert index.find_channel(999) is None
+    assert index.user_channels(user1['auth_user_id']) == {channel_id, dm_id}
+    assert index.user_channels(user2['auth_user_id']) == {dm_id}
+    assert index.channel_owners(channel_id) == {user1['auth_user_id']}
+
+#test that joining, leaving and owner changes keep the membership sets up to date
+def test_membership_updates(users, channels):
+    user1, user2 = users
+    channel_id, _ = channels
+    u_id2 = user2['auth_user_id']
+    channel_join(user2['token'], channel_id)
+    assert index.is_member(u_id2, channel_id)
+    channel_leave(user2['token'], channel_id)
+    assert channel_id not in index.user_channels(u_id2)
+    channel_addowner(user1['token'], channel_id, u_id2)
+    assert index.is_owner(u_id2, channel_id)
+    assert index.is_member(u_id2, channel_id)
+    channel_removeowner(user1['token'], channel_id, u_id2)
+    assert not index.is_owner(u_id2, channel_id)
+
+#test that removing a dm drops it and moves the channels after it
+def test_remove_channel(users, channels):
+    user1, user2 = users
+    channel_id, dm_id = channels
+    other_id = channels_create(user1['token'], 'other', True)['channel_id']
+    dm_remove(user1['token'], dm_id)
+    assert index.find_channel(dm_id) is None
+    assert get_data()['channels'][index.find_channel(other_id)]['channel_id'] == other_id
+    assert index.user_channels(user2['auth_user_id']) == set()
+
+def message_at(found):
+    channel_index, message_index = found
+    return get_data()['channels'][channel_index]['messages'][message_index]
+
+#test that messages are found in whichever channel or dm they were sent to
+def test_find_message(users, channels):
+    user1, _ = users
+    channel_id, dm_id = channels
+    first = message_send(user1['token'], channel_id, 'first')['message_id']
+    second = message_senddm(user1['token'], dm_id, 'second')['message_id']
+    assert message_at(index.find_message(first))['message'] == 'first'
+    assert message_at(index.find_message(second))['message'] == 'second'
+    assert index.find_message(999) is None
+    message_react(user1['token'], first, 1)
+    assert message_at(index.find_message(first))['reacts'][0]['u_ids'] == [user1['auth_user_id']]
+
+#test that removing or emptying a message moves the ones after it
+def test_message_removed(users, channels):
+    user1, _ = users
+    channel_id, _ = channels
+    ids = [message_send(user1['token'], channel_id, str(i))['message_id'] for i in range(4)]
+    message_remove(user1['token'], ids[0])
+    message_edit(user1['token'], ids[2], '')
+    assert index.find_message(ids[0]) is None
+    assert index.find_message(ids[2]) is None
+    assert message_at(index.find_message(ids[1]))['message'] == '1'
+    assert message_at(index.find_message(ids[3]))['message'] == '3'
+
+#test that the messages of a removed dm go with it
+def test_dm_messages_removed(users, channels):
+    user1, _ = users
+    channel_id, dm_id = channels
+    in_dm = message_senddm(user1['token'], dm_id, 'dm')['message_id']
+    dm_remove(user1['token'], dm_id)
+    assert index.find_message(in_dm) is None
+    in_channel = message_send(user1['token'], channel_id, 'channel')['message_id']
+    assert message_at(index.find_message(in_channel))['message'] == 'channel'
+
+#test that membership changes are remembered until the stats take them
+def test_stale_members(users, channels):
+    user1, user2 = users
+    channel_id, dm_id = channels
+    channel_join(user2['token'], channel_id)
+    assert index.joined_counts(user2['auth_user_id']) == (1, 1)
+    # joining updated the stats straight away, leaving a dm doesn't
+    assert index.take_stale_members() == set()
+    dm_leave(user2['token'], dm_id)
+    assert index.take_stale_members() == {user2['auth_user_id']}
+    dm_remove(user1['token'], dm_id)
+    assert index.take_stale_members() == {user1['auth_user_id']}
+    assert index.channel_counts() == (1, 0)
+
+#test that the message count follows sends and removes
+def test_message_count(users, channels):
+    user1, _ = users
+    channel_id, dm_id = channels
+    message_id = message_send(user1['token'], channel_id, 'hello')['message_id']
+    message_senddm(user1['token'], dm_id, 'hello')
+    assert index.message_count() == 2
+    message_remove(user1['token'], message_id)
+    dm_remove(user1['token'], dm_id)
+    assert index.message_count() == 0
+
+#test that the change log forgets the oldest changes past its limit
+def test_change_log_limit(users, channels, monkeypatch):
+    user1, _ = users
+    channel_id, _ = channels
+    monkeypatch.setattr(config, 'change_log_limit', 2)
+    ids = [message_send(user1['token'], channel_id, str(i))['message_id'] for i in range(3)]
+    changed, latest = index.changes_since(channel_id, 0)
+    assert changed is None
+    changed, latest = index.changes_since(channel_id, latest - 2)
+    assert changed == set(ids[1:])
+
+#test that each user's messages are found without looking through anyone else's
+def test_user_messages(users, channels):
+    user1, user2 = users
+    channel_id, dm_id = channels
+    first = message_send(user1['token'], channel_id, 'first')['message_id']
+    in_dm = message_senddm(user2['token'], dm_id, 'dm')['message_id']
+    second = message_send(user1['token'], channel_id, 'second')['message_id']
+    assert index.user_messages(user1['auth_user_id']) == {first, second}
+    assert index.user_messages(user2['auth_user_id']) == {in_dm}
+    message_remove(user1['token'], first)
+    dm_remove(user1['token'], dm_id)
+    assert index.user_messages(user1['auth_user_id']) == {second}
+    assert index.user_messages(user2['auth_user_id']) == set()
@@ -451,12 +451,14 @@ def test_message_share_valid(users, dm_ids):
     assert msg_list1['messages'][0]['message'] == 'Original Message, Hey'
 
     assert shared_channel_msg_id2 == 3
-    assert msg_list2['messages'][0]['message_id'] == shared_channel_msg_id2
-    assert msg_list2['messages'][0]['message'] == 'Original Message, Hi, COMP1531'
-
-    assert shared_dm_msg_id3 == 3
-    assert msg_list3['messages'][1]['message_id'] == shared_dm_msg_id3
+    assert msg_list3['messages'][1]['message_id'] == shared_channel_msg_id2
     assert msg_list3['messages'][1]['message'] == 'Original Message, Hi'
+
+    # Ids are never handed out twice, so the dm message shared back is its own message
+    assert og_msg_id2 == 4
+    assert shared_dm_msg_id3 == 5
+    assert msg_list2['messages'][0]['message_id'] == shared_dm_msg_id3
+    assert msg_list2['messages'][0]['message'] == 'Og Message, COMP1531'
     
 def test_message_share_channel_access_error(users):
     '''
@@ -11,7 +11,9 @@ import pytest
 import jwt
 
 from src.error import InputError, AccessError
-from src.other import clear, search, admin_userpermission_change, admin_user_remove, notifications_get
+from src.other import clear, search, admin_userpermission_change, admin_user_remove, notifications_get, \
+    insert_tag_notification
+from src import config, helper, channel as channel_module
 from src.user import user_profile
 from src.auth import auth_login, auth_register, get_data
 from src.channels import channels_create, channels_listall
@@ -245,3 +247,72 @@ def test_dm_invite_notification(user_create, handle_create):
             "notification_message" : f"{user1_handle} added you to {dm_info['dm_name']}"
         }]
     
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'notification_archive', str(tmp_path / 'notifications.archive'))
+    monkeypatch.setattr(config, 'notification_limit', 5)
+
+def tag_messages(user1_info, user2_info, handle, count):
+    channel_id = channels_create(user1_info['token'], 'channel', True)['channel_id']
+    channel_invite(user1_info['token'], channel_id, user2_info['auth_user_id'])
+    for i in range(count):
+        message_send(user1_info['token'], channel_id, f'{i} @{handle}')
+    return [f"{i} @{handle}"[:20] for i in range(count)]
+
+#test that only the newest notifications are kept with the user and older ones are paged from the archive
+def test_notifications_archived(user_create, handle_create, archive):
+    user1_info, user2_info, _, _ = user_create
+    _, user2_handle, _, _ = handle_create
+    sent = tag_messages(user1_info, user2_info, user2_handle, 24)
+    assert len(get_data()['users'][1]['notifications']) == 5
+
+    newest = notifications_get(user2_info['token'])['notifications']
+    assert [n['notification_message'].split(': ', 1)[1] for n in newest] == sent[:3:-1]
+    older = notifications_get(user2_info['token'], 20)['notifications']
+    assert [n['notification_message'].split(': ', 1)[1] for n in older[:4]] == sent[3::-1]
+    assert older[4]['notification_message'].endswith('added you to channel')
+    assert len(older) == 5
+
+#test that the archive isn't read for users that never had notifications archived
+def test_notifications_archive_not_read(user_create, handle_create, archive, monkeypatch):
+    user1_info, user2_info, _, _ = user_create
+    _, user2_handle, _, _ = handle_create
+    tag_messages(user1_info, user2_info, user2_handle, 6)
+    reads = []
+    archived = helper.archived_notifications
+    monkeypatch.setattr(helper, 'archived_notifications', lambda u_id: reads.append(u_id) or archived(u_id))
+    notifications_get(user1_info['token'])
+    assert reads == []
+    assert len(notifications_get(user2_info['token'])['notifications']) == 7
+    assert reads == [user2_info['auth_user_id']]
+
+#test that notifications saved newest first before the ring keep their order
+def test_notifications_old_list(user_create, handle_create, archive):
+    user1_info, user2_info, _, _ = user_create
+    _, user2_handle, _, _ = handle_create
+    user = get_data()['users'][1]
+    user['notifications'] = [{'channel_id' : -1, 'dm_id' : -1, 'notification_message' : str(i)}
+        for i in range(6, 0, -1)]
+    del user['notifications_head']
+    tag_messages(user1_info, user2_info, user2_handle, 1)
+    messages = [n['notification_message'] for n in notifications_get(user2_info['token'])['notifications']]
+    assert messages[2:] == ['6', '5', '4', '3', '2', '1']
+    assert len(get_data()['users'][1]['notifications']) == 5
+
+#test that everyone tagged in a message is notified once with a single write, members only
+def test_tag_notifications_batched(user_create, handle_create, monkeypatch):
+    user1_info, user2_info, user3_info, user4_info = user_create
+    _, user2_handle, user3_handle, user4_handle = handle_create
+    channel_id = channels_create(user1_info['token'], 'channel', True)['channel_id']
+    channel_invite(user1_info['token'], channel_id, user2_info['auth_user_id'])
+    channel_invite(user1_info['token'], channel_id, user3_info['auth_user_id'])
+
+    writes = []
+    write_data = channel_module.write_data
+    monkeypatch.setattr(channel_module, 'write_data', lambda data: writes.append(write_data(data)))
+    insert_tag_notification(user1_info['token'], channel_id,
+        f'@{user2_handle} @{user3_handle} @{user4_handle} @{user2_handle} @nobody')
+    assert len(writes) == 1
+    for info, count in ((user2_info, 2), (user3_info, 2), (user4_info, 0)):
+        assert_notification_len(notifications_get(info['token']), count)
@@ -0,0 +1,100 @@
+'''
+Tests for the background scheduler behind message_sendlater.
+'''
+
+import time
+import pytest
+
+from src import data_store, scheduler
+from src.auth import auth_register, auth_login, auth_logout, get_data, check_token
+from src.channels import channels_create
+from src.channel import channel_messages
+from src.message import message_send, message_sendlater, send_scheduled
+from src.other import clear
+
+@pytest.fixture
+def channel():
+    clear()
+    user = auth_register("email@email.com", "password", "firstname", "lastname")
+    channel_id = channels_create(user['token'], 'channel', True)['channel_id']
+    return user['token'], channel_id
+
+def u_id_of(token):
+    return get_data()['users'][check_token(token)]['u_id']
+
+def wait_for_messages(token, channel_id, timeout=3):
+    end = time.time() + timeout
+    while time.time() < end:
+        messages = channel_messages(token, channel_id, 0)['messages']
+        if messages:
+            return messages
+        time.sleep(0.05)
+    return []
+
+#test that the message id is handed back straight away and used once the message is sent
+def test_sendlater_returns_immediately(channel):
+    token, channel_id = channel
+    start = time.time()
+    message_id = message_sendlater(token, channel_id, 'later', time.time() + 0.5)['message_id']
+    assert time.time() - start < 0.5
+    assert channel_messages(token, channel_id, 0)['messages'] == []
+    messages = wait_for_messages(token, channel_id)
+    assert [(message['message_id'], message['message']) for message in messages] == \
+        [(message_id, 'later')]
+    # the job is taken off once its handler has returned
+    end = time.time() + 3
+    while get_data()['scheduled'] and time.time() < end:
+        time.sleep(0.05)
+    assert get_data()['scheduled'] == []
+
+#test that the message is still sent if the session it was scheduled from logs out
+def test_sendlater_after_logout(channel):
+    token, channel_id = channel
+    login = auth_login("email@email.com", "password")['token']
+    message_id = message_sendlater(token, channel_id, 'later', time.time() + 0.3)['message_id']
+    assert 'token' not in get_data()['scheduled'][0]['payload']
+    auth_logout(token)
+    assert wait_for_messages(login, channel_id)[0]['message_id'] == message_id
+
+#test that a job saved before a restart is sent once the scheduler sees it
+def test_overdue_after_restart(channel):
+    token, channel_id = channel
+    message_id = data_store.next_id('message_id')
+    data = get_data()
+    data['scheduled'] = [{'job_id' : data_store.next_id('job_id'), 'time' : time.time() - 10,
+        'kind' : 'message_send', 'payload' : {'token' : token, 'channel_id' : channel_id,
+        'message' : 'overdue', 'message_id' : message_id}}]
+    data_store.set_store(data)
+    data_store.flush_data()
+    data_store.load_data()
+    scheduler.start()
+    assert wait_for_messages(token, channel_id)[0]['message_id'] == message_id
+
+#test that running a scheduled send again doesn't send it twice
+def test_send_scheduled_once(channel):
+    token, channel_id = channel
+    message_id = data_store.next_id('message_id')
+    send_scheduled(channel_id, 'once', message_id, u_id=u_id_of(token))
+    send_scheduled(channel_id, 'once', message_id, u_id=u_id_of(token))
+    assert len(channel_messages(token, channel_id, 0)['messages']) == 1
+
+#test that clients can't choose the id of a message they send
+def test_send_ignores_message_id(channel):
+    token, channel_id = channel
+    first = message_send(token, channel_id, 'hello', message_id=1)['message_id']
+    second = message_send(token, channel_id, 'hello', message_id=first)['message_id']
+    assert first != second
+
+#test that a job taken off while another is added is still saved in log and sqlite modes
+def test_scheduled_same_length(channel, storage_mode):
+    token, channel_id = channel
+    message_sendlater(token, channel_id, 'first', time.time() + 60)
+    data = get_data()
+    job = data['scheduled'][0]
+    message_sendlater(token, channel_id, 'second', time.time() + 60)
+    data['scheduled'].remove(job)
+    data_store.set_store(data)
+    expected = [job['payload']['message'] for job in get_data()['scheduled']]
+    data_store.flush_data()
+    assert [job['payload']['message'] for job in data_store.load_data()['scheduled']] == \
+        expected == ['second']
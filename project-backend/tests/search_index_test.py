@@ -0,0 +1,169 @@
+'''
+Tests for the inverted index behind search.
+'''
+
+import copy
+import json
+import pytest
+
+from src import config, data_store, search_index
+from src.auth import auth_register, get_data
+from src.channels import channels_create
+from src.dm import dm_create, dm_remove
+from src.message import message_send, message_senddm, message_edit, message_remove
+from src.other import clear, search, admin_user_remove
+from src.error import InputError
+
+MESSAGES = ['hello world', 'Hello there, world!', 'say hello-world twice', 'helloworld',
+    'nothing here', 'a.b.c', 'world peace']
+
+@pytest.fixture
+def messages(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'search_index_file', str(tmp_path / 'search.index'))
+    clear()
+    user1 = auth_register("email1@email.com", "password", "first", "user")
+    user2 = auth_register("email2@email.com", "password", "second", "user")
+    channel_id = channels_create(user1['token'], 'channel', True)['channel_id']
+    dm_id = dm_create(user1['token'], [user2['auth_user_id']])['dm_id']
+    for i, message in enumerate(MESSAGES):
+        if i % 2:
+            message_senddm(user1['token'], dm_id, message)
+        else:
+            message_send(user1['token'], channel_id, message)
+    message_senddm(user2['token'], dm_id, 'hello from user two')
+    return user1, user2, channel_id, dm_id
+
+def scan(u_id, query_str):
+    return [message['message_id'] for channel in get_data()['channels'] \
+        for message in channel['messages'] if query_str in message['message'] and \
+        message['u_id'] == u_id]
+
+def found(token, query_str):
+    return [message['message_id'] for message in search(token, query_str)['messages']]
+
+QUERIES = ['hello', 'llo wor', 'o-w', 'world!', 'Hello', '', '.', 'b.c', 'there, world', 'xyz',
+    'lo', 'ld pe', 'oworl', 'a.b.c.d']
+
+#test that the index finds exactly what checking every message would
+def test_same_as_scan(messages):
+    user1, user2, _, _ = messages
+    for query_str in QUERIES:
+        assert found(user1['token'], query_str) == scan(user1['auth_user_id'], query_str)
+        assert found(user2['token'], query_str) == scan(user2['auth_user_id'], query_str)
+
+#test that edits, removes and removed users are kept up to date
+def test_changes(messages):
+    user1, user2, _, dm_id = messages
+    ids = found(user1['token'], 'hello')
+    message_edit(user1['token'], ids[0], 'goodbye world')
+    message_remove(user1['token'], ids[1])
+    assert found(user1['token'], 'goodbye') == [ids[0]]
+    assert ids[1] not in found(user1['token'], '')
+    admin_user_remove(user1['token'], user2['auth_user_id'])
+    # the removed user can't search any more, their messages are still indexed
+    assert [message['message_id'] for message in \
+        search_index.search_messages('Removed', user2['auth_user_id'])] == \
+        scan(user2['auth_user_id'], 'Removed') != []
+    dm_remove(user1['token'], dm_id)
+    assert found(user1['token'], 'world') == scan(user1['auth_user_id'], 'world')
+
+#test that a reload reads the index back from its file instead of rebuilding it
+def test_loaded_from_file(messages, monkeypatch):
+    user1, _, _, _ = messages
+    expected = found(user1['token'], 'world')
+    data_store.flush_data()
+    data_store.set_store(copy.deepcopy(get_data()))
+    def no_rebuild(text):
+        raise AssertionError('the index was rebuilt')
+    monkeypatch.setattr(search_index, 'trigrams', no_rebuild)
+    search_index._search_index()
+    monkeypatch.undo()
+    assert found(user1['token'], 'world') == expected
+
+#test that an index file out of step with the data is rebuilt
+def test_stale_file_rebuilt(messages):
+    user1, _, channel_id, _ = messages
+    saved = copy.deepcopy(get_data())
+    message_send(user1['token'], channel_id, 'only in the newer data')
+    data_store.set_store(saved)
+    assert found(user1['token'], 'newer') == []
+    assert found(user1['token'], 'world') == scan(user1['auth_user_id'], 'world')
+
+#test that the file is compacted once enough changes were appended, and still loads
+def test_file_compacted(messages, monkeypatch):
+    user1, _, channel_id, _ = messages
+    monkeypatch.setattr(config, 'search_compact_threshold', 5)
+    for i in range(12):
+        message_send(user1['token'], channel_id, f'compact {i}')
+    with open(config.search_index_file, 'r') as index_file:
+        assert len(index_file.readlines()) <= 5
+    expected = found(user1['token'], 'compact')
+    assert len(expected) == 12
+    data_store.set_store(copy.deepcopy(get_data()))
+    def no_rebuild(text):
+        raise AssertionError('the index was rebuilt')
+    monkeypatch.setattr(search_index, 'trigrams', no_rebuild)
+    search_index._search_index()
+    monkeypatch.undo()
+    assert found(user1['token'], 'compact') == expected
+
+#test that a file saved by another kind of index is rebuilt rather than trusted
+def test_other_format_rebuilt(messages):
+    user1, _, _, _ = messages
+    with open(config.search_index_file, 'w') as index_file:
+        index_file.write(json.dumps({'seq' : get_data()['sequences']['search_seq'],
+            'messages' : []}) + '\n')
+    data_store.set_store(copy.deepcopy(get_data()))
+    assert found(user1['token'], 'world') == scan(user1['auth_user_id'], 'world') != []
+
+#test that paging walks every match once, newest first
+def test_pages(messages):
+    user1, _, channel_id, _ = messages
+    ids = [message_send(user1['token'], channel_id, f'page {i}')['message_id'] for i in range(5)]
+    # the first one was sent last as far as its time is concerned
+    message = get_data()['channels'][0]['messages'][-5]
+    message['time_created'] += 100
+    message_edit(user1['token'], ids[0], 'page 0')
+    expected = [ids[0]] + ids[:0:-1]
+
+    pages = []
+    resp = search(user1['token'], 'page', limit=2)
+    pages.append(resp['messages'])
+    while resp['next_cursor'] is not None:
+        resp = search(user1['token'], 'page', cursor=resp['next_cursor'], limit=2)
+        pages.append(resp['messages'])
+    assert [len(page) for page in pages] == [2, 2, 1]
+    assert [message['message_id'] for page in pages for message in page] == expected
+
+#test that a page only checks as many messages as it needs
+def test_page_stops_early(messages, monkeypatch):
+    user1, _, _, _ = messages
+    checked = []
+    matching = search_index._matching
+    monkeypatch.setattr(search_index, '_matching', lambda *args: checked.append(1) or matching(*args))
+    assert len(search(user1['token'], '', limit=2)['messages']) == 2
+    assert len(checked) == 3
+
+#test that paging finds the same messages as a scan, newest first, for every query
+def test_pages_same_as_scan(messages):
+    user1, _, _, _ = messages
+    messages_by_id = {message['message_id'] : message for channel in get_data()['channels'] \
+        for message in channel['messages']}
+    for query_str in QUERIES:
+        expected = sorted(scan(user1['auth_user_id'], query_str), reverse=True,
+            key=lambda message_id: (messages_by_id[message_id]['time_created'], message_id))
+        paged = []
+        resp = search(user1['token'], query_str, limit=2)
+        paged += [message['message_id'] for message in resp['messages']]
+        while resp['next_cursor'] is not None:
+            resp = search(user1['token'], query_str, cursor=resp['next_cursor'], limit=2)
+            paged += [message['message_id'] for message in resp['messages']]
+        assert paged == expected
+
+#test that bad limits and cursors are rejected
+def test_page_invalid(messages):
+    user1, _, _, _ = messages
+    with pytest.raises(InputError):
+        search(user1['token'], 'hello', limit=0)
+    with pytest.raises(InputError):
+        search(user1['token'], 'hello', cursor='notacursor')
@@ -0,0 +1,93 @@
+'''
+Tests for the SQLite storage backend.
+'''
+
+import copy
+import json
+import pytest
+
+from src import config, data_store, sqlite_store
+from src.auth import auth_register, auth_login, get_data
+from src.channels import channels_create
+from src.channel import channel_invite
+from src.dm import dm_create
+from src.message import message_send, message_react, message_pin, message_remove
+from src.other import clear
+
+@pytest.fixture
+def workspace():
+    '''
+    Fills the database with a bit of everything that gets stored.
+    '''
+    clear()
+    user1 = auth_register("email@email.com", "password", "firstname", "lastname")
+    user2 = auth_register("email1@email.com", "password", "firstname", "lastname")
+    channel_id = channels_create(user1['token'], 'channel', False)['channel_id']
+    channel_invite(user1['token'], channel_id, user2['auth_user_id'])
+    dm_create(user1['token'], [user2['auth_user_id']])
+    message_id = message_send(user1['token'], channel_id, 'hello @firstnamelastname0')['message_id']
+    removed_id = message_send(user1['token'], channel_id, 'goodbye')['message_id']
+    message_react(user2['token'], message_id, 1)
+    message_pin(user1['token'], message_id)
+    message_remove(user1['token'], removed_id)
+    return copy.deepcopy(get_data())
+
+@pytest.fixture
+def sqlite_mode(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, 'storage_mode', 'sqlite')
+    monkeypatch.setattr(config, 'db_file', str(tmp_path / 'data.sqlite'))
+    return tmp_path
+
+#test that everything written row by row comes back out the same
+def test_round_trip(sqlite_mode, workspace):
+    assert data_store.load_data() == workspace
+
+#test that an empty database loads as a freshly cleared one
+def test_empty_database(sqlite_mode):
+    data = data_store.load_data()
+    assert data['users'] == [] and data['channels'] == []
+
+#test that the hot lookups are backed by indexes
+def test_indexes(sqlite_mode, workspace):
+    connection = sqlite_store.get_connection()
+    indexes = {row[0] for row in connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {'users_email', 'users_handle_str', 'messages_message_id', 'members_u_id'} <= indexes
+
+#test that an existing data.json can be imported without moving the running store
+def test_migrate(sqlite_mode, workspace, monkeypatch):
+    json_file = sqlite_mode / 'import.json'
+    json_file.write_text(json.dumps(workspace))
+    db_file = config.db_file
+    assert sqlite_store.migrate(str(json_file), str(sqlite_mode / 'import.sqlite')) == \
+        {'users' : 2, 'channels' : 2}
+    assert config.db_file == db_file
+    monkeypatch.setattr(config, 'db_file', str(sqlite_mode / 'import.sqlite'))
+    assert data_store.load_data() == workspace
+
+#test that a send appends a stats row and leaves the user's other rows alone
+def test_send_touches_few_rows(sqlite_mode, workspace):
+    token = auth_login("email@email.com", "password")['token']
+    channel_id = workspace['channels'][0]['channel_id']
+    for i in range(10):
+        message_send(token, channel_id, str(i))
+    statements = []
+    sqlite_store.get_connection().set_trace_callback(statements.append)
+    message_send(token, channel_id, 'last')
+    sqlite_store.get_connection().set_trace_callback(None)
+    written = ' '.join(statements)
+    assert 'user_series' in written
+    assert 'sessions' not in written and 'notifications' not in written
+    expected = copy.deepcopy(get_data())
+    assert data_store.load_data() == expected
+
+#test that series kept in the users row by older databases are still read
+def test_series_in_users_row(sqlite_mode, workspace):
+    connection = sqlite_store.get_connection()
+    u_id = workspace['users'][0]['u_id']
+    with connection:
+        connection.execute('DELETE FROM user_series WHERE u_id = ? AND key = ?',
+            (u_id, 'messages_sent'))
+        connection.execute('UPDATE users SET messages_sent = ? WHERE u_id = ?',
+            (json.dumps(workspace['users'][0]['messages_sent']), u_id))
+    assert data_store.load_data() == workspace
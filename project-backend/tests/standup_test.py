@@ -7,6 +7,7 @@ Date:
 '''
 
 import pytest
+import threading
 import time
 
 from src.auth import check_token
@@ -15,6 +16,9 @@ from src.standup import standup_start, standup_active, standup_send
 from src.helper import check_channel_id
 from src.user import user_profile
 from src.channel import channel_messages
+from src import config, data_store, scheduler
+from src.auth import auth_login, auth_logout
+from src.auth import get_data
 from tests.setup_test import users, spare_user, channel_id
 
 
@@ -322,4 +326,103 @@ def test_standup_send_auth_not_member(users, channel_id, spare_user):
         standup_send(user2, pub_channel, '123')
         standup_send(user3, pub_channel, 'xyz')
 
-    
\ No newline at end of file
+    
+
+# --------------------------------------------------------------------------------------- #
+# ----------------------------- Tests for StandUp Scheduling ---------------------------- #
+# --------------------------------------------------------------------------------------- #
+def test_standup_deadline_persisted(users, channel_id):
+    '''
+    Tests that the end of a standup is saved as a scheduled job rather than held by a timer.
+    '''
+    user1, user2, _, _ = users
+    pub_channel, priv_channel = channel_id
+    threads = threading.active_count()
+    end_time1 = standup_start(user1, pub_channel, 60)['time_finish']
+    end_time2 = standup_start(user2, priv_channel, 60)['time_finish']
+
+    jobs = [job for job in get_data()['scheduled'] if job['kind'] == 'standup_reset']
+    assert sorted(job['time'] for job in jobs) == sorted([end_time1, end_time2])
+    assert threading.active_count() <= threads + 1
+
+def test_standup_sent_after_logout(users, channel_id):
+    '''
+    Tests that the standup is still sent and cleared when its starter logged out before it ended,
+    and that no session token is saved with the job.
+    '''
+    user1, _, u_id1, _ = users
+    pub_channel, _ = channel_id
+    standup_start(user1, pub_channel, 60)
+    standup_send(user1, pub_channel, 'still sent')
+    job = [job for job in get_data()['scheduled'] if job['kind'] == 'standup_reset'][0]
+    assert 'token' not in job['payload']
+    auth_logout(user1)
+    scheduler.run_job(job['job_id'])
+
+    token = auth_login("userz@email.com", "jaajdfs23")['token']
+    messages = channel_messages(token, pub_channel, 0)['messages']
+    assert [(message['u_id'], message['message'].split(': ')[1]) for message in messages] == \
+        [(u_id1, 'still sent')]
+    assert standup_active(token, pub_channel)['is_active'] is False
+
+def test_standup_inactive_after_deadline(users, channel_id):
+    '''
+    Tests that a standup stops being active at time_finish even before it has been reset.
+    '''
+    user1, _, _, _ = users
+    pub_channel, _ = channel_id
+    standup_start(user1, pub_channel, 60)
+    channel = get_data()['channels'][check_channel_id(pub_channel)]
+    channel['standup']['time_finish'] = int(time.time()) - 1
+    assert standup_active(user1, pub_channel) == {'is_active': False, 'time_finish': None}
+    with pytest.raises(InputError):
+        standup_send(user1, pub_channel, 'too late')
+
+# --------------------------------------------------------------------------------------- #
+# ----------------------------- Tests for StandUp Buffer -------------------------------- #
+# --------------------------------------------------------------------------------------- #
+@pytest.fixture
+def journal(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, 'standup_journal', str(tmp_path / 'standup.journal'))
+    monkeypatch.setattr(config, 'standup_buffer_limit', 3)
+    return tmp_path / 'standup.journal'
+
+def test_standup_send_buffered(users, channel_id, journal, monkeypatch):
+    '''
+    Tests that lines sent to a standup go to the journal instead of the database.
+    '''
+    user1, _, _, _ = users
+    pub_channel, _ = channel_id
+    standup_start(user1, pub_channel, 60)
+    writes = []
+    monkeypatch.setattr(data_store, 'set_store', writes.append)
+    standup_send(user1, pub_channel, 'abc')
+    assert writes == []
+    assert len(journal.read_text().splitlines()) == 1
+
+def test_standup_buffer_limit(users, channel_id, journal):
+    '''
+    Tests for InputError once a standup holds the most lines it can.
+    '''
+    user1, _, _, _ = users
+    pub_channel, _ = channel_id
+    standup_start(user1, pub_channel, 60)
+    for line in ('1', '2', '3'):
+        standup_send(user1, pub_channel, line)
+    with pytest.raises(InputError):
+        standup_send(user1, pub_channel, '4')
+
+def test_standup_buffer_recovered(users, channel_id, journal):
+    '''
+    Tests that buffered lines survive a reload and are sent when the standup ends.
+    '''
+    user1, _, u_id1, _ = users
+    pub_channel, _ = channel_id
+    standup_start(user1, pub_channel, 2)
+    standup_send(user1, pub_channel, 'abc')
+    data_store.flush_data()
+    data_store.load_data()
+    time.sleep(2.5)
+    handle = user_profile(user1, u_id1)['user']['handle_str']
+    assert channel_messages(user1, pub_channel, 0)['messages'][0]['message'] == f"{handle}: abc"
+    assert journal.read_text() == ''
@@ -8,7 +8,7 @@ Date:
 
 import datetime
 import pytest
-from src.dm import dm_create
+from src.dm import dm_create, dm_leave
 from src.auth import auth_register, get_data
 from src.user import user_profile, user_profile_setname, \
     user_profile_setemail, user_profile_sethandle, users_all, user_profile_uploadphoto,\
@@ -19,6 +19,7 @@ from src.error import InputError, AccessError
 from src.channels import channels_create
 from src.channel import channel_invite
 from src.message import message_send
+from src import image_pipeline
 
 @pytest.fixture
 def users():
@@ -237,26 +238,22 @@ def test_set_handle_taken(users, profiles):
 # --------------------------------------------------------------------------------------- #
 # ----------------------------- Tests for uploadPhoto ----------------------------------- #
 # --------------------------------------------------------------------------------------- #
-def test_uploadphoto_inputError(users):
-    #get token
-    user_profile_uploadphoto(users['user1']['token'], "https://images.all-free-download.com/images/graphicthumb/default_profile_picture_117087.jpg", 1,1,200,200)
-    #try to access the image, this requires manually check the src/static file
-    user_profile_uploadphoto(users['user2']['token'], "https://images.all-free-download.com/images/graphicthumb/default_profile_picture_117087.jpg", 1,1,200,200)
-    # result = user_profile(users['user1']['token'], users['user1']['auth_user_id'])
-    # result2 = user_profile(users['user2']['token'], users['user2']['auth_user_id'])
-#     #check the input error, x_start/end, y_start/end are not within the dimensions of the image at the URL
+def test_uploadphoto_inputError(users, image_server):
+    base, _ = image_server
+    user_profile_uploadphoto(users['user1']['token'], f"{base}/picture.jpg", 1,1,200,200)
+    user_profile_uploadphoto(users['user2']['token'], f"{base}/picture.jpg", 1,1,200,200)
+    assert image_pipeline.wait(users['user1']['auth_user_id'], timeout=10)
+    assert image_pipeline.wait(users['user2']['auth_user_id'], timeout=10)
+    #check the input error, x_start/end, y_start/end are not within the dimensions of the image at the URL
+    user_profile_uploadphoto(users['user2']['token'], f"{base}/picture.jpg", 1,1,5000,5000)
     with pytest.raises(InputError):
-        user_profile_uploadphoto(users['user2']['token'], "http://site.meishij.net/r/58/25/3568808/a3568808_142682562777944.jpg", 1,1,5000,5000)
+        image_pipeline.wait(users['user2']['auth_user_id'], timeout=10)
     with pytest.raises(InputError):
-        user_profile_uploadphoto(users['user3']['token'], "http://site.meishij.net/r/58/25/3568808/a3568808_142682562777944.jpg", 5000,5000,50,50)
-    
-    #Check img_url returns an HTTP status other than 200
-    # with pytest.raises(InputError):
-    #     user_profile_uploadphoto('1', "http://site.invalid.jpg", 5000,5000,50,50)
-    
+        user_profile_uploadphoto(users['user3']['token'], f"{base}/picture.jpg", 5000,5000,50,50)
+
     # Check the image uploaded is not a JPG
     with pytest.raises(InputError):
-        user_profile_uploadphoto(users['user3']['token'], "https://s29843.pcdn.co/blog/wp-content/uploads/sites/2/2020/11/TechSmith-Blog-JPGvsPNG.png", 1,1,50,50)
+        user_profile_uploadphoto(users['user3']['token'], f"{base}/picture.png", 1,1,50,50)
 
 #USER_STATS_TESTS:
 def test_no_involvement(users):
@@ -334,3 +331,13 @@ def test_dreams_utilizations(users, channels):
     token = users['user1']['token']
     resp = users_stats(token)['dreams_stats']
     assert resp['utilization_rate'] == 2/3
+
+#test that leaving a dm shows up in the stats on the next membership change
+def test_stats_after_dm_leave(users):
+    token1 = users['user1']['token']
+    token2 = users['user2']['token']
+    dm_id = dm_create(token1, [users['user2']['auth_user_id']])['dm_id']
+    dm_leave(token2, dm_id)
+    channels_create(token1, 'channelname0', True)
+    stats = user_stats(token2)['user_stats']
+    assert [stat['num_dms_joined'] for stat in stats['dms_joined']] == [0, 1, 0]